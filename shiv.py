@@ -8,23 +8,88 @@
 #              real-time noise reduction, local system control, and AI integration.
 # =============================================================================
 
+import time
+_PROCESS_T0 = time.perf_counter() # Startup timeline origin
 import tkinter as tk
-from PIL import Image, ImageTk, ImageSequence
+import importlib
+import importlib.util
 import threading
+import queue
+import itertools
+import heapq
+import random
+import bisect
+import concurrent.futures
 import asyncio
-import pyttsx3
 import datetime
-import wikipedia
 import webbrowser
 import os
-import time
 import speech_recognition as sr
-import google.generativeai as genai
 import re
+import sqlite3
+import hashlib
+import difflib
+import wave
+import gzip
+import ssl
+import urllib.parse
+import glob
+import base64
+import struct
+import io
+from collections import deque
+import json
+import logging
+import contextlib
+import weakref
+from collections import OrderedDict
 import numpy as np
-import noisereduce as nr
 from dotenv import load_dotenv # <<< ADD THIS LINE
 
+# =====================================
+# Startup: lazy imports + timeline
+# =====================================
+class LazyModule:
+    """ Stands in for a heavy module and imports it on first attribute access (thread-safe via the import lock). """
+    def __init__(self, name): self.__dict__["_name"] = name; self.__dict__["_module"] = None
+    def _load(self):
+        if self._module is None:
+            with STARTUP.phase(f"import {self._name}"): self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+    def __getattr__(self, attr): return getattr(self._load(), attr)
+
+class StartupTimeline:
+    """ Records named startup phases (possibly overlapping, on several threads) and prints them once. """
+    def __init__(self, t0): self.t0 = t0; self.phases = []; self._lock = threading.Lock(); self._reported = False
+    def record(self, name, start, end):
+        with self._lock: self.phases.append((name, start - self.t0, end - start, threading.current_thread().name))
+    def phase(self, name):
+        timeline = self
+        class _Phase:
+            def __enter__(self): self.start = time.perf_counter(); return self
+            def __exit__(self, *exc): timeline.record(name, self.start, time.perf_counter()); return False
+        return _Phase()
+    def mark(self, name): now = time.perf_counter(); self.record(name, now, now)
+    def report(self):
+        """ Prints one line per phase (offset from process start, duration, thread); only the first call prints. """
+        with self._lock:
+            if self._reported: return
+            self._reported = True; phases = sorted(self.phases, key=lambda p: p[1])
+        print("--- Startup timeline ---")
+        for name, offset, duration, thread in phases: print(f"  +{offset*1000:7.0f}ms  {name:<32} {duration*1000:7.0f}ms  [{thread}]")
+        print("------------------------")
+
+STARTUP = StartupTimeline(_PROCESS_T0)
+STARTUP.record("core imports", _PROCESS_T0, time.perf_counter())
+
+# Heavy libraries load on first use (mostly from background startup threads), not at import
+genai = LazyModule("google.generativeai")
+nr = LazyModule("noisereduce")
+pyttsx3 = LazyModule("pyttsx3")
+Image = LazyModule("PIL.Image")
+ImageTk = LazyModule("PIL.ImageTk")
+ImageSequence = LazyModule("PIL.ImageSequence")
+
 # Load environment variables from .env file
 load_dotenv() # <<< ADD THIS LINE
 
@@ -38,7 +103,7 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 GENERATIVE_MODEL_NAME = "gemini-1.5-flash" # Or "gemini-pro"
 
-google_ai_configured = False
+google_ai_configured = False # Set once configure_google_ai() succeeds (deferred to the startup thread)
 ai_model_loaded = False # Flag specifically for model loading success
 
 if not GOOGLE_API_KEY or "YOUR_API_KEY" in GOOGLE_API_KEY:
@@ -46,104 +111,1850 @@ if not GOOGLE_API_KEY or "YOUR_API_KEY" in GOOGLE_API_KEY:
     GOOGLE_API_KEY = None
 else:
     print(f"Using GOOGLE_API_KEY from .env file, starting with: {GOOGLE_API_KEY[:4]}...{GOOGLE_API_KEY[-4:]}")
+
+def configure_google_ai():
+    """ Imports and configures the Google AI SDK; deferred so the import cost is paid off the startup path. """
+    global google_ai_configured, GOOGLE_API_KEY
+    if google_ai_configured or not GOOGLE_API_KEY: return google_ai_configured
     try:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        print("Google AI SDK configured successfully using hardcoded key.")
+        with STARTUP.phase("configure google ai"): genai.configure(api_key=GOOGLE_API_KEY)
+        print("Google AI SDK configured successfully using .env key.")
         google_ai_configured = True
     except Exception as e:
         print(f"\n!!! ERROR configuring Google AI SDK: {e} !!!\n")
         GOOGLE_API_KEY = None
+    return google_ai_configured
 
 # --- Other Settings ---
 GIF_OVERLAY_ALPHA = 160
+GIF_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".shiva_gif_cache") # Prepared frames, reused across runs
+GIF_FRAME_MEMORY_CAP_MB = 256 # Budget for decoded frames held by the UI; larger GIFs drop frames/resolution or stream from disk
 ENABLE_NOISE_REDUCTION = True
+MIC_CALIBRATION_SECONDS = 1.0 # Ambient-noise calibration at startup (dynamic_energy_threshold keeps adapting after)
+ENABLE_VAD_FRONTEND = True # Persistent mic stream + streaming voice-activity detection instead of recognizer.listen()
+VAD_HANGOVER_MS = 450 # Silence that ends an utterance (listen() waited pause_threshold = 1000 ms)
+VAD_PRE_ROLL_MS = 300 # Audio kept from before speech onset so first syllables are not clipped
+VAD_HALF_DUPLEX = True # While Shiva speaks, only "stop"/"cancel" is acted on (no echo cancellation); False hears everything, echo included
+VAD_BARGE_IN_MARGIN = 2.0 # While Shiva speaks, speech must be this much louder than the normal VAD threshold (keeps its own echo out of STT)
+ENABLE_WAKE_WORD = True # Only utterances that contain (or closely follow) the wake word reach noise reduction + STT (VAD front-end)
+WAKE_WORD = "shiva"
+WAKE_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wake_templates") # 3-5 short WAVs of you saying the wake word
+WAKE_SENSITIVITY = 0.5 # 0..1: higher wakes more easily (fewer misses, more false accepts); try shiva_bench.py wake
+WAKE_FOLLOWUP_SECONDS = 8.0 # After an admitted utterance, the next one needs no wake word
+STT_BACKEND = "auto" # "google" (cloud), "vosk" (offline), "hybrid" (local first, cloud on low confidence) or "auto"
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "vosk-model-small-en-in-0.4"))
+STT_MIN_CONFIDENCE = 0.75 # Hybrid: local results below this also ask the cloud
+STT_DEADLINE_SECONDS = 2.5 # Hybrid: after this, answer with the best result available
+ENABLE_AI_STREAMING = True # Speak AI answers sentence-by-sentence while they are still being generated
+ENABLE_SPECULATIVE_AI = True # Hybrid STT: start the AI fallback on the unsure local transcript while the cloud confirms it
+SPECULATIVE_AI_MAX_CONFIDENCE = 0.8 # ...but only when the router's built-in confidence (IntentRouter.builtin_confidence) is below this
+ENABLE_RESPONSE_CACHE = True
+RESPONSE_CACHE_MAX_ENTRIES = 512
+RESPONSE_CACHE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shiva_cache.sqlite3") # None = memory only
+WIKIPEDIA_LANG = "en"
+WIKIPEDIA_API_URL = os.getenv("SHIVA_WIKIPEDIA_URL") or f"https://{WIKIPEDIA_LANG}.wikipedia.org/w/api.php" # e.g. the offline stand-in from shiva_bench.py wiki --serve
+WIKIPEDIA_SENTENCES = 3
+WIKIPEDIA_TIMEOUT = 8.0 # Seconds per HTTP exchange
+AI_MAX_CONCURRENCY = 4 # Simultaneous Gemini calls
+AI_RPM_LIMIT = 15 # Requests/minute and tokens/minute budget for GENERATIVE_MODEL_NAME (gemini-1.5-flash free tier)
+AI_TPM_LIMIT = 1_000_000
+AI_MAX_RETRIES = 4 # Retries for 429 / quota / transient network errors (exponential backoff with full jitter)
+ENABLE_CONVERSATION_MEMORY = True # AI fallback answers see earlier turns ("and what about tomorrow?")
+CONVERSATION_TOKEN_BUDGET = 1500 # Max estimated prompt tokens of context (summary + recent turns) sent per question
+CONVERSATION_IDLE_SECONDS = 300 # A new conversation starts after this much silence
+AI_REQUEST_DEADLINE = 10.0 # Seconds before a spoken fallback (stale cached answer or a short canned reply)
+RESPONSE_CACHE_TTLS = {"weather": 15*60, "fact": 30*60, "ai": 6*3600, "wikipedia": 7*24*3600} # Seconds, per source
+LOG_LEVEL = os.getenv("SHIVA_LOG_LEVEL", "INFO") # DEBUG shows per-command tracing; at INFO those calls cost a level check
+ENABLE_METRICS = True # Counters, histograms and stage spans in METRICS (in-process; exported only if configured below)
+METRICS_JSONL_PATH = os.getenv("SHIVA_METRICS_JSONL") # e.g. "shiva_metrics.jsonl": one snapshot line per METRICS_EXPORT_SECONDS
+METRICS_EXPORT_SECONDS = 60
+METRICS_HTTP_PORT = int(os.getenv("SHIVA_METRICS_PORT", "0")) or None # e.g. 9464: Prometheus text at http://127.0.0.1:<port>/metrics
 DEFAULT_MUSIC_FOLDER = r"C:\Users\SHYAM YADAV\Music"
 DEFAULT_PDF_PATH = r"C:\Users\SHYAM YADAV\Downloads\Shivavoice\SHIVA_PDF.3[1].pdf"
 DEFAULT_WORD_PATH = r"C:\Users\SHYAM YADAV\Downloads\Shivavoice\project_report_shyam[1].docx"
 DEFAULT_VIDEO_PATH = r"C:\Users\SHYAM YADAV\OneDrive\Desktop\Shivavoice\videoplayback.mp4"
 DEFAULT_GIF_PATH = r"C:\Users\SHYAM YADAV\OneDrive\Desktop\Shivavoice\Generated shiva.gif"
+ENABLE_MEDIA_INDEX = True # Background-scanned library for "play <title>" / "open <name> pdf" instead of listing a folder per request
+MEDIA_INDEX_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shiva_media.sqlite3") # None = memory only
+MEDIA_LIBRARY_ROOTS = [DEFAULT_MUSIC_FOLDER] + [os.path.join(os.path.expanduser("~"), d) for d in ("Music", "Videos", "Documents", "Downloads", "Desktop")]
+MEDIA_RESCAN_SECONDS = 15*60 # Incremental rescan interval (only new/changed files are re-indexed)
+MEDIA_KINDS = {"music": ("mp3", "wav", "ogg", "flac", "m4a", "aac", "wma"), "video": ("mp4", "avi", "mov", "mkv", "wmv"), "pdf": ("pdf",), "word": ("docx", "doc")}
+TIMER_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shiva_timers.sqlite3") # Pending timers/reminders survive restarts; None = memory only
+SERVER_HOST = os.getenv("SHIVA_SERVER_HOST", "127.0.0.1") # python shiv.py --server: many clients over WebSocket/HTTP instead of the local mic + window
+SERVER_PORT = int(os.getenv("SHIVA_SERVER_PORT", "8765"))
+SERVER_MAX_SESSIONS = 500
+SERVER_SESSION_IDLE_SECONDS = 15*60 # Sessions with no input for this long are closed (their timers go with them)
+SERVER_REQUEST_TIMEOUT = 30.0 # HTTP: seconds to wait for a command's replies
 
 print("--- End Configuration Phase ---")
 
+# =====================================
+# Instrumentation: leveled logging, counters, histograms, stage spans, export
+# =====================================
+log = logging.getLogger("shiva")
+if not log.handlers:
+    _log_handler = logging.StreamHandler(); _log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s")); log.addHandler(_log_handler); log.propagate = False
+try: log.setLevel(int(LOG_LEVEL) if LOG_LEVEL.strip().isdigit() else LOG_LEVEL.strip().upper())
+except ValueError: log.setLevel(logging.INFO); log.warning("Unknown SHIVA_LOG_LEVEL %r; using INFO.", LOG_LEVEL)
+
+class Metrics:
+    """ Thread-safe in-process metrics: counters and fixed-bucket latency histograms keyed by (name, labels).
+        span() times a block into a histogram. With enabled=False every call returns immediately.
+        snapshot() is JSON-friendly; prometheus_text() renders the Prometheus text exposition format. """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    def __init__(self, enabled=True, buckets=BUCKETS):
+        self.enabled = enabled; self.buckets = tuple(buckets); self._counters = {}; self._hists = {}; self._lock = threading.Lock()
+    @staticmethod
+    def _key(name, labels): return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+    def inc(self, name, value=1, **labels):
+        if not self.enabled: return
+        key = self._key(name, labels)
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + value
+    def observe(self, name, seconds, **labels):
+        if not self.enabled: return
+        key = self._key(name, labels); idx = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None: hist = self._hists[key] = [[0] * (len(self.buckets) + 1), 0.0, 0] # bucket counts (+Inf last), sum, count
+            hist[0][idx] += 1; hist[1] += seconds; hist[2] += 1
+    def span(self, name, **labels):
+        """ with METRICS.span("stage_seconds", stage="stt"): ...  (works inside coroutines too). """
+        return _Span(self, name, labels) if self.enabled else _NO_SPAN
+    def quantile(self, name, q, **labels):
+        """ Bucket-interpolated quantile estimate of a histogram in seconds (None if empty). """
+        with self._lock: hist = self._hists.get(self._key(name, labels)); counts = list(hist[0]) if hist else None
+        if not counts or not sum(counts): return None
+        target = q * sum(counts); seen = 0
+        for i, c in enumerate(counts):
+            if seen + c >= target and c:
+                lo = self.buckets[i - 1] if i else 0.0; hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (target - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+    def snapshot(self):
+        with self._lock: counters = dict(self._counters); hists = {k: (list(v[0]), v[1], v[2]) for k, v in self._hists.items()}
+        label = lambda key: key[0] + ("{" + ",".join(f"{k}={v}" for k, v in key[1]) + "}" if key[1] else "")
+        out = {"ts": time.time(), "counters": {label(k): v for k, v in sorted(counters.items())}, "histograms": {}}
+        for key, (counts, total, n) in sorted(hists.items()):
+            labels = dict(key[1]); out["histograms"][label(key)] = {"count": n, "sum": round(total, 6), "mean_ms": round(total / n * 1000, 3) if n else 0.0,
+                "p50_ms": round((self.quantile(key[0], 0.5, **labels) or 0) * 1000, 3), "p95_ms": round((self.quantile(key[0], 0.95, **labels) or 0) * 1000, 3)}
+        return out
+    def prometheus_text(self):
+        with self._lock: counters = dict(self._counters); hists = {k: (list(v[0]), v[1], v[2]) for k, v in self._hists.items()}
+        fmt = lambda pairs: "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}" if pairs else ""
+        lines = []; typed = set()
+        for (name, pairs), value in sorted(counters.items()):
+            if name not in typed: lines.append(f"# TYPE shiva_{name} counter"); typed.add(name)
+            lines.append(f"shiva_{name}{fmt(pairs)} {value}")
+        for (name, pairs), (counts, total, n) in sorted(hists.items()):
+            if name not in typed: lines.append(f"# TYPE shiva_{name} histogram"); typed.add(name)
+            cumulative = 0
+            for bound, c in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += c; lines.append(f"shiva_{name}_bucket{fmt(pairs + (('le', bound),))} {cumulative}")
+            lines.append(f"shiva_{name}_sum{fmt(pairs)} {total}"); lines.append(f"shiva_{name}_count{fmt(pairs)} {n}")
+        return "\n".join(lines) + "\n"
+
+    def write_jsonl(self, path):
+        with open(path, "a", encoding="utf-8") as f: f.write(json.dumps(self.snapshot()) + "\n")
+    def start_export(self, jsonl_path=None, http_port=None, interval=METRICS_EXPORT_SECONDS):
+        """ Optional local export: a JSONL snapshot every interval seconds and/or a Prometheus endpoint on 127.0.0.1. """
+        if jsonl_path:
+            def writer():
+                while True:
+                    time.sleep(interval)
+                    try: self.write_jsonl(jsonl_path)
+                    except OSError as e: log.warning("Metrics JSONL write failed: %s", e)
+            threading.Thread(target=writer, name="shiva-metrics-jsonl", daemon=True).start(); print(f"Metrics: appending snapshots to {jsonl_path} every {interval}s.")
+        if http_port:
+            import http.server
+            metrics = self
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.prometheus_text().encode() if self.path.startswith("/metrics") else b"see /metrics\n"
+                    self.send_response(200 if self.path.startswith("/metrics") else 404); self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+                def log_message(self, *args): pass
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", http_port), Handler)
+            threading.Thread(target=server.serve_forever, name="shiva-metrics-http", daemon=True).start(); print(f"Metrics: Prometheus endpoint on http://127.0.0.1:{http_port}/metrics")
+            return server
+
+def percentile(samples, pct):
+    """ Nearest-rank percentile of a list of numbers (0 for an empty list); Metrics.quantile estimates from histogram buckets instead. """
+    if not samples: return 0.0
+    ordered = sorted(samples); k = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+class _Span:
+    __slots__ = ("metrics", "name", "labels", "start")
+    def __init__(self, metrics, name, labels): self.metrics = metrics; self.name = name; self.labels = labels
+    def __enter__(self): self.start = time.perf_counter(); return self
+    def __exit__(self, *exc): self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels); return False
+
+class _NoSpan:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+_NO_SPAN = _NoSpan()
+
+METRICS = Metrics(enabled=ENABLE_METRICS)
+
+# =====================================
+# Intent Router: compiled built-in command matching
+# =====================================
+_WAKE_PREFIX_RE = re.compile(r'^\s*shiva\b', re.IGNORECASE)
+_FILLER_WORDS_RE = re.compile(r'\b(please|can you|could you|tell me|what is|who is|open|play|start|show|display|search|set|get me|find)\b', re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+class Intent:
+    """ A built-in command: its trigger phrases and the coroutine handler(shiva, raw_query) that serves it.
+        With prefix=True the triggers only count at the start of the query (after an optional "shiva"). """
+    def __init__(self, name, triggers, handler, prefix=False):
+        self.name = name; self.triggers = list(triggers); self.handler = handler; self.prefix = prefix
+    def __repr__(self): return f"Intent({self.name!r})"
+
+class IntentRouter:
+    """ Routes a query to the first-registered Intent whose trigger phrase appears in it as whole words
+        (so "time" no longer fires inside "sometimes" and "fact" not inside "manufacture"). There is no stemming:
+        plural forms are listed as triggers where they are meant ("timers", "songs"), so "times" is not "time".
+        Triggers are compiled into a word-level lookup keyed on each phrase's first word, so a query is
+        tokenized once and scanned in a single pass. Registration order is priority order, like the old elif chain. """
+    _WORD_RE = re.compile(r"[a-z0-9']+")
+    def __init__(self, intents):
+        self.intents = list(intents); self._first_word = {}
+        for idx, intent in enumerate(self.intents):
+            for phrase in intent.triggers:
+                words = tuple(phrase.lower().split())
+                self._first_word.setdefault(words[0], []).append((idx, words))
+        for cands in self._first_word.values(): cands.sort(key=lambda c: (c[0], -len(c[1]))) # Priority, then longest phrase
+        self._phrases = {} # Word count -> trigger phrases, for builtin_confidence
+        for phrase in sorted({" ".join(p.lower().split()) for intent in self.intents for p in intent.triggers}): self._phrases.setdefault(len(phrase.split()), []).append(phrase)
+    def _phrase_at(self, words, pos, phrase):
+        end = pos + len(phrase)
+        if end > len(words): return False
+        if len(phrase) > 1 and tuple(words[pos:end-1]) != phrase[:-1]: return False
+        return words[end-1] == phrase[-1]
+    def match(self, query):
+        """ Returns (intent, (start_word, end_word)) for the highest-priority trigger in query, or (None, None). """
+        words = self._WORD_RE.findall(query.lower()); best = None; best_idx = len(self.intents)
+        lead = 1 if words and words[0] == "shiva" else 0 # Prefix-only intents may follow the wake word
+        for pos, word in enumerate(words):
+            cands = self._first_word.get(word)
+            if not cands: continue
+            for idx, phrase in cands:
+                if idx >= best_idx: break
+                if self.intents[idx].prefix and pos != lead: continue
+                if self._phrase_at(words, pos, phrase):
+                    best, best_idx = (pos, pos + len(phrase)), idx; break
+            if best_idx == 0: break # Nothing can outrank the first intent
+        return (self.intents[best_idx], best) if best else (None, None)
+    def route(self, query): return self.match(query)[0]
+    def builtin_confidence(self, query):
+        """ How likely query (possibly a misheard partial transcript) is a built-in command: 1.0 when a trigger matches,
+            else the best fuzzy match of a same-length run of its words to a trigger phrase ("wether" ~ "weather" 0.92,
+            "who made you" ~ "who created you" 0.78), 0.0 if nothing is near. """
+        if self.route(query) is not None: return 1.0
+        words = self._WORD_RE.findall(query.lower()); best = 0.0
+        for n, phrases in self._phrases.items():
+            for i in range(len(words) - n + 1):
+                window = " ".join(words[i:i + n])
+                if len(window) < 3: continue
+                for near in difflib.get_close_matches(window, phrases, n=1, cutoff=0.6): best = max(best, difflib.SequenceMatcher(None, window, near).ratio())
+        return best
+
+# =====================================
+# Streaming helpers
+# =====================================
+class SentenceSplitter:
+    """ Incrementally splits streamed text into sentences. feed() returns the sentences completed so far;
+        a terminator only counts once whitespace follows it, so "3.14" or a chunk ending in "." is not cut early. """
+    _BOUNDARY_RE = re.compile(r'(?<=[.!?])["\')\]]*\s+|\n+')
+    def __init__(self, min_chars=12):
+        self.min_chars = min_chars; self._buf = ""
+    def feed(self, text):
+        self._buf += text; out = []; start = 0
+        for m in self._BOUNDARY_RE.finditer(self._buf):
+            sentence = self._buf[start:m.end()].strip()
+            if len(sentence) < self.min_chars and "\n" not in m.group(): continue # Merge tiny fragments ("Dr.", "1.") into the next one
+            if sentence: out.append(sentence)
+            start = m.end()
+        self._buf = self._buf[start:]; return out
+    def flush(self):
+        tail = self._buf.strip(); self._buf = ""; return tail
+
+# =====================================
+# Speech Worker: prioritized, interruptible TTS off the event loop
+# =====================================
+PRIORITY_URGENT, PRIORITY_NORMAL, PRIORITY_LOW = 0, 10, 20
+
+class Utterance:
+    """ One queued speech request. future resolves True when fully spoken, False if cancelled or cut off. """
+    def __init__(self, text, priority, seq):
+        self.text = text; self.priority = priority; self.seq = seq; self.cancelled = False; self.submitted = time.perf_counter()
+        self.segments = _split_for_speech(text)
+        self.future = concurrent.futures.Future()
+    def _resolve(self, spoken):
+        if not self.future.done(): self.future.set_result(spoken)
+    def __lt__(self, other): return (self.priority, self.seq) < (other.priority, other.seq)
+
+def _split_for_speech(text):
+    """ Sentence segments for the worker, so preemption and cancellation can happen between sentences. """
+    splitter = SentenceSplitter(); segments = splitter.feed(text); tail = splitter.flush()
+    return segments + [tail] if tail else segments
+
+class SpeechWorker:
+    """ Owns the TTS engine on a dedicated thread and speaks queued Utterances in priority order (lower = sooner).
+        A more urgent submission preempts the current utterance (it resumes afterwards from the interrupted
+        sentence); cancel()/barge_in() drop queued speech and cut off whatever is playing. All methods are thread-safe.
+        engine_factory runs on the worker thread, since pyttsx3 engines must stay on the thread that uses them. """
+    def __init__(self, engine_factory):
+        self._engine_factory = engine_factory; self.engine = None
+        self._queue = queue.PriorityQueue(); self._seq = itertools.count(); self._lock = threading.Lock()
+        self._current = None; self._interrupt = threading.Event(); self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="shiva-tts", daemon=True); self._thread.start()
+
+    def submit(self, text, priority=PRIORITY_NORMAL):
+        """ Queues text and returns its Utterance; utterance.future is a concurrent.futures.Future[bool]. """
+        utt = Utterance(text, priority, next(self._seq))
+        if not utt.segments: utt._resolve(True); return utt
+        with self._lock:
+            self._queue.put(utt)
+            if self._current and priority < self._current.priority: self._interrupt.set() # Preempt lower-priority speech
+        return utt
+    def cancel(self, utt):
+        """ Drops a queued utterance or cuts it off mid-sentence. """
+        with self._lock:
+            utt.cancelled = True; utt._resolve(False)
+            if self._current is utt: self._interrupt.set()
+    def barge_in(self, keep_priority=PRIORITY_URGENT):
+        """ Cancels everything queued or playing that is less urgent than keep_priority (e.g. when a new command arrives). """
+        with self._lock: pending = list(self._queue.queue) + ([self._current] if self._current else [])
+        for utt in pending:
+            if utt is not None and utt.priority > keep_priority: self.cancel(utt)
+    def is_speaking(self): return self._current is not None
+    def shutdown(self, timeout=2.0):
+        """ Cancels pending speech and stops the worker thread. """
+        self.barge_in(keep_priority=-1); self._queue.put(_SpeechShutdown()); self._thread.join(timeout)
+
+    def _on_word(self, *args, **kwargs):
+        if self._interrupt.is_set():
+            try: self.engine.stop()
+            except Exception as e: print(f"TTS stop error: {e}")
+    def _run(self):
+        try:
+            self.engine = self._engine_factory()
+            try: self.engine.connect('started-word', self._on_word) # Lets an interrupt stop a sentence mid-way
+            except Exception: pass
+        except Exception as e: print(f"Speech engine init error: {e}")
+        finally: self._ready.set()
+        while True:
+            utt = self._queue.get()
+            if isinstance(utt, _SpeechShutdown): break
+            if utt.cancelled: continue
+            with self._lock: self._current = utt; self._interrupt.clear()
+            while utt.segments and not utt.cancelled:
+                with self._lock: # A more urgent utterance arrived between sentences
+                    if self._queue.queue and self._queue.queue[0].priority < utt.priority: self._interrupt.set()
+                if self._interrupt.is_set(): break
+                try: self.engine.say(utt.segments[0]); self.engine.runAndWait()
+                except Exception as e: print(f"Speech synthesis error: {e}"); utt.segments = []; break
+                if self._interrupt.is_set(): break # Cut off mid-sentence: keep the segment to resume it
+                utt.segments.pop(0)
+            with self._lock:
+                self._current = None
+                if utt.cancelled: utt._resolve(False); METRICS.inc("tts_utterances_total", outcome="cancelled")
+                elif utt.segments: self._queue.put(utt); METRICS.inc("tts_preemptions_total") # Preempted: resume once the urgent speech is done
+                else: utt._resolve(True); METRICS.inc("tts_utterances_total", outcome="spoken"); METRICS.observe("stage_seconds", time.perf_counter() - utt.submitted, stage="tts")
+
+class _SpeechShutdown:
+    """ Queue sentinel that sorts ahead of every utterance. """
+    priority = -1; seq = -1
+    def __lt__(self, other): return True
+
+# =====================================
+# Response Cache: TTL + LRU in front of AI and Wikipedia lookups
+# =====================================
+class SQLiteCacheStore:
+    """ Persists ResponseCache entries to a SQLite file so they survive restarts. Any object with the same
+        load()/save()/delete() methods can be plugged into ResponseCache instead. """
+    def __init__(self, path):
+        self.path = path; self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS response_cache (source TEXT, key TEXT, value TEXT, expires_at REAL, latency REAL, PRIMARY KEY (source, key))")
+        self._db.commit()
+    def load(self, now):
+        """ Yields unexpired (source, key, value, expires_at, latency) rows, oldest expiry first, and prunes the rest. """
+        with self._lock:
+            self._db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,)); self._db.commit()
+            return self._db.execute("SELECT source, key, value, expires_at, latency FROM response_cache ORDER BY expires_at").fetchall()
+    def save(self, source, key, value, expires_at, latency):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?)", (source, key, value, expires_at, latency)); self._db.commit()
+    def delete(self, source, key):
+        with self._lock: self._db.execute("DELETE FROM response_cache WHERE source = ? AND key = ?", (source, key)); self._db.commit()
+    def close(self):
+        with self._lock: self._db.close()
+
+class ResponseCache:
+    """ Caches answers keyed on (source, normalized query) with a per-source TTL and an LRU bound on entry count.
+        Counts hits/misses and the fetch latency each hit avoided. max_entries=0 disables caching. """
+    _PUNCT_RE = re.compile(r"[^\w\s]")
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttls=None, store=None, default_ttl=3600, clock=time.time):
+        self.max_entries = max_entries; self.ttls = dict(RESPONSE_CACHE_TTLS if ttls is None else ttls); self.default_ttl = default_ttl
+        self.store = store; self.clock = clock; self._entries = OrderedDict(); self._lock = threading.Lock()
+        self.hits = 0; self.misses = 0; self.latency_saved = 0.0
+        if store and max_entries > 0:
+            try:
+                for source, key, value, expires_at, latency in store.load(clock()): self._insert((source, key), (value, expires_at, latency or 0.0), persist=False)
+                print(f"Response cache: {len(self._entries)} entries restored.")
+            except Exception as e: print(f"Response cache load error: {e}")
+    @classmethod
+    def normalize(cls, query): return _WHITESPACE_RE.sub(' ', cls._PUNCT_RE.sub(' ', str(query).lower())).strip()
+
+    def get(self, source, query):
+        """ Returns the cached value or None. Expired entries count as misses; they stay in memory (LRU-bounded)
+            for get_stale() until replaced, but are dropped from the persistent store. """
+        if self.max_entries <= 0: return None
+        key = (source, self.normalize(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > self.clock():
+                self._entries.move_to_end(key); self.hits += 1; self.latency_saved += entry[2]; METRICS.inc("cache_requests_total", source=source, result="hit")
+                return entry[0]
+            self.misses += 1; METRICS.inc("cache_requests_total", source=source, result="miss")
+        if entry and self.store: self._store_call("delete", *key)
+        return None
+    def has(self, source, query):
+        """ True if a fresh entry exists (not counted as a hit or miss). """
+        if self.max_entries <= 0: return False
+        with self._lock: entry = self._entries.get((source, self.normalize(query)))
+        return bool(entry) and entry[1] > self.clock()
+    def get_stale(self, source, query):
+        """ The last cached value even if expired (a fallback when a fresh answer cannot be had in time), or None. """
+        if self.max_entries <= 0: return None
+        with self._lock: entry = self._entries.get((source, self.normalize(query)))
+        return entry[0] if entry else None
+    def put(self, source, query, value, latency=0.0):
+        """ Caches value for the source's TTL; latency is the fetch time a later hit will save. """
+        if self.max_entries <= 0 or not value: return
+        expires_at = self.clock() + self.ttls.get(source, self.default_ttl)
+        with self._lock: self._insert((source, self.normalize(query)), (value, expires_at, latency))
+    def _insert(self, key, entry, persist=True):
+        self._entries[key] = entry; self._entries.move_to_end(key); evicted = []
+        while len(self._entries) > self.max_entries: evicted.append(self._entries.popitem(last=False)[0])
+        if self.store:
+            if persist: self._store_call("save", key[0], key[1], *entry)
+            for old in evicted: self._store_call("delete", *old)
+    def _store_call(self, method, *args):
+        try: getattr(self.store, method)(*args)
+        except Exception as e: print(f"Response cache {method} error: {e}")
+    def stats(self):
+        total = self.hits + self.misses
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0, "latency_saved_s": round(self.latency_saved, 3)}
+
+def make_default_cache():
+    """ The cache Shiva uses unless one is injected, following the RESPONSE_CACHE_* settings. """
+    if not ENABLE_RESPONSE_CACHE: return ResponseCache(max_entries=0)
+    store = None
+    if RESPONSE_CACHE_DB:
+        try: store = SQLiteCacheStore(RESPONSE_CACHE_DB)
+        except Exception as e: print(f"Response cache DB unavailable ({e}); using memory only.")
+    return ResponseCache(store=store)
+
+# =====================================
+# AI Request Manager: coalescing, concurrency cap, RPM/TPM token buckets, retries with backoff, deadlines
+# =====================================
+def estimate_tokens(text):
+    """ Rough token count (about 4 characters per token) without a tokenizer round-trip. """
+    return len(text) // 4 + 1
+
+class TokenBucket:
+    """ Refills at rate units/second up to capacity; acquire(n) waits until n units are available. Debt is allowed
+        (adjust() with actual usage may push the level negative), which simply delays later acquisitions. The level is
+        shared by every event loop that uses the bucket; the FIFO lock is per loop (asyncio locks are bound to one). """
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=asyncio.sleep):
+        self.rate = rate; self.capacity = capacity; self.level = capacity; self.clock = clock; self.sleep = sleep; self._t = clock(); self._locks = weakref.WeakKeyDictionary()
+    def _refill(self):
+        now = self.clock(); self.level = min(self.capacity, self.level + (now - self._t) * self.rate); self._t = now
+    async def acquire(self, n=1):
+        """ Waits for n units (n is capped at capacity so oversized requests still go through); returns seconds waited. """
+        loop = asyncio.get_running_loop(); lock = self._locks.get(loop)
+        if lock is None: lock = self._locks[loop] = asyncio.Lock()
+        n = min(n, self.capacity); waited = 0.0
+        async with lock: # FIFO: one waiter at a time
+            while True:
+                self._refill()
+                if self.level >= n: self.level -= n; return waited
+                delay = (n - self.level) / self.rate; waited += delay; await self.sleep(delay)
+    def adjust(self, delta): self._refill(); self.level = min(self.capacity, self.level - delta)
+
+class AIDeadlineExceeded(Exception):
+    """ Raised when an answer is not ready by the request deadline; .pending is the still-running call's future. """
+    def __init__(self, pending): super().__init__("AI request deadline exceeded"); self.pending = pending
+
+class AIRequestManager:
+    """ Front door for every Gemini call, sharing one model client:
+          - identical in-flight questions (normalized) share one call and one future (coalescing);
+          - at most max_concurrency calls run at once;
+          - requests and estimated tokens are metered by RPM / TPM token buckets before each call;
+          - 429 / quota / transient network errors are retried with exponential backoff and full jitter;
+          - callers get AIDeadlineExceeded after deadline seconds (the call keeps running so a late answer can be cached).
+        model_getter returns the (lazily loaded) model; clock/sleep/rng are injectable; stats counts what happened.
+        Rate budgets are shared across event loops; the concurrency cap and coalescing are kept per loop, since asyncio
+        semaphores and futures belong to the loop that made them (the benches and the server each run their own). """
+    RETRYABLE = ("429", "quota", "resource exhausted", "rate limit", "503", "unavailable", "deadline exceeded", "timed out", "timeout", "connection", "network")
+    def __init__(self, model_getter, max_concurrency=AI_MAX_CONCURRENCY, rpm=AI_RPM_LIMIT, tpm=AI_TPM_LIMIT, max_retries=AI_MAX_RETRIES,
+                 base_delay=0.5, max_delay=8.0, deadline=AI_REQUEST_DEADLINE, expected_output_tokens=300, clock=time.monotonic, sleep=asyncio.sleep, rng=None):
+        self.model_getter = model_getter; self.max_concurrency = max_concurrency; self.max_retries = max_retries; self.base_delay = base_delay; self.max_delay = max_delay
+        self.deadline = deadline; self.expected_output_tokens = expected_output_tokens; self.sleep = sleep; self.rng = rng or random.Random()
+        self.requests = TokenBucket(rpm / 60.0, max(1, rpm), clock, sleep); self.tokens = TokenBucket(tpm / 60.0, tpm, clock, sleep)
+        self._loops = weakref.WeakKeyDictionary() # Event loop -> (concurrency semaphore, in-flight calls by normalized prompt)
+        self.stats = {"requests": 0, "coalesced": 0, "calls": 0, "retries": 0, "failures": 0, "deadline_fallbacks": 0, "throttled_s": 0.0}
+    def _loop_state(self):
+        loop = asyncio.get_running_loop(); state = self._loops.get(loop)
+        if state is None: state = self._loops[loop] = (asyncio.Semaphore(self.max_concurrency), {})
+        return state
+    def _sem(self): return self._loop_state()[0]
+    @staticmethod
+    def prompt_text(prompt):
+        """ Flattens a prompt (a string, or a list of {"role", "parts"} contents) to its text. """
+        if isinstance(prompt, str): return prompt
+        return "\n".join(str(part) for c in prompt for part in (c.get("parts", ()) if isinstance(c, dict) else (c,)))
+    def estimate_tokens(self, prompt): return estimate_tokens(self.prompt_text(prompt)) + self.expected_output_tokens
+    @classmethod
+    def is_retryable(cls, e):
+        text = f"{type(e).__name__} {e}".lower(); return any(marker in text for marker in cls.RETRYABLE)
+    def backoff(self, attempt):
+        """ Full jitter: uniform in [0, min(max_delay, base_delay * 2**attempt)]. """
+        return self.rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _admit(self, prompt):
+        estimate = self.estimate_tokens(prompt)
+        waited = await self.requests.acquire(1) + await self.tokens.acquire(estimate); self.stats["throttled_s"] += waited
+        if waited: METRICS.observe("ai_throttle_seconds", waited)
+        return estimate
+    def _settle_tokens(self, response, estimate):
+        usage = getattr(response, "usage_metadata", None); total = getattr(usage, "total_token_count", None) if usage is not None else None
+        if isinstance(total, int): self.tokens.adjust(total - estimate)
+    async def _with_retries(self, attempt_call):
+        for attempt in range(self.max_retries + 1):
+            try: return await attempt_call()
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                if attempt >= self.max_retries or not self.is_retryable(e): self.stats["failures"] += 1; raise
+                delay = self.backoff(attempt); self.stats["retries"] += 1; METRICS.inc("ai_retries_total", category=Shiva._ai_error_category(e))
+                log.debug("AI call failed (%s); retry %d in %.2fs", e, attempt + 1, delay); await self.sleep(delay)
+    async def _call(self, prompt):
+        async def attempt():
+            estimate = await self._admit(prompt)
+            async with self._sem():
+                self.stats["calls"] += 1; response = await self.model_getter().generate_content_async(prompt)
+            self._settle_tokens(response, estimate); return response
+        return await self._with_retries(attempt)
+
+    async def generate(self, prompt, deadline=None):
+        """ Returns the model's response for prompt, sharing an identical in-flight call when there is one. """
+        inflight = self._loop_state()[1]; self.stats["requests"] += 1; key = ResponseCache.normalize(self.prompt_text(prompt)); future = inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._call(prompt)); inflight[key] = future
+            future.add_done_callback(lambda f, k=key: inflight.pop(k, None) if inflight.get(k) is f else None)
+            future.add_done_callback(lambda f: f.cancelled() or f.exception()) # Mark retrieved: deadline-abandoned failures are not "never retrieved"
+        else: self.stats["coalesced"] += 1; METRICS.inc("ai_coalesced_total")
+        deadline = self.deadline if deadline is None else deadline
+        try: return await asyncio.wait_for(asyncio.shield(future), deadline)
+        except asyncio.TimeoutError: self.stats["deadline_fallbacks"] += 1; raise AIDeadlineExceeded(future) from None
+
+    @contextlib.asynccontextmanager
+    async def stream(self, prompt, deadline=None):
+        """ async with manager.stream(prompt) as response: ...  Rate-limited, retried until the stream opens (by the
+            deadline, else AIDeadlineExceeded), and it holds a concurrency slot while the caller consumes it. """
+        self.stats["requests"] += 1; estimate = None; sem = self._sem()
+        async def open_stream():
+            nonlocal estimate
+            estimate = await self._admit(prompt); await sem.acquire()
+            try: self.stats["calls"] += 1; return await self.model_getter().generate_content_async(prompt, stream=True)
+            except BaseException: sem.release(); raise
+        opening = asyncio.ensure_future(self._with_retries(open_stream))
+        try: response = await asyncio.wait_for(asyncio.shield(opening), self.deadline if deadline is None else deadline)
+        except asyncio.TimeoutError:
+            self.stats["deadline_fallbacks"] += 1; opening.cancel()
+            opening.add_done_callback(lambda f: f.cancelled() or f.exception() or sem.release()) # Opened after all: free its slot
+            raise AIDeadlineExceeded(opening) from None
+        try: yield response
+        finally: sem.release(); self._settle_tokens(response, estimate)
+
+class SpeculativeAnswer:
+    """ An AI fallback answer started before the final transcript is known (see Shiva._speculate). The stream is
+        opened through the AIRequestManager and read into a buffer in the background; adopt() stands in for
+        ai.stream(prompt), replaying what has already arrived and continuing live. discard() cancels it and returns
+        the tokens it cost: an upper bound, the whole prompt plus the text received so far. """
+    def __init__(self, ai, question, prompt):
+        self.question = question; self.prompt = AIRequestManager.prompt_text(prompt); self.started = time.perf_counter(); self.outcome = None
+        self.first_chunk_at = None; self.adopted_at = None; self.response = None; self.error = None; self.text = []
+        self._chunks = asyncio.Queue(); self.task = asyncio.ensure_future(self._run(ai, prompt))
+    async def _run(self, ai, prompt):
+        try:
+            async with ai.stream(prompt) as response:
+                self.response = response
+                async for chunk in response:
+                    if self.first_chunk_at is None: self.first_chunk_at = time.perf_counter()
+                    try: self.text.append("".join(part.text for part in chunk.parts))
+                    except Exception: pass
+                    self._chunks.put_nowait(chunk)
+        except Exception as e: self.error = e # Re-raised to whoever adopts it
+        finally: self._chunks.put_nowait(None)
+    def matches(self, question, prompt):
+        return ResponseCache.normalize(question) == ResponseCache.normalize(self.question) and AIRequestManager.prompt_text(prompt) == self.prompt
+    @property
+    def usage_metadata(self): return getattr(self.response, "usage_metadata", None)
+    async def __aiter__(self):
+        while True:
+            chunk = await self._chunks.get()
+            if chunk is None:
+                if self.error is not None: raise self.error
+                return
+            yield chunk
+    @contextlib.asynccontextmanager
+    async def adopt(self):
+        self.adopted_at = time.perf_counter(); self.outcome = "adopted"
+        try: yield self
+        finally:
+            if not self.task.done(): self.task.cancel() # Barged in: stop generating
+    def latency_saved(self):
+        """ How much sooner the first chunk was available than with a request started at adoption (None before it arrives). """
+        if self.adopted_at is None or self.first_chunk_at is None: return None
+        return min(self.adopted_at, self.first_chunk_at) - self.started
+    def discard(self):
+        self.outcome = "discarded"
+        if not self.task.done(): self.task.cancel()
+        return estimate_tokens(self.prompt) + (estimate_tokens("".join(self.text)) if self.text else 0)
+
+# =====================================
+# Wikipedia: asyncio HTTP client with pooled keep-alive connections, one-round-trip summaries
+# =====================================
+class AsyncHTTPPool:
+    """ Minimal HTTP/1.1 GET client on asyncio streams. Keep-alive connections are pooled per (scheme, host, port)
+        (up to max_idle_per_host), so repeated lookups skip TCP and TLS setup. Bodies may be Content-Length, chunked or
+        gzip. A request that times out, fails or is cancelled mid-exchange closes its connection rather than pooling it;
+        a pooled connection the server has since closed is retried once on a fresh one. """
+    def __init__(self, max_idle_per_host=4, timeout=WIKIPEDIA_TIMEOUT, user_agent="Shiva-Voice-Assistant/1.0 (desktop voice assistant)"):
+        self.max_idle_per_host = max_idle_per_host; self.timeout = timeout; self.user_agent = user_agent
+        self._idle = {}; self._loop = None; self._ssl = None; self.stats = {"requests": 0, "connections": 0, "reused": 0}
+    async def _open(self, scheme, host, port):
+        if scheme == "https" and self._ssl is None: self._ssl = ssl.create_default_context()
+        conn = await asyncio.open_connection(host, port, ssl=self._ssl if scheme == "https" else None); self.stats["connections"] += 1; return conn
+    @staticmethod
+    def _close(conn):
+        try: conn[1].close()
+        except Exception: pass
+    def _release(self, key, conn):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.max_idle_per_host: idle.append(conn)
+        else: self._close(conn)
+    def _acquire(self, key):
+        idle = self._idle.get(key) or []
+        while idle:
+            conn = idle.pop()
+            if not conn[1].is_closing() and not conn[0].at_eof(): return conn
+            self._close(conn)
+        return None
+    async def get(self, url, headers=None):
+        """ Returns (status, headers with lower-case names, body bytes); raises OSError / asyncio.TimeoutError on network trouble. """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop: self.close_idle(); self._loop = loop # Streams belong to the loop that opened them
+        u = urllib.parse.urlsplit(url); scheme = u.scheme or "http"; port = u.port or (443 if scheme == "https" else 80); key = (scheme, u.hostname, port)
+        head = {"Host": u.netloc, "User-Agent": self.user_agent, "Accept-Encoding": "gzip", "Connection": "keep-alive", **(headers or {})}
+        request = (f"GET {u.path or '/'}{'?' + u.query if u.query else ''} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in head.items()) + "\r\n").encode("latin-1")
+        self.stats["requests"] += 1
+        for attempt in range(2):
+            conn = self._acquire(key); reused = conn is not None
+            if reused: self.stats["reused"] += 1
+            else: conn = await asyncio.wait_for(self._open(scheme, u.hostname, port), self.timeout)
+            try: status, resp_headers, body, keep_alive = await asyncio.wait_for(self._exchange(conn, request), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self._close(conn)
+                if reused and attempt == 0: continue
+                raise
+            except BaseException: self._close(conn); raise # Timeout or cancellation mid-response: connection state unknown
+            if keep_alive: self._release(key, conn)
+            else: self._close(conn)
+            return status, resp_headers, body
+    async def _exchange(self, conn, request):
+        reader, writer = conn; writer.write(request); await writer.drain()
+        status_line = await reader.readline()
+        if not status_line: raise ConnectionResetError("connection closed by server")
+        version, status = status_line.split()[:2]; headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""): break
+            name, _, value = line.decode("latin-1").partition(":"); headers[name.strip().lower()] = value.strip()
+        keep_alive = version == b"HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                if not size: break
+                parts.append(await reader.readexactly(size)); await reader.readexactly(2)
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass # Trailers
+            body = b"".join(parts)
+        elif "content-length" in headers: body = await reader.readexactly(int(headers["content-length"]))
+        else: body = await reader.read(); keep_alive = False
+        if headers.get("content-encoding") == "gzip": body = gzip.decompress(body)
+        return int(status), headers, body, keep_alive
+    def close_idle(self):
+        for idle in self._idle.values():
+            for conn in idle: self._close(conn)
+        self._idle.clear()
+
+class WikipediaError(Exception): pass
+class WikipediaPageError(WikipediaError): pass
+class WikipediaDisambiguation(WikipediaError):
+    def __init__(self, title, options): super().__init__(title); self.title = title; self.options = options
+
+class WikipediaClient:
+    """ Plain-text article intros from the MediaWiki API in one round trip: the search generator (auto-suggest),
+        redirects, the disambiguation page prop and the extract are all requested in a single query. The wikipedia
+        package took three to four blocking requests, each on a new connection. The language is part of api_url
+        and is fixed per client. summary() raises WikipediaPageError, WikipediaDisambiguation (options = the
+        next best results) or WikipediaError. """
+    def __init__(self, api_url=WIKIPEDIA_API_URL, pool=None, sentences=WIKIPEDIA_SENTENCES):
+        self.api_url = api_url; self.pool = pool or AsyncHTTPPool(); self.sentences = sentences
+    async def summary(self, term, sentences=None):
+        """ (title, extract) of the best match for term. """
+        params = {"action": "query", "format": "json", "formatversion": "2", "redirects": "1", "generator": "search", "gsrsearch": term, "gsrlimit": "4",
+                  "prop": "extracts|pageprops", "ppprop": "disambiguation", "exintro": "1", "explaintext": "1", "exsentences": str(sentences or self.sentences), "exlimit": "4"}
+        with METRICS.span("wiki_request_seconds"): status, _, body = await self.pool.get(f"{self.api_url}?{urllib.parse.urlencode(params)}")
+        if status != 200: raise WikipediaError(f"HTTP {status} from Wikipedia")
+        data = json.loads(body)
+        if "error" in data: raise WikipediaError(data["error"].get("info", "API error"))
+        pages = sorted(data.get("query", {}).get("pages", []), key=lambda p: p.get("index", 0))
+        if not pages: raise WikipediaPageError(term)
+        top = pages[0]
+        if "disambiguation" in top.get("pageprops", {}): raise WikipediaDisambiguation(top["title"], [p["title"] for p in pages[1:]])
+        extract = (top.get("extract") or "").strip()
+        if not extract: raise WikipediaPageError(term)
+        return top["title"], extract
+
+# =====================================
+# Conversation Memory: rolling, token-budgeted context for follow-up questions
+# =====================================
+class ConversationMemory:
+    """ Multi-turn context for the AI fallback (the equivalent of a start_chat session, with bounded history).
+        prompt() returns Gemini "contents": a running summary of older turns, then recent (question, answer)
+        turns, then the new question, trimmed so the estimated tokens stay within token_budget. Turns pushed out of
+        the window are folded into the summary in the background by summarizer (async text -> text; extractive
+        compaction when there is none or it fails). After idle_timeout seconds without a turn, memory resets.
+        turn_stats records estimated (and, when the response reports it, actual) prompt tokens per turn. """
+    SUMMARY_PROMPT = ("Summarize this conversation between a user and the voice assistant Shiva in under {words} words. "
+                      "Keep names, places, dates, numbers and open questions.\n\n{text}")
+    def __init__(self, token_budget=CONVERSATION_TOKEN_BUDGET, idle_timeout=CONVERSATION_IDLE_SECONDS, summary_tokens=200, summarizer=None, clock=time.monotonic, low_water=0.7):
+        self.token_budget = token_budget; self.low_water = low_water; self.idle_timeout = idle_timeout; self.summary_tokens = summary_tokens; self.summarizer = summarizer; self.clock = clock
+        self.turns = deque(); self.summary = ""; self.turn_stats = []; self._pending = []; self._compaction = None; self._generation = 0
+        self._last_activity = clock(); self._last_prompt_tokens = 0; self.resets = 0; self.compactions = 0
+    def _turn_tokens(self, turn): return estimate_tokens(turn[0]) + estimate_tokens(turn[1])
+    def _context_tokens(self): return (estimate_tokens(self.summary) if self.summary else 0) + sum(self._turn_tokens(t) for t in self.turns)
+    def _expire_if_idle(self):
+        if (self.turns or self.summary) and self.clock() - self._last_activity > self.idle_timeout: print("Conversation idle; starting fresh."); self.reset()
+    def reset(self):
+        """ Forgets everything (a pending background summary is discarded when it lands). """
+        self.turns.clear(); self.summary = ""; self._pending = []; self._generation += 1; self.resets += 1
+    def has_context(self): self._expire_if_idle(); return bool(self.turns or self.summary)
+
+    def prompt(self, question):
+        """ The contents to send for question: the bare string when there is no context yet. """
+        self._expire_if_idle(); self._trim(reserve=estimate_tokens(question))
+        contents = []
+        if self.summary: contents += [{"role": "user", "parts": [f"Summary of our conversation so far: {self.summary}"]}, {"role": "model", "parts": ["Got it."]}]
+        for q, a in self.turns: contents += [{"role": "user", "parts": [q]}, {"role": "model", "parts": [a]}]
+        self._last_prompt_tokens = estimate_tokens(question) + self._context_tokens()
+        return question if not contents else contents + [{"role": "user", "parts": [question]}]
+    def add_turn(self, question, answer, response=None):
+        """ Records a completed exchange; response.usage_metadata (if any) supplies the actual prompt token count. """
+        usage = getattr(response, "usage_metadata", None); actual = getattr(usage, "prompt_token_count", None) if usage is not None else None
+        self.turns.append((question, answer)); self._last_activity = self.clock()
+        self.turn_stats.append({"turn": len(self.turn_stats) + 1, "prompt_tokens_est": self._last_prompt_tokens, "prompt_tokens": actual if isinstance(actual, int) else None,
+                                "window_turns": len(self.turns) - 1, "summary_tokens": estimate_tokens(self.summary) if self.summary else 0})
+        log.debug("Conversation: turn %d, prompt ~%d tokens%s, %d earlier turn(s) in window%s", len(self.turn_stats), self._last_prompt_tokens,
+                  f" (reported {actual})" if isinstance(actual, int) else "", len(self.turns) - 1, ", plus summary" if self.summary else "")
+        self._trim(reserve=0)
+
+    def _trim(self, reserve):
+        """ Once context + reserve exceeds the budget, moves the oldest turns out of the window down to low_water of it
+            (so a summary is made every few turns rather than every turn); the newest turn always stays. """
+        if self._context_tokens() + reserve <= self.token_budget: return
+        moved = False
+        while len(self.turns) > 1 and self._context_tokens() + reserve > self.token_budget * self.low_water: self._pending.append(self.turns.popleft()); moved = True
+        if moved: self._schedule_compaction()
+    def _schedule_compaction(self):
+        if self._compaction is not None and not self._compaction.done(): return # The running one picks up new turns when it finishes
+        try: self._compaction = asyncio.ensure_future(self._compact())
+        except RuntimeError: self._compact_extractive(self._pending); self._pending = [] # No event loop: compact inline
+    async def _compact(self):
+        while self._pending:
+            batch, self._pending = self._pending, []; generation = self._generation
+            text = (f"Earlier summary: {self.summary}\n" if self.summary else "") + "\n".join(f"User: {q}\nShiva: {a}" for q, a in batch)
+            summary = None
+            if self.summarizer:
+                try: summary = await self.summarizer(self.SUMMARY_PROMPT.format(words=int(self.summary_tokens * 0.6), text=text))
+                except Exception as e: log.debug("Conversation summary failed (%s); compacting extractively.", e)
+            if generation != self._generation: return # Reset while summarizing
+            if summary: self.summary = self._cap(summary.strip()); self.compactions += 1
+            else: self._compact_extractive(batch)
+    def _compact_extractive(self, batch):
+        self.summary = self._cap(" ".join(filter(None, [self.summary] + [f"The user asked: {q}." for q, _ in batch])))
+    def _cap(self, text):
+        limit = self.summary_tokens * 4
+        return text if len(text) <= limit else "..." + text[-limit:] # Keep the most recent part
+
+# =====================================
+# Media Library: SQLite index of music / video / PDF / Word files with fuzzy title lookup
+# =====================================
+def speakable_title(filename):
+    """ "02_Believer (Official) [HD].mp3" -> "Believer" (capped for speech). """
+    name = re.sub(r'[_\-.]', ' ', os.path.splitext(os.path.basename(filename))[0]).strip()
+    name = re.sub(r'\[.*?\]|\(.*?\)|[\d\W]+$|^\d{1,3}\s+', '', name).strip(); name = re.sub(r'\s+', ' ', name).strip() # Also drops track numbers
+    return name[:50] + "..." if len(name) > 50 else name
+
+class MediaIndex:
+    """ Persistent index of media files under a set of roots. scan() is incremental (only files whose mtime/size changed
+        are re-indexed; vanished files are dropped); search() is a fuzzy title lookup: misheard words are corrected
+        against the indexed vocabulary, an FTS5 trigram query narrows candidates (substring match, then any-trigram
+        match), and those are re-ranked by similarity to the title. Falls back to LIKE matching when SQLite lacks the trigram tokenizer. """
+    _BATCH = 1000
+    def __init__(self, path=":memory:", kinds=None):
+        self.path = path; self.kinds = dict(MEDIA_KINDS if kinds is None else kinds); self._lock = threading.Lock()
+        self._ext_kind = {"." + ext: kind for kind, exts in self.kinds.items() for ext in exts}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS media (id INTEGER PRIMARY KEY, path TEXT UNIQUE, kind TEXT, title TEXT, terms TEXT, mtime REAL, size INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS media_kind ON media (kind)")
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(terms, content='media', content_rowid='id', tokenize='trigram')")
+            self._db.executescript("""
+                CREATE TRIGGER IF NOT EXISTS media_ai AFTER INSERT ON media BEGIN INSERT INTO media_fts (rowid, terms) VALUES (new.id, new.terms); END;
+                CREATE TRIGGER IF NOT EXISTS media_ad AFTER DELETE ON media BEGIN INSERT INTO media_fts (media_fts, rowid, terms) VALUES ('delete', old.id, old.terms); END;
+                CREATE TRIGGER IF NOT EXISTS media_au AFTER UPDATE ON media BEGIN
+                    INSERT INTO media_fts (media_fts, rowid, terms) VALUES ('delete', old.id, old.terms); INSERT INTO media_fts (rowid, terms) VALUES (new.id, new.terms); END;""")
+            self.fts = True
+        except sqlite3.OperationalError as e: print(f"Media index: no FTS5 trigram support ({e}); using LIKE lookups."); self.fts = False
+        self._db.commit(); self._scanner = None; self._stop = threading.Event(); self.last_scan = None; self._vocab = None; self._first_build = False
+
+    @staticmethod
+    def _terms(path):
+        """ Searchable text: the file's title plus its two parent folder names (artist / album, course / subject...). """
+        parent = os.path.dirname(path); names = [speakable_title(path), os.path.basename(parent), os.path.basename(os.path.dirname(parent))]
+        return " ".join(re.sub(r'[_\-.]', ' ', n) for n in names if n).lower()
+    def _walk(self, root):
+        stack = [root]
+        while stack:
+            try: entries = list(os.scandir(stack.pop()))
+            except OSError: continue
+            for entry in entries:
+                if entry.name.startswith(('.', '$')): continue
+                try:
+                    if entry.is_dir(follow_symlinks=False): stack.append(entry.path); continue
+                    kind = self._ext_kind.get(os.path.splitext(entry.name)[1].lower())
+                    if kind: st = entry.stat(); yield entry.path, kind, st.st_mtime, st.st_size
+                except OSError: continue
+    def scan(self, roots):
+        """ Incrementally syncs the index with the files under roots; returns counts and elapsed seconds. """
+        t0 = time.perf_counter(); roots = [os.path.abspath(r) for r in roots if r and os.path.isdir(r)]
+        roots = [r for r in roots if not any(r != o and r.startswith(os.path.join(o, "")) for o in roots)] # Drop nested roots
+        with self._lock: known = {p: (m, z) for p, m, z in self._db.execute("SELECT path, mtime, size FROM media")}
+        seen = set(); batch = []; counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        for root in dict.fromkeys(roots):
+            for path, kind, mtime, size in self._walk(root):
+                if path in seen: continue
+                seen.add(path); old = known.get(path)
+                if old == (mtime, size): counts["unchanged"] += 1; continue
+                counts["updated" if old else "added"] += 1; batch.append((path, kind, speakable_title(path), self._terms(path), mtime, size))
+                if len(batch) >= self._BATCH: self._write(batch); batch = []
+        if batch: self._write(batch)
+        gone = [(p,) for p in known if p not in seen and any(p.startswith(os.path.join(r, "")) for r in roots)]
+        if gone:
+            with self._lock: self._db.executemany("DELETE FROM media WHERE path = ?", gone); self._db.commit()
+            counts["removed"] = len(gone)
+        counts["seconds"] = round(time.perf_counter() - t0, 3); self.last_scan = counts
+        return counts
+    def _write(self, rows):
+        with self._lock:
+            self._db.executemany("""INSERT INTO media (path, kind, title, terms, mtime, size) VALUES (?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT(path) DO UPDATE SET kind=excluded.kind, title=excluded.title, terms=excluded.terms, mtime=excluded.mtime, size=excluded.size""", rows)
+            self._db.commit()
+            if self._vocab is not None: self._add_vocab(row[3] for row in rows)
+    def _add_vocab(self, terms_iter):
+        for terms in terms_iter:
+            for w in terms.split():
+                if len(w) >= 3 and not w.isdigit(): self._vocab.setdefault(w[0], set()).add(w)
+    def _correct(self, word):
+        """ Maps a misrecognized word to the closest indexed word with the same first letter (vocabulary kept in memory). """
+        if self._vocab is None: self._vocab = {}; self._add_vocab(t for (t,) in self._db.execute("SELECT terms FROM media"))
+        bucket = self._vocab.get(word[0], ())
+        if len(word) < 3 or word.isdigit() or word in bucket: return word
+        close = difflib.get_close_matches(word, [w for w in bucket if abs(len(w) - len(word)) <= 2], n=1, cutoff=0.75)
+        return close[0] if close else word
+    def _candidates(self, words, kind, limit):
+        kind_sql = " AND m.kind = ?" if kind else ""; extra = (kind,) if kind else ()
+        if not self.fts:
+            where = " AND ".join("m.terms LIKE ?" for _ in words)
+            return self._db.execute(f"SELECT m.path, m.title, m.kind, m.terms FROM media m WHERE {where}{kind_sql} LIMIT ?", (*(f"%{w}%" for w in words), *extra, limit)).fetchall()
+        sql = f"SELECT m.path, m.title, m.kind, m.terms FROM media_fts JOIN media m ON m.id = media_fts.rowid WHERE media_fts MATCH ?{kind_sql} ORDER BY bm25(media_fts) LIMIT ?"
+        long_words = [w for w in words if len(w) >= 3]
+        rows = self._db.execute(sql, (" AND ".join(f'"{w}"' for w in long_words), *extra, limit)).fetchall() if long_words else []
+        if not rows: # Still nothing: any shared trigram, best-ranked first
+            grams = {w[i:i + 3] for w in long_words for i in range(len(w) - 2)}
+            if grams: rows = self._db.execute(sql, (" OR ".join(f'"{g}"' for g in grams), *extra, limit)).fetchall()
+        return rows
+    def search(self, query, kind=None, limit=5, min_score=0.45):
+        """ Fuzzy lookup: returns up to limit (score, path, title, kind) tuples, best first, with score in 0..1.
+            Unknown words are first corrected against the indexed vocabulary ("beleiver" -> "believer"). """
+        words = re.findall(r"[a-z0-9']+", str(query).lower())
+        if not words: return []
+        with self._lock: words = [self._correct(w) for w in words]; rows = self._candidates(words, kind, limit=50)
+        text = " ".join(words)
+        scored = []
+        for path, title, row_kind, terms in rows:
+            title_l = title.lower(); score = max(difflib.SequenceMatcher(None, text, title_l).ratio(), difflib.SequenceMatcher(None, text, terms).ratio() * 0.9)
+            hits = sum(1 for w in words if w in terms) / len(words); score = 0.6 * score + 0.4 * hits
+            if score >= min_score: scored.append((round(score, 3), path, title, row_kind))
+        scored.sort(key=lambda r: -r[0]); return scored[:limit]
+    def random(self, kind):
+        """ A random (path, title) of the given kind, or None when there is none. """
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM media WHERE kind = ?", (kind,)).fetchone()[0]
+            if not count: return None
+            return self._db.execute("SELECT path, title FROM media WHERE kind = ? LIMIT 1 OFFSET ?", (kind, random.randrange(count))).fetchone()
+    def count(self, kind=None):
+        with self._lock: return self._db.execute("SELECT COUNT(*) FROM media" + (" WHERE kind = ?" if kind else ""), (kind,) if kind else ()).fetchone()[0]
+
+    @property
+    def building(self):
+        """ True while the first scan of an empty index is still running (a search miss may just not be indexed yet). """
+        return self._first_build and self.last_scan is None
+    def start_scanner(self, roots, interval=MEDIA_RESCAN_SECONDS):
+        """ Scans now and then every interval seconds on a daemon thread. """
+        self._first_build = self.count() == 0
+        def run():
+            while not self._stop.is_set():
+                try: counts = self.scan(roots); print(f"Media index: {self.count()} files ({counts})")
+                except Exception as e: print(f"Media scan error: {e}")
+                self._stop.wait(interval)
+        self._scanner = threading.Thread(target=run, name="shiva-media-scan", daemon=True); self._scanner.start(); return self
+    def close(self):
+        self._stop.set()
+        if self._scanner: self._scanner.join(timeout=2.0)
+        with self._lock: self._db.close()
+
+def make_default_media_index():
+    """ The media index Shiva uses unless one is injected (None when ENABLE_MEDIA_INDEX is off). """
+    if not ENABLE_MEDIA_INDEX: return None
+    try: return MediaIndex(MEDIA_INDEX_DB or ":memory:").start_scanner(MEDIA_LIBRARY_ROOTS)
+    except Exception as e: print(f"Media index unavailable ({e}); using default paths."); return None
+
+# =====================================
+# Timers: one heap-based scheduler on the assistant's event loop (persisted)
+# =====================================
+class Timer:
+    """ A pending timer or reminder: fires at due (wall-clock seconds); label is the reminder text, if any. """
+    __slots__ = ("id", "due", "duration", "label", "created", "cancelled")
+    def __init__(self, id, due, duration, label="", created=None):
+        self.id = id; self.due = due; self.duration = duration; self.label = label or ""; self.created = created if created is not None else due - duration; self.cancelled = False
+    def describe(self):
+        """ "5 minute timer" / "reminder to call mom" (for speech). """
+        return f"reminder to {self.label}" if self.label else re.sub(r'(hour|minute|second)s\b', r'\1', speak_duration(self.duration)) + " timer"
+
+def speak_duration(seconds):
+    """ 90 -> "1 minute 30 seconds", 7200 -> "2 hours". """
+    seconds = int(round(seconds)); parts = []
+    for unit, size in (("hour", 3600), ("minute", 60), ("second", 1)):
+        n, seconds = divmod(seconds, size)
+        if n: parts.append(f"{n} {unit}{'s' if n != 1 else ''}")
+    return " ".join(parts) or "0 seconds"
+
+class SQLiteTimerStore:
+    """ Persists pending timers so they survive restarts; same load/save/delete shape as SQLiteCacheStore. """
+    def __init__(self, path):
+        self.path = path; self._lock = threading.Lock(); self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS timers (id INTEGER PRIMARY KEY, due REAL, duration REAL, label TEXT, created REAL)"); self._db.commit()
+    def load(self):
+        with self._lock: return self._db.execute("SELECT id, due, duration, label, created FROM timers ORDER BY due").fetchall()
+    def save(self, timer):
+        with self._lock: self._db.execute("INSERT OR REPLACE INTO timers VALUES (?, ?, ?, ?, ?)", (timer.id, timer.due, timer.duration, timer.label, timer.created)); self._db.commit()
+    def delete(self, timer_id):
+        with self._lock: self._db.execute("DELETE FROM timers WHERE id = ?", (timer_id,)); self._db.commit()
+    def close(self):
+        with self._lock: self._db.close()
+
+class TimerScheduler:
+    """ All timers live in one heap ordered by due time; a single asyncio task sleeps until the earliest one, so
+        thousands of pending timers cost one task and no threads. Cancelled timers are dropped lazily when they
+        reach the top of the heap. on_fire(timer, late_by) is called for each due timer; timers that came due while
+        the assistant was off fire at start-up with late_by > 0. clock is injectable (wall-clock seconds); fire_due()
+        can be driven directly with a fake clock, without an event loop. """
+    def __init__(self, on_fire=None, store=None, clock=time.time):
+        self.on_fire = on_fire; self.store = store; self.clock = clock; self._heap = []; self._timers = {}
+        self._wake = None; self._task = None; self.fired = 0
+        rows = []
+        if store:
+            try: rows = store.load()
+            except Exception as e: print(f"Timer store load error: {e}")
+        for id, due, duration, label, created in rows: self._push(Timer(id, due, duration, label, created))
+        self._ids = itertools.count(max(self._timers, default=0) + 1)
+        if rows: print(f"Timers: {len(rows)} pending timer(s) restored.")
+
+    def _push(self, timer): self._timers[timer.id] = timer; heapq.heappush(self._heap, (timer.due, timer.id, timer)) # Tuples compare in C
+    def _store_call(self, method, *args):
+        try: getattr(self.store, method)(*args)
+        except Exception as e: print(f"Timer store {method} error: {e}")
+    def _kick(self):
+        if self._wake is not None: self._wake.set()
+
+    def add(self, duration, label=""):
+        """ Schedules a timer duration seconds from now and returns it. Call from the event loop thread. """
+        now = self.clock(); timer = Timer(next(self._ids), now + duration, duration, label, now); self._push(timer)
+        if self.store: self._store_call("save", timer)
+        self._kick(); return timer
+    def cancel(self, timer_id):
+        """ Cancels a pending timer; returns it, or None if it is unknown or already fired. """
+        timer = self._timers.pop(timer_id, None)
+        if timer is None: return None
+        timer.cancelled = True
+        if self.store: self._store_call("delete", timer_id)
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._timers): # Mostly tombstones: rebuild
+            self._heap = [e for e in self._heap if not e[2].cancelled]; heapq.heapify(self._heap)
+        self._kick(); return timer
+    def pending(self):
+        """ Pending timers, soonest first. """
+        return sorted(self._timers.values(), key=lambda t: (t.due, t.id))
+    def remaining(self, timer): return max(0.0, timer.due - self.clock())
+    def next_due(self):
+        while self._heap and self._heap[0][2].cancelled: heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+    def fire_due(self, now=None):
+        """ Pops and fires every timer due at now (default: clock()); returns the fired timers. """
+        now = self.clock() if now is None else now; fired = []
+        while self._heap and (self._heap[0][2].cancelled or self._heap[0][0] <= now):
+            timer = heapq.heappop(self._heap)[2]
+            if timer.cancelled: continue
+            self._timers.pop(timer.id, None); fired.append(timer); self.fired += 1
+            if self.store: self._store_call("delete", timer.id)
+            if self.on_fire:
+                try: self.on_fire(timer, now - timer.due)
+                except Exception as e: print(f"Timer alert error: {e}")
+        return fired
+
+    def start(self):
+        """ Starts the scheduler task on the running event loop (idempotent). """
+        if self._task is None or self._task.done(): self._wake = asyncio.Event(); self._task = asyncio.ensure_future(self.run())
+        return self._task
+    async def run(self):
+        while True:
+            self.fire_due(); due = self.next_due(); self._wake.clear()
+            timeout = None if due is None else max(0.0, due - self.clock())
+            try: await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError: pass
+    def stop(self):
+        if self._task is not None: self._task.cancel(); self._task = None
+
+def make_default_timers(on_fire):
+    store = None
+    if TIMER_DB:
+        try: store = SQLiteTimerStore(TIMER_DB)
+        except Exception as e: print(f"Timer DB unavailable ({e}); timers will not survive restarts.")
+    return TimerScheduler(on_fire, store=store)
+
+# =====================================
+# Audio Front-end: persistent capture + streaming voice-activity detection
+# =====================================
+class MicrophoneSource:
+    """ Keeps a single sr.Microphone stream open and reads raw frames from it (no per-command device open/close). """
+    def __init__(self, device_index=None):
+        self.mic = sr.Microphone(device_index=device_index); self.sample_rate = self.mic.SAMPLE_RATE; self.sample_width = self.mic.SAMPLE_WIDTH
+    def open(self): self.mic.__enter__()
+    def read(self, n_samples): return self.mic.stream.read(n_samples)
+    def close(self):
+        try: self.mic.__exit__(None, None, None)
+        except Exception as e: print(f"Mic close error: {e}")
+
+def _wav_mono16(path):
+    """ (int16 mono samples, sample rate) of a WAV file (path or file object); 8/32-bit audio is converted, channels averaged. """
+    with wave.open(path, "rb") as wf: width, channels, rate, raw = wf.getsampwidth(), wf.getnchannels(), wf.getframerate(), wf.readframes(wf.getnframes())
+    if width == 1: samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.int16) - 128) << 8
+    elif width == 4: samples = (np.frombuffer(raw, dtype=np.int32) >> 16).astype(np.int16)
+    else: samples = np.frombuffer(raw, dtype=np.int16)
+    if channels > 1: samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return samples, rate
+
+def _read_wav_mono16(path, sample_rate):
+    """ int16 mono samples of a WAV file, linearly resampled to sample_rate. """
+    x, rate = _wav_mono16(path)
+    if rate != sample_rate: x = np.interp(np.arange(0, len(x), rate / sample_rate), np.arange(len(x)), x).astype(np.int16)
+    return x
+
+class WavFileSource:
+    """ Plays a WAV file into the front-end as if it were the microphone (for tests and benchmarks).
+        Audio is converted to mono 16-bit; tail_silence_ms of silence follows the file so a final utterance can end.
+        realtime=True paces reads at the audio rate. read() raises EOFError when the file is exhausted. """
+    sample_width = 2
+    def __init__(self, path, realtime=False, tail_silence_ms=1500):
+        self.path = path; self.realtime = realtime; self.tail_silence_ms = tail_silence_ms; self.sample_rate = None; self._samples = None; self._pos = 0
+    def open(self):
+        samples, self.sample_rate = _wav_mono16(self.path)
+        tail = np.zeros(int(self.sample_rate * self.tail_silence_ms / 1000), dtype=np.int16)
+        self._samples = np.concatenate([samples, tail]); self._pos = 0; self._t0 = time.perf_counter()
+    def read(self, n_samples):
+        if self._pos >= len(self._samples): raise EOFError(self.path)
+        chunk = self._samples[self._pos:self._pos + n_samples]; self._pos += n_samples
+        if len(chunk) < n_samples: chunk = np.pad(chunk, (0, n_samples - len(chunk)))
+        if self.realtime:
+            lag = self._t0 + self._pos / self.sample_rate - time.perf_counter()
+            if lag > 0: time.sleep(lag)
+        return chunk.tobytes()
+    def close(self): self._samples = None
+
+class EnergyVAD:
+    """ Frame-level voice-activity detector on RMS energy over an adaptive noise floor (learned from the first
+        warmup_frames, then tracked during silence). Any object with is_speech(samples) -> bool, where samples is
+        one frame as an int16 numpy array, can be plugged in instead (e.g. a webrtcvad wrapper). margin > 1 raises the
+        threshold and freezes the floor (set while Shiva speaks, so its echo is neither speech nor ambient noise). """
+    def __init__(self, ratio=3.0, min_rms=120.0, floor_alpha=0.05, warmup_frames=15):
+        self.ratio = ratio; self.min_rms = min_rms; self.floor_alpha = floor_alpha; self.warmup_frames = warmup_frames; self.floor = None; self._seen = 0; self.margin = 1.0
+    def is_speech(self, samples):
+        x = samples.astype(np.float32); rms = float(np.sqrt(np.dot(x, x) / max(1, len(x)))); self._seen += 1
+        if self._seen <= self.warmup_frames: # Calibrating: running mean of the ambient level
+            self.floor = rms if self.floor is None else self.floor + (rms - self.floor) / self._seen; return False
+        speech = rms > max(self.min_rms, self.floor * self.ratio) * self.margin
+        if not speech and self.margin == 1.0: self.floor += self.floor_alpha * (rms - self.floor)
+        return speech
+    @property
+    def calibrated(self): return self._seen >= self.warmup_frames
+
+class StreamingDenoiser:
+    """ Incremental spectral-gating noise reduction for 16-bit PCM, applied frame by frame as audio is captured.
+        STFT with sqrt-Hann windows at 50% overlap-add; a per-bin noise profile (mean/std of dB magnitude) is learned
+        from chunks passed with learn_noise=True (silence) and kept across utterances. Bins under
+        mean + n_std_thresh * std are attenuated by prop_decrease (0.85, as the old noisereduce call).
+        Working buffers are float32/float64 arrays allocated once; output lags input by latency_samples. """
+    def __init__(self, sample_rate, fft_ms=32, prop_decrease=0.85, n_std_thresh=1.5, noise_alpha=0.02, learn_frames=20, smooth_bins=3):
+        self.sample_rate = sample_rate; self.fft_size = 1 << max(6, int(round(np.log2(sample_rate * fft_ms / 1000)))); self.hop = self.fft_size // 2
+        self.latency_samples = self.fft_size; self.prop_decrease = prop_decrease; self.n_std_thresh = n_std_thresh
+        self.noise_alpha = noise_alpha; self.learn_frames = learn_frames; self.noise_frames = 0
+        N, bins = self.fft_size, self.fft_size // 2 + 1
+        self.window = np.sqrt(np.hanning(N + 1)[:N]).astype(np.float32) # Periodic sqrt-Hann: perfect reconstruction at 50% overlap
+        self._kernel = np.ones(smooth_bins) / smooth_bins
+        self._win = np.zeros(N, np.float32); self._frame = np.zeros(N, np.float32); self._ola = np.zeros(N, np.float64)
+        self._mag = np.zeros(bins, np.float64); self._db = np.zeros(bins, np.float64); self._gain = np.zeros(bins, np.float64); self._mask = np.zeros(bins, bool)
+        self._noise_mean = np.zeros(bins, np.float64); self._noise_m2 = np.zeros(bins, np.float64); self._thresh = np.zeros(bins, np.float64)
+        self._in = np.zeros(0, np.float32); self._in_fill = 0; self._out = np.zeros(0, np.float32); self._out_fill = 0; self._pcm = np.zeros(0, np.int16)
+        self._ensure_capacity(4 * N); self.reset()
+
+    def reset(self):
+        """ Drops buffered audio but keeps the learned noise profile (for resuming after frames were skipped). """
+        self._win[:] = 0.0; self._ola[:] = 0.0; self._in_fill = 0; self._out[:] = 0.0
+        self._out_fill = self.hop # One hop of leading silence so every call can return as many samples as it got
+
+    def _ensure_capacity(self, n):
+        need = n + 2 * self.fft_size
+        if len(self._in) >= need: return
+        self._in = np.concatenate([self._in, np.zeros(need - len(self._in), np.float32)])
+        self._out = np.concatenate([self._out, np.zeros(need - len(self._out), np.float32)]); self._pcm = np.zeros(need, np.int16)
+
+    def process(self, frame, learn_noise=False):
+        """ Denoises one chunk of 16-bit PCM bytes and returns the same number of samples (delayed by latency_samples). """
+        x = np.frombuffer(frame, dtype=np.int16); n = len(x); self._ensure_capacity(n)
+        np.multiply(x, 1.0 / 32768, out=self._in[self._in_fill:self._in_fill + n], casting="unsafe"); self._in_fill += n
+        while self._in_fill >= self.hop: self._process_hop(learn_noise)
+        out = self._pcm[:n]; np.clip(self._out[:n] * 32767.0, -32768, 32767, out=self._out[:n]); out[:] = self._out[:n]
+        self._out[:self._out_fill - n] = self._out[n:self._out_fill]; self._out_fill -= n
+        return out.tobytes()
+
+    def _process_hop(self, learn_noise):
+        N, H = self.fft_size, self.hop
+        self._win[:N - H] = self._win[H:]; self._win[N - H:] = self._in[:H] # Slide the analysis window by one hop
+        self._in[:self._in_fill - H] = self._in[H:self._in_fill]; self._in_fill -= H
+        np.multiply(self._win, self.window, out=self._frame)
+        spec = np.fft.rfft(self._frame)
+        np.abs(spec, out=self._mag); self._mag += 1e-10; np.log10(self._mag, out=self._db); self._db *= 20.0
+        if learn_noise: self._learn_noise()
+        if self.noise_frames:
+            np.greater(self._db, self._thresh, out=self._mask)
+            np.multiply(self._mask, self.prop_decrease, out=self._gain); self._gain += 1.0 - self.prop_decrease
+            spec *= np.convolve(self._gain, self._kernel, mode="same") # Smooth across frequency to limit musical noise
+        y = np.fft.irfft(spec, n=N); y *= self.window; self._ola += y
+        self._out[self._out_fill:self._out_fill + H] = self._ola[:H]; self._out_fill += H
+        self._ola[:N - H] = self._ola[H:]; self._ola[N - H:] = 0.0
+
+    def _learn_noise(self):
+        """ Running mean/variance of each bin's dB level: exact for the first learn_frames, then exponential. """
+        self.noise_frames += 1; alpha = 1.0 / self.noise_frames if self.noise_frames <= self.learn_frames else self.noise_alpha
+        delta = self._db - self._noise_mean; self._noise_mean += alpha * delta; self._noise_m2 += alpha * (delta * (self._db - self._noise_mean) - self._noise_m2)
+        np.sqrt(np.maximum(self._noise_m2, 0.0), out=self._thresh); self._thresh *= self.n_std_thresh; self._thresh += self._noise_mean
+
+class SpeechSegment:
+    """ One detected utterance: audio (sr.AudioData), stream-time bounds of the speech in seconds, the stream time at
+        which end-of-speech was declared (eos_s), and the perf_counter moment it happened (eos_at), from which
+        end-of-speech -> recognition latency is measured. """
+    def __init__(self, audio, start_s, end_s, eos_s, eos_at):
+        self.audio = audio; self.start_s = start_s; self.end_s = end_s; self.eos_s = eos_s; self.eos_at = eos_at; self.denoised = False; self.barge_in = False
+    def __repr__(self): return f"SpeechSegment({self.start_s:.2f}s-{self.end_s:.2f}s)"
+
+class VADSegmenter:
+    """ Turns a stream of fixed-size frames into SpeechSegments: speech starts after start_ms of voiced frames
+        (plus pre_roll_ms of ring-buffered audio before it) and ends after hangover_ms of silence or max_utterance_s. """
+    def __init__(self, sample_rate, sample_width=2, vad=None, frame_ms=30, pre_roll_ms=VAD_PRE_ROLL_MS, start_ms=90, hangover_ms=VAD_HANGOVER_MS, max_utterance_s=10.0, keep_tail_ms=150):
+        self.sample_rate = sample_rate; self.sample_width = sample_width; self.vad = vad or EnergyVAD(); self.frame_ms = frame_ms
+        self.frame_samples = int(sample_rate * frame_ms / 1000); self.frame_s = self.frame_samples / sample_rate
+        to_frames = lambda ms: max(1, int(round(ms / frame_ms)))
+        self.start_frames = to_frames(start_ms); self.hangover_frames = to_frames(hangover_ms); self.max_frames = to_frames(max_utterance_s * 1000); self.keep_tail_frames = to_frames(keep_tail_ms)
+        self._pre_roll = deque(maxlen=to_frames(pre_roll_ms) + self.start_frames); self.reset(); self._n = 0
+    def reset(self):
+        """ Drops any partial utterance (e.g. when the mic is gated while Shiva speaks). """
+        self._in_speech = False; self._voiced_run = 0; self._silence_run = 0; self._buf = []; self._start_n = 0; self._last_voiced_n = 0; self._pre_roll.clear()
+    @property
+    def idle(self): return not self._in_speech and self._voiced_run == 0 # Nothing speech-like in progress: safe to learn noise
+    def push(self, frame):
+        """ Feeds one frame (bytes, frame_samples long); returns a SpeechSegment when an utterance ends, else None. """
+        n = self._n; self._n += 1
+        voiced = self.vad.is_speech(np.frombuffer(frame, dtype=np.int16))
+        if not self._in_speech:
+            self._pre_roll.append(frame); self._voiced_run = self._voiced_run + 1 if voiced else 0
+            if self._voiced_run >= self.start_frames:
+                self._in_speech = True; self._buf = list(self._pre_roll); self._start_n = n - len(self._buf) + 1; self._pre_roll.clear()
+                self._silence_run = 0; self._last_voiced_n = n
+            return None
+        self._buf.append(frame)
+        if voiced: self._silence_run = 0; self._last_voiced_n = n
+        else: self._silence_run += 1
+        if self._silence_run < self.hangover_frames and len(self._buf) < self.max_frames: return None
+        keep = len(self._buf) - max(0, self._silence_run - self.keep_tail_frames) # Trim most of the trailing silence
+        audio = sr.AudioData(b"".join(self._buf[:keep]), self.sample_rate, self.sample_width)
+        segment = SpeechSegment(audio, self._start_n * self.frame_s, (self._last_voiced_n + 1) * self.frame_s, (n + 1) * self.frame_s, time.perf_counter())
+        self.reset(); return segment
+
+class AudioFrontEnd:
+    """ Reads frames from a persistent source on a background thread and queues SpeechSegments as soon as the
+        segmenter detects end-of-speech. With denoise=True every frame first passes through a StreamingDenoiser
+        whose noise profile is learned while the segmenter is idle, so noise reduction overlaps capture.
+        gate() returning False means the speaker is active (Shiva is talking): with barge_in=True the VAD threshold is
+        raised by VAD_BARGE_IN_MARGIN, the wake gate and noise learning are paused, and segments heard then are marked
+        barge_in (the pipeline only acts on them if they are "stop"/"cancel"); with barge_in=False that audio is
+        discarded. With a WakeWordGate (wake) the keyword
+        spotter sees every raw frame while Shiva is quiet, the denoiser runs only for utterances that start while the gate is awake (it is
+        switched on or off between utterances, never inside one), and utterances the gate does not admit are dropped
+        before reaching recognition (admitted ones captured asleep get whole-utterance NR there instead).
+        At most max_pending segments wait in the queue; older ones are dropped. """
+    def __init__(self, source, vad=None, gate=None, max_pending=4, denoise=False, wake=None, barge_in=True, **segmenter_opts):
+        self.source = source; self.vad = vad; self.gate = gate; self.denoise = denoise; self.denoiser = None; self.segmenter_opts = segmenter_opts; self.segmenter = None
+        self.wake = wake; self.barge_in = barge_in; self._segment_denoised = True; self._segment_barge_in = False
+        self._segments = queue.Queue(maxsize=max_pending); self._stop = threading.Event(); self.ready = threading.Event(); self.finished = threading.Event(); self._thread = None
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="shiva-audio", daemon=True); self._thread.start(); return self
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        if self._thread: self._thread.join(timeout)
+    def _emit(self, segment):
+        while True:
+            try: self._segments.put_nowait(segment); return
+            except queue.Full:
+                try: self._segments.get_nowait(); print("Audio front-end: dropping a stale utterance.")
+                except queue.Empty: pass
+    def setup(self, sample_rate, sample_width=2):
+        """ Builds the segmenter / denoiser / wake-word spotter for the source format (once). """
+        if self.segmenter is None:
+            self.segmenter = VADSegmenter(sample_rate, sample_width, self.vad, **self.segmenter_opts)
+            if self.wake is not None: self.wake.prepare(sample_rate, self.segmenter.frame_s)
+        if self.denoise and self.denoiser is None: self.denoiser = StreamingDenoiser(sample_rate)
+        return self.segmenter
+    def process_frame(self, frame, speaking=False):
+        """ Runs one captured frame through wake-word spotting, noise reduction and segmentation; returns an admitted
+            SpeechSegment or None. speaking=True while Shiva talks (see barge_in). """
+        seg = self.segmenter; den = self.denoiser; wake = self.wake
+        if hasattr(seg.vad, "margin"): seg.vad.margin = VAD_BARGE_IN_MARGIN if speaking else 1.0
+        if wake is not None and not speaking: # The follow-up window pauses while Shiva talks, as it did when the mic was gated
+            with METRICS.span("stage_seconds", stage="wake_frame"): wake.feed(frame)
+        if seg.idle: # Only switch denoising between utterances: a wake word mid-utterance leaves that one raw (batch NR later)
+            on = den is not None and (wake is None or wake.awake)
+            if on and not self._segment_denoised: den.reset() # Its buffers hold audio from before it was paused
+            self._segment_denoised = on; self._segment_barge_in = speaking
+        elif speaking: self._segment_barge_in = True # Shiva started talking mid-utterance: it may hold echo
+        if self._segment_denoised:
+            with METRICS.span("stage_seconds", stage="nr_frame"): frame = den.process(frame, learn_noise=seg.idle and not speaking)
+        segment = seg.push(frame)
+        if segment is None: return None
+        if self._segment_barge_in: segment.barge_in = True # Screened by keyword instead of the wake word
+        elif wake is not None and not wake.admit(segment): return None
+        segment.denoised = self._segment_denoised; METRICS.observe("stage_seconds", segment.eos_s - segment.end_s, stage="capture_eos"); return segment
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.source.open(); seg = self.setup(self.source.sample_rate, self.source.sample_width); vad = seg.vad
+                print(f"Audio front-end listening ({self.source.sample_rate} Hz, {seg.frame_ms} ms frames{', denoised' if self.denoiser else ''}{', wake word' if self.wake else ''}).")
+                while not self._stop.is_set():
+                    frame = self.source.read(seg.frame_samples); speaking = self.gate is not None and not self.gate()
+                    if speaking and not self.barge_in: seg.reset(); continue
+                    segment = self.process_frame(frame, speaking)
+                    if not self.ready.is_set() and getattr(vad, "calibrated", True): self.ready.set()
+                    if segment: self._emit(segment)
+            except EOFError: break
+            except OSError as e: print(f"\n!!! Mic OS Error: {e} !!! Reopening in 2s."); time.sleep(2)
+            except Exception as e: print(f"Audio front-end error: {e}"); time.sleep(1)
+            finally: self.source.close()
+        self.ready.set(); self.finished.set(); self._emit(None) # None = source exhausted
+    async def next_segment(self, timeout=None):
+        """ Awaits the next SpeechSegment (None when the source is exhausted or on timeout) without blocking the loop. """
+        def wait():
+            try: return self._segments.get(timeout=timeout)
+            except queue.Empty: return None
+        return await asyncio.get_running_loop().run_in_executor(None, wait)
+
+# =====================================
+# Speech Recognition: pluggable cloud / local (warm) / hybrid backends
+# =====================================
+class RecognitionResult:
+    """ A transcript with the backend's confidence (0..1) and how long recognition took. """
+    def __init__(self, text, confidence, backend, latency=0.0):
+        self.text = text; self.confidence = confidence; self.backend = backend; self.latency = latency
+    def __repr__(self): return f"RecognitionResult({self.text!r}, {self.confidence:.2f}, {self.backend})"
+
+class STTBackend:
+    """ Base for recognizers: recognize(audio_data) -> RecognitionResult or None, blocking; recognize_async runs it
+        on the default executor. warm_up() loads any model up front (called from the startup thread). Backends that
+        see an early, unconfirmed transcript may pass it to recognize_async's on_partial(result) before returning. """
+    name = "stt"
+    def warm_up(self): pass
+    def recognize(self, audio_data): raise NotImplementedError
+    async def recognize_async(self, audio_data, on_partial=None): return await asyncio.get_running_loop().run_in_executor(None, self.recognize, audio_data)
+
+class GoogleSTT(STTBackend):
+    """ Google Web Speech API through speech_recognition (needs network). Raises sr.RequestError when unreachable. """
+    name = "google"
+    def __init__(self, recognizer=None, language='en-in'): self.recognizer = recognizer or sr.Recognizer(); self.language = language
+    def recognize(self, audio_data):
+        t0 = time.perf_counter(); raw = self.recognizer.recognize_google(audio_data, language=self.language, show_all=True)
+        if not isinstance(raw, dict) or not raw.get("alternative"): return None
+        alt = raw["alternative"][0]
+        return RecognitionResult(alt.get("transcript", "").strip(), float(alt.get("confidence", 1.0)), self.name, time.perf_counter() - t0)
+
+class VoskSTT(STTBackend):
+    """ Offline recognition on CPU with a Vosk model that is loaded once and kept warm in memory.
+        A fresh KaldiRecognizer per utterance is cheap; confidence is the mean per-word confidence. """
+    name = "vosk"
+    def __init__(self, model_path=VOSK_MODEL_PATH, sample_rate=16000):
+        self.model_path = model_path; self.sample_rate = sample_rate; self._model = None; self._vosk = None; self._lock = threading.Lock()
+    def warm_up(self):
+        with self._lock:
+            if self._model is None:
+                self._vosk = importlib.import_module("vosk"); self._vosk.SetLogLevel(-1)
+                with STARTUP.phase("stt model (vosk)"): self._model = self._vosk.Model(self.model_path)
+        return self._model
+    def recognize(self, audio_data):
+        t0 = time.perf_counter(); model = self.warm_up() # Loads it here if the background warm-up has not finished (or failed)
+        rec = self._vosk.KaldiRecognizer(model, self.sample_rate); rec.SetWords(True)
+        rec.AcceptWaveform(audio_data.get_raw_data(convert_rate=self.sample_rate, convert_width=2))
+        res = json.loads(rec.FinalResult()); text = res.get("text", "").strip()
+        if not text: return None
+        words = res.get("result") or []; confidence = sum(w.get("conf", 0.0) for w in words) / len(words) if words else 0.0
+        return RecognitionResult(text, confidence, self.name, time.perf_counter() - t0)
+
+class HybridSTT(STTBackend):
+    """ Local first, cloud only when needed: a confident local result (>= min_confidence) is returned directly.
+        The cloud is consulted when the local result is unsure or has not arrived within local_deadline; the two then
+        race, the cloud's answer wins, and at deadline the best result so far is returned. An unsure local result is
+        handed to on_partial while the cloud is still working (speculation can start on it). Counters in stats. """
+    name = "hybrid"
+    def __init__(self, local, cloud, min_confidence=STT_MIN_CONFIDENCE, local_deadline=0.8, deadline=STT_DEADLINE_SECONDS):
+        self.local = local; self.cloud = cloud; self.min_confidence = min_confidence; self.local_deadline = local_deadline; self.deadline = deadline
+        self.stats = {"local_only": 0, "cloud_consulted": 0, "cloud_won": 0, "deadline_hit": 0}
+    def warm_up(self): self.local.warm_up(); self.cloud.warm_up()
+    @staticmethod
+    def _result(task):
+        try: return task.result()
+        except (sr.UnknownValueError, sr.RequestError): return None
+        except Exception as e: print(f"STT backend error: {e}"); return None
+    async def recognize_async(self, audio_data, on_partial=None):
+        t0 = time.perf_counter(); local = asyncio.ensure_future(self.local.recognize_async(audio_data)); cloud = None; best = None
+        try:
+            await asyncio.wait({local}, timeout=self.local_deadline)
+            if local.done():
+                best = self._result(local)
+                if best and best.confidence >= self.min_confidence: self.stats["local_only"] += 1; return best
+            cloud = asyncio.ensure_future(self.cloud.recognize_async(audio_data)); self.stats["cloud_consulted"] += 1
+            if best and on_partial: on_partial(best)
+            pending = {t for t in (local, cloud) if not t.done()}
+            while pending:
+                remaining = t0 + self.deadline - time.perf_counter()
+                if remaining <= 0: self.stats["deadline_hit"] += 1; break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = self._result(task)
+                    if not result: continue
+                    if task is cloud: self.stats["cloud_won"] += 1; return result
+                    best = result
+                    if result.confidence >= self.min_confidence: return result
+                    if on_partial: on_partial(result)
+            return best
+        finally:
+            for task in (local, cloud):
+                if task is not None and not task.done(): task.cancel() # The executor thread finishes on its own; its result is ignored
+
+def make_default_stt(recognizer=None):
+    """ Builds the STT_BACKEND recognizer; "auto" is hybrid when a Vosk model and the vosk package exist, else Google. """
+    backend = STT_BACKEND
+    if backend == "auto":
+        has_vosk = importlib.util.find_spec("vosk") is not None and os.path.isdir(VOSK_MODEL_PATH)
+        backend = "hybrid" if has_vosk else "google"
+    cloud = GoogleSTT(recognizer)
+    if backend == "vosk": return VoskSTT()
+    if backend == "hybrid": return HybridSTT(VoskSTT(), cloud)
+    return cloud
+
+# =====================================
+# Wake Word: always-on local keyword spotting in front of noise reduction + STT
+# =====================================
+class LogMelFeatures:
+    """ Streaming cepstral features for keyword spotting: 25 ms Hann windows every 10 ms, n_mels log-mel bands floored
+        at range_db below each frame's loudest band (so clean recordings and a noisy room look alike), and a DCT to
+        cepstra c1..n_ceps (c0, the loudness, is dropped). push(samples) returns the new feature rows. """
+    def __init__(self, sample_rate, n_mels=24, n_ceps=12, win_ms=25, hop_ms=10, fmin=60.0, range_db=30.0):
+        self.floor = 10 ** (-range_db / 10)
+        self.win = int(sample_rate * win_ms / 1000); self.hop = int(sample_rate * hop_ms / 1000); self.n_fft = 1 << int(np.ceil(np.log2(self.win)))
+        self.window = np.hanning(self.win).astype(np.float32); self._buf = np.zeros(0, np.float32)
+        to_mel = lambda f: 2595 * np.log10(1 + f / 700); to_hz = lambda m: 700 * (10 ** (m / 2595) - 1)
+        pts = to_hz(np.linspace(to_mel(fmin), to_mel(sample_rate / 2), n_mels + 2)); freqs = np.fft.rfftfreq(self.n_fft, 1 / sample_rate)
+        lo, mid, hi = pts[:-2, None], pts[1:-1, None], pts[2:, None]
+        self.mel = np.maximum(0, np.minimum((freqs - lo) / (mid - lo), (hi - freqs) / (hi - mid))).astype(np.float32).T # (bins, n_mels)
+        self.dct = np.cos(np.pi / n_mels * (np.arange(n_mels)[:, None] + 0.5) * np.arange(1, n_ceps + 1)[None, :]).astype(np.float32) # (n_mels, n_ceps)
+    def push(self, samples):
+        self._buf = np.concatenate([self._buf, np.asarray(samples, np.float32) / 32768.0])
+        n = 0 if len(self._buf) < self.win else 1 + (len(self._buf) - self.win) // self.hop
+        if not n: return np.zeros((0, self.dct.shape[1]), np.float32)
+        frames = self._buf[np.arange(self.win)[None, :] + self.hop * np.arange(n)[:, None]] * self.window; self._buf = self._buf[n * self.hop:]
+        mel = (np.abs(np.fft.rfft(frames, self.n_fft)) ** 2) @ self.mel + 1e-12
+        return np.log(np.maximum(mel, mel.max(axis=1, keepdims=True) * self.floor)) @ self.dct
+
+
+class TemplateKeywordSpotter:
+    """ Keyword spotting on CPU with numpy only: streaming subsequence DTW of cepstral features against a few enrolled
+        recordings of the wake word (each trimmed to its voiced part). Steps advance the template by 0, 1 or 2 frames
+        per input frame (speech down to half speed, staying costs stay_penalty) and path cost is averaged per input
+        frame. Distances are scaled by the templates' mutual distance, so score = 1 - distance / (2.5 * that): about
+        0.6 for another take as close as the enrolled ones. All templates are stacked into one array, so each 10 ms
+        step is a handful of vector ops. prepare(sample_rate), then process(frame) -> best score. """
+    name = "template"
+    def __init__(self, template_paths, ref_distance=None, stay_penalty=0.5):
+        self.template_paths = list(template_paths); self.ref_distance = ref_distance; self.stay_penalty = stay_penalty; self.templates = []; self.sample_rate = None
+    def prepare(self, sample_rate):
+        if self.sample_rate == sample_rate: return
+        self.sample_rate = sample_rate; self.templates = [t for t in (self._features(_read_wav_mono16(p, sample_rate)) for p in self.template_paths) if len(t) >= 10]
+        if not self.templates: raise ValueError(f"No usable wake-word templates in {self.template_paths}")
+        self._stay_cost = self.stay_penalty * float(np.mean([np.linalg.norm(np.diff(t, axis=0), axis=1).mean() for t in self.templates])) # In units of frame-to-frame change
+        if self.ref_distance is None:
+            pairs = [self.distance(a, b) for i, a in enumerate(self.templates) for b in self.templates[i + 1:]]
+            self.ref_distance = float(np.mean(pairs)) if pairs else 4.0 * self._stay_cost
+        lengths = np.array([len(t) for t in self.templates]); self._starts = np.r_[0, np.cumsum(lengths)[:-1]]; self._ends = self._starts + lengths - 1
+        self._stacked = np.concatenate(self.templates).astype(np.float32); self._stacked_sq = (self._stacked ** 2).sum(axis=1)
+        self.reset(); print(f"Wake word: {len(self.templates)} template(s), reference distance {self.ref_distance:.2f}.")
+    def _features(self, samples):
+        """ Features of the voiced part of a clip (frames within 30 dB of its loudest). """
+        feats = LogMelFeatures(self.sample_rate); hop = feats.hop; x = samples.astype(np.float32)
+        energy = np.array([np.dot(x[i:i + hop], x[i:i + hop]) for i in range(0, len(x) - hop + 1, hop)]) + 1e-9
+        voiced = np.flatnonzero(energy > energy.max() * 1e-3)
+        if not len(voiced): return np.zeros((0, feats.dct.shape[1]), np.float32)
+        return feats.push(samples[voiced[0] * hop:(voiced[-1] + 1) * hop + feats.win])
+    def distance(self, clip_feats, template):
+        """ Mean per-frame DTW cost of the whole clip_feats against template (used to calibrate ref_distance). """
+        d, n, starts = np.full(len(template), np.inf), np.zeros(len(template)), np.array([0])
+        for i, x in enumerate(clip_feats): d, n = self._step(np.sqrt(((template - x) ** 2).sum(axis=1)), d, n, starts, free_start=i == 0)
+        return float(d[-1] / max(n[-1], 1))
+    def _step(self, cost, d, n, starts, free_start=True):
+        """ One input frame of DTW over stacked templates (template k starts at index starts[k]). """
+        stay = d + self._stay_cost; one = np.empty_like(d); one[1:] = d[:-1]; two = np.empty_like(d); two[2:] = d[:-2]
+        one[starts] = np.inf; two[starts] = np.inf; two[starts + 1] = np.inf # No step into a template from the previous one
+        n1 = np.empty_like(n); n1[1:] = n[:-1]; n2 = np.empty_like(n); n2[2:] = n[:-2]
+        best = np.minimum(np.minimum(stay, one), two); steps = np.where(best == stay, n, np.where(best == one, n1, n2))
+        if free_start: best[starts] = 0.0; steps[starts] = 0 # Streaming: a match may start at any input frame (subsequence DTW)
+        return best + cost, steps + 1
+    def reset(self):
+        self._feats = LogMelFeatures(self.sample_rate); self._d = np.full(len(self._stacked), np.inf); self._n = np.ones(len(self._stacked))
+    def process(self, frame):
+        feats = self._feats.push(np.frombuffer(frame, dtype=np.int16))
+        if not len(feats): return 0.0
+        costs = np.sqrt(np.maximum(0.0, (feats ** 2).sum(axis=1)[:, None] + self._stacked_sq[None, :] - 2.0 * feats @ self._stacked.T))
+        best = np.inf
+        for cost in costs: self._d, self._n = self._step(cost, self._d, self._n, self._starts); best = min(best, float((self._d[self._ends] / self._n[self._ends]).min()))
+        return max(0.0, 1.0 - best / (2.5 * self.ref_distance))
+
+class VoskKeywordSpotter:
+    """ Keyword spotting with the (already warm) Vosk model and a grammar of just the wake word or [unk]: far cheaper
+        than open-vocabulary recognition. A partial hit scores 0.6, a final one the word's confidence. Pass the
+        VoskSTT used for recognition (stt) so the model is loaded once; without one it gets its own. """
+    name = "vosk"
+    def __init__(self, keyword=WAKE_WORD, model_path=VOSK_MODEL_PATH, stt=None):
+        self.keyword = keyword.lower(); self.stt = stt or VoskSTT(model_path); self._rec = None; self.sample_rate = None
+    def prepare(self, sample_rate):
+        model = self.stt.warm_up(); self.sample_rate = sample_rate
+        self._rec = self.stt._vosk.KaldiRecognizer(model, sample_rate, json.dumps([self.keyword, "[unk]"])); self._rec.SetWords(True)
+    def reset(self): self._rec.Reset()
+    def process(self, frame):
+        if self._rec.AcceptWaveform(frame):
+            return max((w.get("conf", 0.0) for w in json.loads(self._rec.Result()).get("result", []) if w.get("word") == self.keyword), default=0.0)
+        return 0.6 if self.keyword in json.loads(self._rec.PartialResult()).get("partial", "").split() else 0.0
+
+class WakeWordGate:
+    """ Decides which utterances reach noise reduction and STT. The detector (prepare(sample_rate), then
+        process(frame) -> score 0..1) runs on every raw frame; a score >= 1 - sensitivity is a detection.
+        An utterance is admitted when the wake word was heard inside it ("Shiva, open notepad" in one breath) or it
+        starts within followup_s after the end of the one that was (follow-ups do not extend the window, so chatter
+        cannot keep the gate open); everything else is dropped. Stream time is counted in fed frames, as by
+        VADSegmenter, so detections line up with SpeechSegment bounds and the window pauses while the mic is gated. """
+    def __init__(self, detector, sensitivity=WAKE_SENSITIVITY, followup_s=WAKE_FOLLOWUP_SECONDS, refractory_s=1.0, slack_s=0.3):
+        self.detector = detector; self.sensitivity = sensitivity; self.followup_s = followup_s; self.refractory_s = refractory_s; self.slack_s = slack_s
+        self.frame_s = 0.03; self._t = 0.0; self._last_hit = None; self._awake_until = -1.0; self.stats = {"detections": 0, "admitted": 0, "rejected": 0}
+    @property
+    def threshold(self): return 1.0 - self.sensitivity
+    def prepare(self, sample_rate, frame_s): self.detector.prepare(sample_rate); self.frame_s = frame_s
+    @property
+    def awake(self): return self._t <= self._awake_until
+    def feed(self, frame):
+        """ Runs the spotter on one raw frame; returns True on a (new) detection. """
+        self._t += self.frame_s; score = self.detector.process(frame)
+        if score < self.threshold or (self._last_hit is not None and self._t - self._last_hit < self.refractory_s): return False
+        self._last_hit = self._t; self._awake_until = max(self._awake_until, self._t + self.followup_s); self.stats["detections"] += 1
+        METRICS.inc("wake_detections_total"); print(f"Wake word detected (score {score:.2f})."); return True
+    def admit(self, segment):
+        heard = self._last_hit is not None and segment.start_s - self.slack_s <= self._last_hit <= segment.eos_s + self.slack_s
+        if not (heard or segment.start_s <= self._awake_until):
+            self.stats["rejected"] += 1; METRICS.inc("wake_segments_total", outcome="rejected"); return False
+        if heard: self._awake_until = max(self._awake_until, segment.eos_s + self.followup_s)
+        self.stats["admitted"] += 1; METRICS.inc("wake_segments_total", outcome="admitted")
+        return True
+
+def make_default_wake_gate(stt=None):
+    """ WakeWordGate over enrolled templates (WAKE_TEMPLATES_DIR) or else the Vosk model (shared with stt when that is,
+        or wraps, a VoskSTT); None (no gating) without either. """
+    if not ENABLE_WAKE_WORD: return None
+    templates = sorted(glob.glob(os.path.join(WAKE_TEMPLATES_DIR, "*.wav")))
+    if templates: return WakeWordGate(TemplateKeywordSpotter(templates))
+    local = stt if isinstance(stt, VoskSTT) else getattr(stt, "local", None)
+    if isinstance(local, VoskSTT) and os.path.isdir(local.model_path): return WakeWordGate(VoskKeywordSpotter(stt=local))
+    if importlib.util.find_spec("vosk") is not None and os.path.isdir(VOSK_MODEL_PATH): return WakeWordGate(VoskKeywordSpotter())
+    print(f"Wake word: no templates in {WAKE_TEMPLATES_DIR} and no Vosk model; every utterance is recognized."); return None
+
 # =====================================
 # Shiva: Voice Assistant Class
 # =====================================
 class Shiva:
-    def __init__(self):
+    background_startup = True # False for assistants whose services are injected already warm (server sessions): no startup pool or futures
+    def __init__(self, engine=None, genai_model=None, calibrate_mic=True, cache=None, audio_source=None, stt=None, media_index=None, timers=None, ai_manager=None, memory=None, wake_gate=None, wiki=None, speech=None, stop_event=None):
+        """ Returns quickly: TTS engine start-up, AI model construction, STT model warm-up and mic start-up/calibration
+            run concurrently in the background (see wait_until_ready / the startup timeline). engine / genai_model /
+            cache / audio_source (e.g. a WavFileSource) / stt (an STTBackend) / media_index / timers (a TimerScheduler) / ai_manager / memory (a ConversationMemory) / wake_gate (a WakeWordGate) / wiki (a WikipediaClient) may be injected; calibrate_mic=False skips the mic.
+            speech replaces the local SpeechWorker (e.g. a server session's RemoteSpeech); stop_event is what "exit" sets (default stop_voice_loop). """
         global ai_model_loaded
-        print("\n--- Initializing Shiva ---")
-        self.engine = pyttsx3.init(); self.recognizer = sr.Recognizer(); self.name = "Shiva"; self.genai_model = None; ai_model_loaded = False; self.ambient_noise_adjusted = False
-        if google_ai_configured:
-            print(f"Attempting load: '{GENERATIVE_MODEL_NAME}'...");
-            try:
-                self.genai_model = genai.GenerativeModel(GENERATIVE_MODEL_NAME)
-                print(f"Successfully loaded Google AI Model: '{GENERATIVE_MODEL_NAME}'.")
-                ai_model_loaded = True
-            except Exception as e:
-                print(f"\n!!! ERROR loading AI Model '{GENERATIVE_MODEL_NAME}': {e} !!!\n")
-        else: print("Google AI SDK not configured, skipping AI model loading.")
+        if self.background_startup: print("\n--- Initializing Shiva ---")
+        self.speech = speech or SpeechWorker(lambda: self._timed("tts engine", lambda: engine or pyttsx3.init())); self.stop_event = stop_event or stop_voice_loop; self._recognizer = None; self.name = "Shiva"; self.genai_model = genai_model; ai_model_loaded = genai_model is not None; self.ambient_noise_adjusted = False
+        self.last_stream_stats = {} # Timings of the most recent streamed AI answer (see speak_ai_answer)
+        self._speculation = None; self.speculation_stats = {"started": 0, "adopted": 0, "discarded": 0, "latency_saved_s": 0.0, "tokens_wasted": 0}
+        self.cache = cache if cache is not None else make_default_cache()
+        self.stt = stt or make_default_stt(self.recognizer); self.pipeline = None;
+        self.media_index = media_index if media_index is not None else make_default_media_index()
+        self.timers = timers if timers is not None else make_default_timers(None); self.timers.on_fire = self._timer_fired
+        self.ai = ai_manager or AIRequestManager(lambda: self.genai_model) # Every Gemini call goes through here (one shared model client)
+        self.wiki = wiki or WikipediaClient()
+        self.memory = memory or (ConversationMemory(summarizer=self._summarize) if ENABLE_CONVERSATION_MEMORY else None)
+        self.audio_source = audio_source; self.wake_gate = wake_gate; self.audio_frontend = None; self.last_recognition_latency = None # End-of-speech -> text, seconds
+        self._ai_future = self._mic_future = self._stt_future = None
+        if not self.background_startup: return
+        self._startup_pool = concurrent.futures.ThreadPoolExecutor(max_workers=3, thread_name_prefix="shiva-startup")
+        if genai_model is not None: print("Using injected AI model.")
+        else: self._ai_future = self._startup_pool.submit(self._load_ai_model)
+        self._mic_future = self._startup_pool.submit(self._calibrate_mic) if calibrate_mic or audio_source is not None else None
+        self._stt_future = self._startup_pool.submit(self._warm_stt)
+        self._startup_pool.shutdown(wait=False); print("--- Shiva Initialized (background startup running) ---")
+
+    @property
+    def recognizer(self):
+        """ speech_recognition's Recognizer, for the cloud STT default and the legacy listen() path; built on first use. """
+        if self._recognizer is None:
+            self._recognizer = sr.Recognizer(); self._recognizer.pause_threshold = 1.0; self._recognizer.dynamic_energy_threshold = True
+        return self._recognizer
+
+    @staticmethod
+    def _timed(name, fn):
+        with STARTUP.phase(name): return fn()
+    def _load_ai_model(self):
+        global ai_model_loaded
+        if not configure_google_ai(): print("Google AI SDK not configured, skipping AI model loading."); return None
+        print(f"Attempting load: '{GENERATIVE_MODEL_NAME}'...");
+        try:
+            with STARTUP.phase("ai model"): self.genai_model = genai.GenerativeModel(GENERATIVE_MODEL_NAME)
+            print(f"Successfully loaded Google AI Model: '{GENERATIVE_MODEL_NAME}'.")
+            ai_model_loaded = True
+        except Exception as e:
+            print(f"\n!!! ERROR loading AI Model '{GENERATIVE_MODEL_NAME}': {e} !!!\n")
+        return self.genai_model
+    def _calibrate_mic(self):
+        if ENABLE_VAD_FRONTEND or self.audio_source is not None: return self._start_audio_frontend()
         try:
-            with sr.Microphone() as source: print("Adjusting noise..."); self.recognizer.adjust_for_ambient_noise(source, duration=2.0); self.ambient_noise_adjusted = True; print("Noise adjust done.")
+            with STARTUP.phase("mic calibration"), sr.Microphone() as source:
+                print("Adjusting noise..."); self.recognizer.adjust_for_ambient_noise(source, duration=MIC_CALIBRATION_SECONDS); self.ambient_noise_adjusted = True; print("Noise adjust done.")
         except OSError as e: print(f"\n!!! Mic OS Error: {e} !!!");
         except Exception as e: print(f"Mic init error: {e}");
-        self.recognizer.pause_threshold = 1.0; self.recognizer.dynamic_energy_threshold = True; print("--- Shiva Initialized ---")
+    def _warm_stt(self):
+        try: self.stt.warm_up()
+        except Exception as e: print(f"STT warm-up error ({self.stt.name}): {e}")
+    def _start_audio_frontend(self):
+        """ Opens the persistent capture stream; "mic ready" once the VAD has learned the ambient noise floor. """
+        try:
+            with STARTUP.phase("mic stream + vad calibration"):
+                gate = (lambda: not self.speech.is_speaking()) if VAD_HALF_DUPLEX else None
+                wake = self.wake_gate if self.wake_gate is not None else make_default_wake_gate(self.stt) if self.audio_source is None else None # Files/replays are not gated unless one is injected
+                self.audio_frontend = AudioFrontEnd(self.audio_source or MicrophoneSource(), gate=gate, denoise=ENABLE_NOISE_REDUCTION, wake=wake).start()
+                if not self.audio_frontend.ready.wait(timeout=5.0): print("Audio front-end slow to calibrate; listening anyway.")
+            self.ambient_noise_adjusted = True
+        except Exception as e: print(f"Audio front-end init error: {e}"); self.audio_frontend = None
+    async def _ensure_ai_model(self):
+        """ Waits for the background model load (if still running) and returns the model or None. """
+        if self._ai_future is not None and not self._ai_future.done(): await asyncio.wrap_future(self._ai_future)
+        return self.genai_model
+    async def wait_until_ready(self, mic=True, ai=False, stt=True):
+        """ Awaits the background startup stages the caller needs (mic and STT model before listening, AI before asking). """
+        if mic and self._mic_future is not None: await asyncio.wrap_future(self._mic_future)
+        if stt and self._stt_future is not None: await asyncio.wrap_future(self._stt_future)
+        if ai: await self._ensure_ai_model()
 
-    async def speak(self, text):
-        if not text: return; print(f"Shiva: {text[:100]}{'...' if len(text)>100 else ''}")
-        try: self.engine.say(text); self.engine.runAndWait()
-        except Exception as e: print(f"Speech synthesis error: {e}")
+    async def speak(self, text, priority=PRIORITY_NORMAL, wait=True):
+        """ Queues text on the speech worker without blocking the event loop. Awaits completion (True if fully
+            spoken, False if cancelled/barged-in); with wait=False returns the Utterance (utterance.future) instead. """
+        if not text: return True
+        print(f"Shiva: {text[:100]}{'...' if len(text)>100 else ''}")
+        utt = self.speech.submit(text, priority)
+        if not wait: return utt
+        return await asyncio.wrap_future(utt.future)
     async def take_command(self):
-        query = "none";
+        query = "none"; await self.wait_until_ready(mic=True)
+        if not STARTUP._reported: STARTUP.mark("first listen"); STARTUP.report()
+        if self.audio_frontend: return await self._take_command_streaming()
         try:
             with sr.Microphone() as source:
                 print("Listening...");
                 try:
-                    audio_data = self.recognizer.listen(source, timeout=7, phrase_time_limit=10); print("Processing...")
-                    if ENABLE_NOISE_REDUCTION:
-                        try:
-                            raw_data=audio_data.get_raw_data(); sr_rate=audio_data.sample_rate; sw=audio_data.sample_width; dtype={1:np.int8, 2:np.int16, 4:np.int32}.get(sw,np.int16)
-                            if sw not in [1,2,4]: print(f"Warn: Sample width {sw}");
-                            aud_samp=np.frombuffer(raw_data,dtype=dtype);
-                            if np.max(np.abs(aud_samp))>0:
-                                aud_fl=aud_samp.astype(np.float32)/np.iinfo(dtype).max; red_fl=nr.reduce_noise(y=aud_fl,sr=sr_rate,stationary=True,prop_decrease=0.85); red_samp=(red_fl*np.iinfo(dtype).max).astype(dtype); proc_raw=red_samp.tobytes(); audio_data=sr.AudioData(proc_raw,sr_rate,sw); print("Noise reduction applied.")
-                            else: print("Silent audio, skipping NR.")
-                        except ImportError: print("NR libs missing.");
-                        except Exception as nr_e: print(f"NR error: {nr_e}");
-                    print("Recognizing..."); query=self.recognizer.recognize_google(audio_data, language='en-in'); print(f"User: {query}"); return query.lower()
+                    audio_data = await asyncio.get_running_loop().run_in_executor(None, lambda: self.recognizer.listen(source, timeout=7, phrase_time_limit=10)); print("Processing...")
+                    query = await self._recognize(self._reduce_noise(audio_data))
+                    if query: return query
                 except sr.WaitTimeoutError: print("No speech.");
-                except sr.UnknownValueError: print("Audio unclear.");
-                except sr.RequestError as e: print(f"Recognition API error: {e}");
                 except Exception as e: print(f"Listen/Recognize error: {e}");
         except OSError as e: print(f"\n!!! Mic OS Error: {e} !!!"); await self.speak("Mic connection lost."); await asyncio.sleep(5)
         except Exception as mic_e: print(f"General mic access error: {mic_e}");
         return "none"
-    async def ask_google_ai(self, question):
-        if not self.genai_model:
-            print("DEBUG: ask_google_ai called but self.genai_model is None.")
-            if not google_ai_configured: return "My apologies. The AI connection setup failed, likely due to the API key."
-            else: return f"My apologies. I couldn't load the specific AI model ('{GENERATIVE_MODEL_NAME}') during startup."
+    async def _take_command_streaming(self):
+        """ Waits for the VAD front-end's next utterance (emitted right at end-of-speech) and recognizes it. """
+        print("Listening...")
+        segment = await self.audio_frontend.next_segment(timeout=7)
+        if segment is None:
+            if self.audio_frontend.finished.is_set(): print("Audio source exhausted.")
+            else: print("No speech.")
+            return "none"
+        return await self.recognize_segment(segment)
+    async def recognize_segment(self, segment):
+        """ Recognizes one front-end SpeechSegment; returns the lower-cased query or "none". """
+        print(f"Processing... ({segment.end_s - segment.start_s:.1f}s of speech)")
+        try: query = await self._recognize(segment.audio if segment.denoised else self._reduce_noise(segment.audio))
+        except Exception as e: print(f"Recognize error: {e}"); return "none"
+        self.last_recognition_latency = time.perf_counter() - segment.eos_at
+        log.debug("Latency: end-of-speech -> text %.0fms", self.last_recognition_latency * 1000)
+        if segment.barge_in and query: # Heard over Shiva's own voice: only an interrupt counts, anything else is likely echo
+            intent = INTENT_ROUTER.route(query); interrupt = intent is not None and intent.name == "interrupt"
+            METRICS.inc("barge_in_segments_total", outcome="interrupt" if interrupt else "ignored")
+            if not interrupt: print(f"Ignoring '{query}' (heard while speaking)."); self._discard_speculation("heard while speaking"); return "none"
+        return query or "none"
+    def _reduce_noise(self, audio_data):
+        """ Applies noisereduce to an sr.AudioData when ENABLE_NOISE_REDUCTION is set; returns the input on any problem. """
+        if not ENABLE_NOISE_REDUCTION: return audio_data
+        with METRICS.span("stage_seconds", stage="nr"): return self._reduce_noise_now(audio_data)
+    def _reduce_noise_now(self, audio_data):
+        try:
+            raw_data=audio_data.get_raw_data(); sr_rate=audio_data.sample_rate; sw=audio_data.sample_width; dtype={1:np.int8, 2:np.int16, 4:np.int32}.get(sw,np.int16)
+            if sw not in [1,2,4]: print(f"Warn: Sample width {sw}");
+            aud_samp=np.frombuffer(raw_data,dtype=dtype);
+            if np.max(np.abs(aud_samp))>0:
+                aud_fl=aud_samp.astype(np.float32)/np.iinfo(dtype).max; red_fl=nr.reduce_noise(y=aud_fl,sr=sr_rate,stationary=True,prop_decrease=0.85); red_samp=(red_fl*np.iinfo(dtype).max).astype(dtype); proc_raw=red_samp.tobytes(); audio_data=sr.AudioData(proc_raw,sr_rate,sw); print("Noise reduction applied.")
+            else: print("Silent audio, skipping NR.")
+        except ImportError: print("NR libs missing.");
+        except Exception as nr_e: print(f"NR error: {nr_e}");
+        return audio_data
+    async def _recognize(self, audio_data):
+        """ Speech-to-text through self.stt (off the event loop); returns the lower-cased query or None when nothing usable was recognized. """
+        try:
+            print("Recognizing...")
+            with METRICS.span("stage_seconds", stage="stt"): result = await self.stt.recognize_async(audio_data, on_partial=self._speculate)
+            if result: METRICS.inc("stt_results_total", backend=result.backend)
+            if self._speculation and not (result and result.text and ResponseCache.normalize(result.text) == ResponseCache.normalize(self._speculation.question)):
+                self._discard_speculation("final transcript differs")
+            if result and result.text: print(f"User: {result.text}  [{result.backend}, conf {result.confidence:.2f}, {result.latency*1000:.0f}ms]"); return result.text.lower()
+            print("Audio unclear.")
+        except sr.UnknownValueError: print("Audio unclear.");
+        except sr.RequestError as e: print(f"Recognition API error: {e}");
+        return None
+    def _speculate(self, result):
+        """ on_partial callback for an unconfirmed transcript (HybridSTT's unsure local result while the cloud checks it):
+            when the router finds a built-in unlikely, the AI fallback starts on it right away. process_command adopts
+            the answer if the final transcript agrees and no built-in wins; otherwise it is cancelled. """
+        if not (ENABLE_SPECULATIVE_AI and ENABLE_AI_STREAMING) or not result or not result.text or self.genai_model is None: return
+        query = result.text.lower()
+        if self._speculation and ResponseCache.normalize(self._speculation.question) == ResponseCache.normalize(query): return
+        confidence = INTENT_ROUTER.builtin_confidence(query)
+        if confidence >= SPECULATIVE_AI_MAX_CONFIDENCE: return
+        prompt, cacheable = self._conversation_prompt(query, True)
+        if cacheable and self.cache.has("ai", query): return
+        self._discard_speculation("newer partial transcript")
+        self._speculation = SpeculativeAnswer(self.ai, query, prompt); self.speculation_stats["started"] += 1; METRICS.inc("ai_speculation_total", outcome="started")
+        log.debug("Speculative AI request on partial transcript %r (built-in confidence %.2f).", query, confidence)
+    def _take_speculation(self, query):
+        """ Hands the pending speculative answer to the command for query (None if there is none or it was for other words). """
+        spec, self._speculation = self._speculation, None
+        if spec and ResponseCache.normalize(spec.question) != ResponseCache.normalize(query): self._discard_speculation("final transcript differs", spec); return None
+        return spec
+    def _discard_speculation(self, reason, spec=None):
+        spec = spec or self._speculation
+        if spec is None or spec.outcome is not None: return
+        if spec is self._speculation: self._speculation = None
+        tokens = spec.discard(); self.speculation_stats["discarded"] += 1; self.speculation_stats["tokens_wasted"] += tokens
+        METRICS.inc("ai_speculation_total", outcome="discarded"); METRICS.inc("ai_speculation_wasted_tokens_total", tokens)
+        log.debug("Speculative AI request for %r discarded (%s): ~%d tokens wasted.", spec.question, reason, tokens)
+    def _conversation_prompt(self, question, conversation):
+        """ (prompt, cacheable): with conversation memory the prompt carries earlier turns, and answers that depend on
+            them are neither served from nor stored in the cache (only a conversation's first question is). """
+        if not (conversation and self.memory) or not self.memory.has_context(): return (self.memory.prompt(question) if conversation and self.memory else question), True
+        return self.memory.prompt(question), False
+    async def _summarize(self, prompt):
+        response = await self.ai.generate(prompt, deadline=30.0)
+        return "".join(part.text for part in response.parts).strip()
+    async def ask_google_ai(self, question, cache_source="ai", conversation=False):
+        if not await self._ensure_ai_model():
+            log.debug("ask_google_ai called but self.genai_model is None."); METRICS.inc("ai_errors_total", category="unavailable")
+            return self._ai_unavailable_message()
         if not question: return "What would you like to ask?"
-        print(f"DEBUG: Sending to AI ({GENERATIVE_MODEL_NAME}): '{question}'");
+        prompt, cacheable = self._conversation_prompt(question, conversation)
+        cached = self.cache.get(cache_source, question) if cacheable else None
+        if cached:
+            log.debug("AI answer from cache [%s].", cache_source)
+            if conversation and self.memory: self.memory.add_turn(question, cached)
+            return cached
+        log.debug("Sending to AI (%s): %r", GENERATIVE_MODEL_NAME, question)
         try:
-            response = await self.genai_model.generate_content_async(question);
-            if response.prompt_feedback and response.prompt_feedback.block_reason: reason = response.prompt_feedback.block_reason; print(f"AI blocked: {reason}"); return "Safety restrictions prevent response." if 'SAFETY' in str(reason).upper() else f"AI blocked: {reason}"
+            t0 = time.perf_counter()
+            with METRICS.span("ai_request_seconds", mode="blocking"): response = await self.ai.generate(prompt)
+            if response.prompt_feedback and response.prompt_feedback.block_reason: reason = response.prompt_feedback.block_reason; print(f"AI blocked: {reason}"); METRICS.inc("ai_errors_total", category="blocked"); return "Safety restrictions prevent response." if 'SAFETY' in str(reason).upper() else f"AI blocked: {reason}"
             answer = None;
             if response.candidates and response.candidates[0].content and response.candidates[0].content.parts: answer = "".join(part.text for part in response.candidates[0].content.parts).strip()
             if not answer and response.parts: answer = "".join(part.text for part in response.parts).strip()
-            if not answer: finish_reason = response.candidates[0].finish_reason if response.candidates else "Unknown"; print(f"AI empty response. Finish Reason: {finish_reason}"); return "AI response unclear/empty."
-            print(f"DEBUG: AI response received: {answer[:100]}..."); return answer
+            if not answer: finish_reason = response.candidates[0].finish_reason if response.candidates else "Unknown"; print(f"AI empty response. Finish Reason: {finish_reason}"); METRICS.inc("ai_errors_total", category="empty"); return "AI response unclear/empty."
+            log.debug("AI response received: %.100s...", answer)
+            if cacheable: self.cache.put(cache_source, question, answer, time.perf_counter() - t0)
+            if conversation and self.memory: self.memory.add_turn(question, answer, response)
+            return answer
+        except AIDeadlineExceeded as e: return self._ai_deadline_fallback(e, question, cache_source)
         except Exception as e:
-            print(f"!!! Google AI API Error during generation: {e}"); err_msg = str(e).lower(); user_message = "Sorry, an error occurred while contacting the AI module."
-            if "api key not valid" in err_msg or "permission denied" in err_msg: user_message = "The AI API key seems invalid or lacks permission."
-            elif "quota" in err_msg or "resource exhausted" in err_msg: user_message = "The AI service is busy or the usage limit was reached."
-            elif "model" in err_msg and ("not found" in err_msg or "404" in err_msg): user_message = f"The AI model '{GENERATIVE_MODEL_NAME}' could not be found or is unavailable."
-            elif "connection" in err_msg or "network" in err_msg or "deadline exceeded" in err_msg: user_message = "I'm having trouble connecting to the AI service."
-            print(f"DEBUG: AI Error User Message: {user_message}"); return user_message
+            print(f"!!! Google AI API Error during generation: {e}"); return self._ai_error_message(e)
+    def _ai_deadline_fallback(self, exc, question, cache_source, cache_late=True):
+        """ Answer for a request that missed its deadline: a stale cached answer if there is one, else a short canned
+            reply. A blocking call that finishes later is still cached, so asking again gets the real answer. """
+        METRICS.inc("ai_errors_total", category="deadline"); print(f"AI answer not ready within {self.ai.deadline:g}s; using fallback.")
+        def cache_late_answer(fut):
+            if fut.cancelled() or fut.exception() is not None: return
+            try: text = "".join(p.text for p in fut.result().parts).strip()
+            except Exception: return
+            if text: self.cache.put(cache_source, question, text)
+        if cache_late: exc.pending.add_done_callback(cache_late_answer)
+        stale = self.cache.get_stale(cache_source, question)
+        return stale if stale else "That's taking longer than expected. Please ask me again in a moment."
+    def _ai_unavailable_message(self):
+        if not google_ai_configured: return "My apologies. The AI connection setup failed, likely due to the API key."
+        return f"My apologies. I couldn't load the specific AI model ('{GENERATIVE_MODEL_NAME}') during startup."
+    @staticmethod
+    def _ai_error_category(e):
+        """ Buckets an AI SDK exception by its text: auth, quota, model_not_found, network or other. """
+        err_msg = str(e).lower()
+        if "api key not valid" in err_msg or "permission denied" in err_msg: return "auth"
+        if "quota" in err_msg or "resource exhausted" in err_msg: return "quota"
+        if "model" in err_msg and ("not found" in err_msg or "404" in err_msg): return "model_not_found"
+        if "connection" in err_msg or "network" in err_msg or "deadline exceeded" in err_msg: return "network"
+        return "other"
+    def _ai_error_message(self, e):
+        """ Maps an AI SDK exception to a short spoken explanation (and counts it under ai_errors_total). """
+        category = self._ai_error_category(e); METRICS.inc("ai_errors_total", category=category)
+        user_message = {"auth": "The AI API key seems invalid or lacks permission.", "quota": "The AI service is busy or the usage limit was reached.",
+                        "model_not_found": f"The AI model '{GENERATIVE_MODEL_NAME}' could not be found or is unavailable.",
+                        "network": "I'm having trouble connecting to the AI service."}.get(category, "Sorry, an error occurred while contacting the AI module.")
+        log.debug("AI error (%s) user message: %s", category, user_message); return user_message
+
+    async def speak_ai_answer(self, question, stream=None, cache_source="ai", conversation=False, speculation=None):
+        """ Asks the AI and speaks the answer. With stream (default ENABLE_AI_STREAMING) the response is consumed
+            as a stream and each complete sentence is queued to speech while the model is still generating.
+            Timings land in self.last_stream_stats: ttft (first chunk) and ttfa (first sentence handed to speak).
+            cache_source picks the ResponseCache TTL bucket ("ai", "weather", "fact"); conversation=True sends (and
+            extends) the conversation memory. speculation (a SpeculativeAnswer for this question) is used instead of
+            a new request when its prompt is still the one that would be sent; the caller discards it otherwise. """
+        if stream is None: stream = ENABLE_AI_STREAMING
+        if not stream or not await self._ensure_ai_model() or not question:
+            await self.speak(await self.ask_google_ai(question, cache_source, conversation)); return
+        prompt, cacheable = self._conversation_prompt(question, conversation)
+        cached = self.cache.get(cache_source, question) if cacheable else None
+        if cached:
+            log.debug("AI answer from cache [%s].", cache_source)
+            if conversation and self.memory: self.memory.add_turn(question, cached)
+            await self.speak(cached); return
+        if speculation and not speculation.matches(question, prompt): self._discard_speculation("conversation changed", speculation); speculation = None
+        log.debug("Streaming from AI (%s%s): %r", GENERATIVE_MODEL_NAME, ", speculative" if speculation else "", question)
+        sentences = asyncio.Queue(); splitter = SentenceSplitter(); t0 = time.perf_counter(); stats = {"ttft": None, "ttfa": None, "total": None, "sentences": 0, "barged_in": False, "speculative_saved": None}
+        async def speaker():
+            while True:
+                sentence = await sentences.get()
+                if sentence is None: return
+                if stats["barged_in"]: continue # Drain the rest of the answer silently
+                if stats["ttfa"] is None: stats["ttfa"] = time.perf_counter() - t0
+                stats["sentences"] += 1; stats["barged_in"] = not await self.speak(sentence)
+        speaker_task = asyncio.create_task(speaker()); full_text = []; blocked = False
+        try:
+            async with (speculation.adopt() if speculation else self.ai.stream(prompt)) as response:
+                if speculation: self.speculation_stats["adopted"] += 1; METRICS.inc("ai_speculation_total", outcome="adopted")
+                async for chunk in response:
+                    if stats["ttft"] is None: stats["ttft"] = time.perf_counter() - t0
+                    if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                        reason = chunk.prompt_feedback.block_reason; print(f"AI blocked: {reason}"); blocked = True; METRICS.inc("ai_errors_total", category="blocked")
+                        sentences.put_nowait("Safety restrictions prevent response." if 'SAFETY' in str(reason).upper() else f"AI blocked: {reason}"); break
+                    try: text = "".join(part.text for part in chunk.parts)
+                    except Exception: text = "" # Chunk without text parts (e.g. a bare finish_reason)
+                    if text: full_text.append(text)
+                    for sentence in splitter.feed(text): sentences.put_nowait(sentence)
+                tail = splitter.flush()
+                if tail: sentences.put_nowait(tail)
+                elif not full_text and stats["sentences"] == 0 and sentences.empty(): sentences.put_nowait("AI response unclear/empty."); METRICS.inc("ai_errors_total", category="empty")
+                if full_text and not blocked:
+                    if cacheable: self.cache.put(cache_source, question, "".join(full_text).strip(), time.perf_counter() - t0)
+                    if conversation and self.memory: self.memory.add_turn(question, "".join(full_text).strip(), response)
+        except AIDeadlineExceeded as e: sentences.put_nowait(self._ai_deadline_fallback(e, question, cache_source, cache_late=False))
+        except Exception as e:
+            print(f"!!! Google AI API Error during streaming: {e}"); sentences.put_nowait(self._ai_error_message(e))
+        finally:
+            sentences.put_nowait(None)
+            try: await speaker_task
+            finally:
+                stats["total"] = time.perf_counter() - t0; self.last_stream_stats = stats; METRICS.observe("ai_request_seconds", stats["total"], mode="stream")
+                saved = speculation.latency_saved() if speculation else None
+                if saved is not None:
+                    stats["speculative_saved"] = saved; self.speculation_stats["latency_saved_s"] += saved; METRICS.observe("ai_speculation_saved_seconds", saved)
+                for k in ("ttft", "ttfa"):
+                    if stats[k] is not None: METRICS.observe(f"ai_{k}_seconds", stats[k])
+        if log.isEnabledFor(logging.DEBUG):
+            fmt = lambda v: f"{v*1000:.0f}ms" if v is not None else "n/a"
+            log.debug("AI stream: TTFT=%s TTFA=%s total=%s sentences=%d%s", fmt(stats["ttft"]), fmt(stats["ttfa"]), fmt(stats["total"]), stats["sentences"],
+                      f" (speculative, {fmt(stats['speculative_saved'])} saved)" if speculation else "")
 
     def _clean_query_for_builtin(self, query):
-        cleaned = re.sub(r'^\s*shiva\b', '', query, flags=re.IGNORECASE).strip()
-        cleaned = re.sub(r'\b(please|can you|could you|tell me|what is|who is|open|play|start|show|display|search|set|get me|find)\b', '', cleaned, flags=re.IGNORECASE).strip()
-        cleaned = re.sub(r'\s+', ' ', cleaned).strip()
+        cleaned = _WAKE_PREFIX_RE.sub('', query).strip()
+        cleaned = _FILLER_WORDS_RE.sub('', cleaned).strip()
+        cleaned = _WHITESPACE_RE.sub(' ', cleaned).strip()
         return cleaned
 
     async def tell_time(self): await self.speak(f"Time is {datetime.datetime.now().strftime('%I:%M %p')}.")
@@ -152,28 +1963,61 @@ class Shiva:
         if not url.startswith("http"): url = "https://" + url;
         try: webbrowser.open(url); await self.speak(f"Opening {name}")
         except Exception as e: await self.speak(f"Couldn't open {name}. Error: {e}")
-    async def play_music(self, music_dir=DEFAULT_MUSIC_FOLDER):
+    _MEDIA_FILLER_RE = re.compile(r"\b(shiva|please|play|open|start|show|some|me|my|the|a|song|songs|music|track|video|movie|pdf|file|document|word|doc|called|named|by)\b", re.IGNORECASE)
+    def _media_title_query(self, raw_query): return _WHITESPACE_RE.sub(' ', self._MEDIA_FILLER_RE.sub(' ', raw_query)).strip()
+    async def play_music(self, raw_query="", music_dir=DEFAULT_MUSIC_FOLDER):
+        """ "play believer" plays the best index match; plain "play music" plays a random indexed song. """
         try:
-            if not os.path.isdir(music_dir): await self.speak(f"Music dir not found: {music_dir}"); return
-            songs=os.listdir(music_dir); music_files=[s for s in songs if s.lower().endswith(('.mp3','.wav','.ogg','.flac','.m4a','.aac','.wma'))]
-            if music_files:
-                import random; song=random.choice(music_files); file=os.path.join(music_dir,song); name=os.path.splitext(song)[0];
-                speak_name=re.sub(r'[_\-.]',' ',name).strip(); speak_name=re.sub(r'\[.*?\]|\(.*?\)|[\d\W]+$','',speak_name).strip(); speak_name=re.sub(r'\s+',' ',speak_name).strip();
-                if len(speak_name)>50: speak_name=speak_name[:50]+"..."
-                if not speak_name: speak_name="a song"
-                print(f"Playing: {file}"); os.startfile(file); await self.speak(f"Playing {speak_name}.")
-            else: await self.speak("No music found.")
+            title = self._media_title_query(raw_query); file = None
+            if self.media_index:
+                if title:
+                    matches = self.media_index.search(title, kind="music", limit=1)
+                    if not matches: await self.speak(self._media_miss(f"{title} in your music")); return
+                    file = matches[0][1]
+                else:
+                    pick = self.media_index.random("music"); file = pick[0] if pick else None
+            if not file: # Index disabled or still empty: list the default folder
+                if not os.path.isdir(music_dir): await self.speak(f"Music dir not found: {music_dir}"); return
+                music_files=[s for s in os.listdir(music_dir) if s.lower().endswith(tuple('.'+ext for ext in MEDIA_KINDS["music"]))]
+                if not music_files: await self.speak("No music found."); return
+                file=os.path.join(music_dir,random.choice(music_files))
+            print(f"Playing: {file}"); os.startfile(file); await self.speak(f"Playing {speakable_title(file) or 'a song'}.")
         except Exception as e: print(f"Music error: {e}"); await self.speak("Error playing music.")
+    def _media_miss(self, what):
+        if self.media_index and self.media_index.building: return f"I'm still indexing your media, so I couldn't find {what} yet."
+        return f"I couldn't find {what}."
+    async def play_media(self, raw_query):
+        """ "play <title>" without saying music/video: best match across songs and videos. """
+        title = self._media_title_query(raw_query)
+        if not title or not self.media_index: return await self.play_music(raw_query)
+        matches = self.media_index.search(title, kind="music", limit=1) + self.media_index.search(title, kind="video", limit=1)
+        if not matches: await self.speak(self._media_miss(title)); return
+        score, file, name, kind = max(matches)
+        try: print(f"Playing {kind}: {file} (match {score:.2f})"); os.startfile(file); await self.speak(f"Playing {speakable_title(file) or name}.")
+        except Exception as e: print(f"Media error: {e}"); await self.speak(f"Couldn't play {name}.")
+    async def _speak_sentences(self, text):
+        """ Queues text one sentence per utterance right away (behind anything still playing) and awaits the last. """
+        utterances = [await self.speak(sentence, wait=False) for sentence in _split_for_speech(text)]
+        return all([await asyncio.wrap_future(u.future) for u in utterances])
     async def search_wikipedia(self, search_term):
+        """ The lookup starts before "Searching Wikipedia for ..." is spoken, so the request overlaps the announcement,
+            and the summary sentences are queued right behind it. Cancelling the command cancels the request. """
         if not search_term: await self.speak("What topic for Wikipedia?"); return
+        results = self.cache.get("wikipedia", search_term)
+        if results: await self._speak_sentences(f"Wikipedia says: {results}"); return
+        t0 = time.perf_counter(); lookup = asyncio.ensure_future(self.wiki.summary(search_term))
         try:
-            await self.speak(f"Searching Wikipedia for {search_term}..."); wikipedia.set_lang("en");
-            results = wikipedia.summary(search_term, sentences=3, auto_suggest=True, redirect=True)
-            await self.speak(f"Wikipedia says: {results}")
-        except wikipedia.exceptions.PageError: await self.speak(f"No Wikipedia page for '{search_term}'.")
-        except wikipedia.exceptions.DisambiguationError as e: options=e.options[:3]; await self.speak(f"'{search_term}' could mean: {', '.join(options)}. Be specific?")
-        except wikipedia.exceptions.WikipediaException as we: print(f"Wiki error: {we}"); await self.speak(f"Issue searching Wiki: {we}")
+            announcement = await self.speak(f"Searching Wikipedia for {search_term}...", wait=False)
+            title, results = await lookup; fetched = time.perf_counter() - t0
+            log.debug("Wikipedia: '%s' in %.0fms%s", title, fetched * 1000, " (while announcing)" if not announcement.future.done() else "")
+            self.cache.put("wikipedia", search_term, results, fetched)
+            await self._speak_sentences(f"Wikipedia says: {results}")
+        except WikipediaPageError: await self.speak(f"No Wikipedia page for '{search_term}'.")
+        except WikipediaDisambiguation as e: await self.speak(f"'{search_term}' could mean: {', '.join(e.options[:3]) or e.title}. Be specific?")
+        except WikipediaError as we: print(f"Wiki error: {we}"); await self.speak(f"Issue searching Wiki: {we}")
+        except (OSError, asyncio.TimeoutError) as e: print(f"Wiki network error: {e!r}"); await self.speak("I couldn't reach Wikipedia.")
         except Exception as e: print(f"Wiki search error: {e}"); await self.speak("Error searching Wikipedia.")
+        finally: lookup.cancel()
     async def open_application(self, app_alias):
         app_map = {"notepad": "notepad.exe", "calculator": "calc.exe", "paint": "mspaint.exe", "command prompt": "cmd.exe", }
         app_to_open = app_map.get(app_alias.lower(), app_alias)
@@ -182,13 +2026,19 @@ class Shiva:
             speak_name=os.path.basename(app_to_open).replace('.exe','').replace('_',' '); await self.speak(f"Opening {speak_name}.")
         except FileNotFoundError: await self.speak(f"App not found '{app_to_open}'.")
         except Exception as e: await self.speak(f"Couldn't open app. Error: {e}")
-    async def find_and_open_file(self, file_type, extensions, default_path, raw_query):
+    async def find_and_open_file(self, file_type, extensions, default_path, raw_query, kind=None):
+        """ Opens an explicit path from the query, else the best media-index match for the spoken name, else default_path. """
         path_match = re.search(r'((?:[a-zA-Z]:\\|\/)[^\s]+\.(?:' + '|'.join(extensions) + '))', raw_query, re.IGNORECASE)
         file_path = None;
         if path_match:
             extracted=path_match.group(1); print(f"Path extracted: {extracted}");
             if os.path.exists(extracted): file_path=extracted
             else: await self.speak(f"Specified {file_type} path doesn't exist. Trying default.")
+        title = self._media_title_query(raw_query) if not path_match else ""
+        if not file_path and title and kind and self.media_index:
+            matches = self.media_index.search(title, kind=kind, limit=1)
+            if matches: file_path = matches[0][1]; print(f"Index match for '{title}': {file_path} ({matches[0][0]:.2f})")
+            else: await self.speak(f"{self._media_miss(f'a {file_type} called {title}')} Trying default.")
         if not file_path:
              if default_path and os.path.exists(default_path): file_path=default_path; print(f"Using default {file_type}: {file_path}")
              else: await self.speak(f"Default {file_type} path invalid/not set."); return
@@ -196,191 +2046,741 @@ class Shiva:
             try: print(f"Opening {file_type}: {file_path}"); os.startfile(file_path); await self.speak(f"Opening the {file_type} file.")
             except Exception as e: await self.speak(f"Couldn't open {file_type}. Error: {e}")
         elif file_path: await self.speak(f"File ({os.path.basename(file_path)}) not a valid {file_type}.")
-    async def open_pdf_file(self, raw_query): await self.find_and_open_file("PDF", ["pdf"], DEFAULT_PDF_PATH, raw_query)
-    async def open_word_document(self, raw_query): await self.find_and_open_file("Word document", ["docx", "doc"], DEFAULT_WORD_PATH, raw_query)
-    async def open_video_file(self, raw_query): await self.find_and_open_file("video", ["mp4", "avi", "mov", "mkv", "wmv"], DEFAULT_VIDEO_PATH, raw_query)
+    async def open_pdf_file(self, raw_query): await self.find_and_open_file("PDF", ["pdf"], DEFAULT_PDF_PATH, raw_query, kind="pdf")
+    async def open_word_document(self, raw_query): await self.find_and_open_file("Word document", ["docx", "doc"], DEFAULT_WORD_PATH, raw_query, kind="word")
+    async def open_video_file(self, raw_query): await self.find_and_open_file("video", ["mp4", "avi", "mov", "mkv", "wmv"], DEFAULT_VIDEO_PATH, raw_query, kind="video")
+    _DURATION_RE = re.compile(r'\b(\d+(?:\.\d+)?|an?|one)\s*(hours?|hrs?|minutes?|mins?|seconds?|secs?)\b', re.IGNORECASE)
+    _DURATIONS = r'(?:\d+(?:\.\d+)?|an?|one)\s*(?:hours?|hrs?|minutes?|mins?|seconds?|secs?)\b(?:\s*,?\s*(?:and\s+)?(?:\d+(?:\.\d+)?|an?|one)\s*(?:hours?|hrs?|minutes?|mins?|seconds?|secs?)\b)*'
+    _DURATION_TAIL_RE = re.compile(r'\s*\b(?:in|after|for)\s+(' + _DURATIONS + r')(?:\s+from now)?(?:\s+please)?[\s.!?]*$', re.IGNORECASE) # "... in 1 hour 30 minutes"
+    _DURATION_LEAD_RE = re.compile(r'^(?:in|after)\s+' + _DURATIONS + r'\s*,?\s*', re.IGNORECASE) # "remind me in 10 minutes to ..."
+    _REMINDER_TEXT_RE = re.compile(r'\bremind me\b|\breminders?\s+(?:to|about|that)\b', re.IGNORECASE)
+    def _parse_duration(self, raw_query):
+        """ Seconds in the trailing "in/after/for <n> <unit> ..." clause ("in 1 hour 30 minutes" -> 5400), so durations
+            inside reminder text do not count; without one, sums the numeric "<n> <unit>"s in the query ("a/an <unit>"
+            only when there is nothing more specific). None when there is no duration. """
+        tail = self._DURATION_TAIL_RE.search(raw_query); found = self._DURATION_RE.findall(tail.group(1) if tail else raw_query)
+        if not tail: found = [f for f in found if f[0].lower() not in ("a", "an")] or found
+        total = None
+        for value, unit in found:
+            n = 1.0 if value.lower() in ("a", "an", "one") else float(value); unit = unit.lower()
+            total = (total or 0) + n * (3600 if unit.startswith("h") else 60 if unit.startswith("m") else 1)
+        return total
+    async def timer_command(self, raw_query):
+        """ One entry point for timers and reminders: set ("timer 5 minutes", "remind me to call mom in 10 minutes"),
+            list ("what timers do I have"), cancel ("cancel the 5 minute timer", "cancel all timers"). The action is read
+            from the command words before any reminder text, so "remind me to stop the oven ..." sets a reminder. """
+        reminder = self._REMINDER_TEXT_RE.search(raw_query)
+        words = set(re.findall(r"[a-z]+", (raw_query[:reminder.start()] if reminder else raw_query).lower()))
+        if words & {"cancel", "stop", "delete", "remove", "clear"}: return await self.cancel_timer(raw_query)
+        if words & {"list", "what", "which", "show", "many", "left", "remaining", "pending"}: return await self.list_timers()
+        if reminder is None and words & {"timers", "reminders"} and self._parse_duration(raw_query) is None: return await self.list_timers()
+        await self.set_timer(raw_query)
     async def set_timer(self, raw_query):
         try:
-            match = re.search(r'(\d+(\.\d+)?)\s*(minute|min|second|sec|hour|hr)s?', raw_query, re.IGNORECASE)
-            if not match: await self.speak("Specify duration like 'timer 5 minutes'."); return
-            value=float(match.group(1)); unit=match.group(3).lower(); duration=0;
-            if "min" in unit: duration=value*60
-            elif "sec" in unit: duration=value
-            elif "hr" in unit or "hour" in unit: duration=value*3600
-            else: await self.speak("Invalid time unit."); return
+            duration = self._parse_duration(raw_query)
+            if duration is None: await self.speak("Specify duration like 'timer 5 minutes'."); return
             if duration<=0: await self.speak("Duration must be positive."); return
-            if duration>=3600: speak_dur=f"{value} hour{'s' if value!=1 else ''}"
-            elif duration>=60: speak_dur=f"{value} minute{'s' if value!=1 else ''}"
-            else: speak_dur=f"{value} second{'s' if value!=1 else ''}"
-            await self.speak(f"Timer set: {speak_dur}."); threading.Thread(target=self.timer_thread, args=(duration, speak_dur), daemon=True).start()
+            label = ""; verb = "to"; match = re.search(r'\bremind(?:er)? (?:me )?(.+)$', raw_query, re.IGNORECASE)
+            if match:
+                text = self._DURATION_TAIL_RE.sub('', match.group(1)); text = self._DURATION_LEAD_RE.sub('', text.strip()) # Only the timer's own duration clauses are dropped
+                if not re.match(r'to\s', text, re.IGNORECASE): verb = "about"
+                label = _WHITESPACE_RE.sub(' ', re.sub(r'^(?:(?:to|about|that)\s+)', '', text, flags=re.IGNORECASE)).strip()
+            self.timers.start(); timer = self.timers.add(duration, label); print(f"Timer {timer.id} set: {timer.describe()} ({duration}s).")
+            await self.speak(f"Okay, I'll remind you {verb} {label} in {speak_duration(duration)}." if label else f"Timer set: {speak_duration(duration)}.")
         except ValueError: await self.speak("Didn't understand duration.")
         except Exception as e: print(f"Timer error: {e}"); await self.speak("Error setting timer.")
-    def timer_thread(self, duration_seconds, speak_duration):
-        print(f"Timer started: {speak_duration} ({duration_seconds}s)."); time.sleep(duration_seconds); print(f"Timer finished: {speak_duration}");
-        try:
-            loop = asyncio.get_running_loop()
-            loop.call_soon_threadsafe(asyncio.create_task, self.speak(f"Time's up! Your {speak_duration} timer is done."))
-        except RuntimeError:
-            print("Timer alert: Event loop not running. Trying synchronous speak.")
-            try: self.engine.say(f"Time's up! Your {speak_duration} timer is done."); self.engine.runAndWait()
-            except Exception as speak_e: print(f"Fallback timer speak error: {speak_e}")
-        except Exception as e: print(f"Error scheduling timer alert: {e}")
+    async def list_timers(self):
+        pending = self.timers.pending()
+        if not pending: await self.speak("You have no timers running."); return
+        items = "; ".join(f"{t.describe()}, {speak_duration(self.timers.remaining(t))} left" for t in pending[:5])
+        more = f", and {len(pending) - 5} more" if len(pending) > 5 else ""
+        await self.speak(f"You have {len(pending)} timer{'s' if len(pending) != 1 else ''}: {items}{more}.")
+    async def cancel_timer(self, raw_query):
+        """ Cancels all timers, the ones matching a spoken duration or reminder text, or the only one. """
+        pending = self.timers.pending()
+        if not pending: await self.speak("There are no timers to cancel."); return
+        duration = self._parse_duration(raw_query); lowered = raw_query.lower()
+        if re.search(r'\ball\b|\bevery', lowered): targets = pending
+        elif duration is not None: targets = [t for t in pending if abs(t.duration - duration) < 1]
+        else: targets = [t for t in pending if t.label and t.label.lower() in lowered] or (pending if len(pending) == 1 else [])
+        if not targets:
+            if duration is None and len(pending) > 1: await self.speak(f"You have {len(pending)} timers. Which one? Say the duration, or cancel all timers."); return
+            await self.speak("I couldn't find that timer."); return
+        for t in targets: self.timers.cancel(t.id)
+        await self.speak(f"Cancelled your {targets[0].describe()}." if len(targets) == 1 else f"Cancelled {len(targets)} timers.")
+    def _timer_fired(self, timer, late_by):
+        """ Scheduler callback (event loop thread): alerts through the speech worker, preempting other chatter. """
+        print(f"Timer finished: {timer.describe()} (late by {late_by:.2f}s)")
+        if timer.label: text = f"Reminder: {timer.label}."
+        else: text = f"Time's up! Your {speak_duration(timer.duration)} timer is done."
+        if late_by > 60: text = f"While I was away, your {timer.describe()} finished."
+        self.speech.submit(text, PRIORITY_URGENT)
+
+    # --- Built-in intent handlers (registered in BUILTIN_INTENTS below) ---
+    async def _intent_exit(self, raw_query):
+        global root_window_ref
+        await self.speak("Goodbye! Shutting down.")
+        self.stop_event.set()
+        if self.stop_event is stop_voice_loop and root_window_ref and root_window_ref.winfo_exists():
+             log.debug("Scheduling window close."); root_window_ref.after(50, on_close)
+    async def _intent_open_website(self, raw_query):
+        url_part = re.sub(r'^(shiva\s)?open\s+(website|site)\s*', '', raw_query, flags=re.IGNORECASE).strip()
+        if url_part and '.' in url_part and ' ' not in url_part: await self.open_website(url_part, url_part)
+        else: await self.speak("Which website?")
+    async def _intent_wikipedia(self, raw_query):
+        search_term = re.sub(r"^(?:for|about|on)\s+", "", self._clean_query_for_builtin(raw_query).lower().replace("wikipedia", "").strip()); await self.search_wikipedia(search_term)
+    async def _intent_weather(self, raw_query): # Uses AI internally
+        city = "your location"; match = re.search(r'weather in\s+(.+)', raw_query, re.IGNORECASE)
+        if match: city = match.group(1).strip()
+        weather_query = f"Briefly, what is the current weather in {city}?"; log.debug("AI query for weather: %r", weather_query)
+        await self.speak_ai_answer(weather_query, cache_source="weather")
+    async def _intent_fact(self, raw_query): # Uses AI internally
+        log.debug("AI query for fact.")
+        await self.speak_ai_answer("Tell me an interesting short fun fact.", cache_source="fact")
+    async def _intent_interrupt(self, raw_query):
+        """ "stop" / "cancel": silences Shiva and cancels in-flight work (the pipeline also handles this inline). """
+        self.speech.barge_in(keep_priority=-1)
+        if self.pipeline: self.pipeline.cancel_inflight()
+    async def _intent_new_conversation(self, raw_query):
+        if self.memory: self.memory.reset()
+        await self.speak("Okay, starting a new conversation.")
+    async def _intent_pause(self, raw_query):
+        await self.speak("Pausing for 30 seconds."); await asyncio.sleep(30); await self.speak("Listening again.")
 
     # --- PROCESS COMMAND (Implicit AI Fallback Logic) ---
     async def process_command(self, raw_query):
         """ Processes voice commands, prioritizing built-ins, then falling back to AI. """
-        global root_window_ref
         if not raw_query or raw_query == "none": return
+        log.debug("Processing raw query: %r", raw_query)
+        speculation = self._take_speculation(raw_query) # AI answer already started on the partial transcript, if any
+        try:
+            # --- 1./2. Exit + Built-in Commands (single pass over INTENT_ROUTER) ---
+            with METRICS.span("stage_seconds", stage="routing"): intent = INTENT_ROUTER.route(raw_query)
+            if intent:
+                if speculation: self._discard_speculation(f"built-in '{intent.name}' won", speculation)
+                log.debug("Matched built-in: %s", intent.name); METRICS.inc("commands_total", intent=intent.name)
+                with METRICS.span("handler_seconds", intent=intent.name): await intent.handler(self, raw_query)
+                return
 
-        l_raw_query = raw_query.lower()
-        print(f"DEBUG: ---> Processing Raw Query: '{raw_query}' <---") # DEBUG
-        command_handled = False
-
-        # --- 1. Check for Exit Command ---
-        if any(p in l_raw_query for p in ["stop listening", "stop now", "exit", "quit", "shutdown", "goodbye", "bye", "stop shiva"]):
-             print("DEBUG: Exit command detected.") # DEBUG
-             await self.speak("Goodbye! Shutting down.")
-             stop_voice_loop.set()
-             if root_window_ref and root_window_ref.winfo_exists():
-                  print("DEBUG: Scheduling window close."); root_window_ref.after(50, on_close) # DEBUG
-             return # Exit command takes precedence
-
-        # --- 2. Check for Built-in Commands ---
-        cleaned_for_builtin = self._clean_query_for_builtin(raw_query)
-        print(f"DEBUG: Cleaned query for built-in check: '{cleaned_for_builtin}'") # DEBUG
-
-        # Using elif chain for built-ins
-        if "how are you" in cleaned_for_builtin: print("DEBUG: Matched built-in: how are you"); await self.speak("I am operational!"); command_handled = True # DEBUG
-        elif "your name" in cleaned_for_builtin: print("DEBUG: Matched built-in: your name"); await self.speak(f"My name is {self.name}."); command_handled = True # DEBUG
-        elif any(p in cleaned_for_builtin for p in ["who created you", "developer"]): print("DEBUG: Matched built-in: creator"); await self.speak("I was developed by Shyam Yadav."); command_handled = True # DEBUG
-        elif any(p in cleaned_for_builtin for p in ["time"]): print("DEBUG: Matched built-in: time"); await self.tell_time(); command_handled = True # DEBUG
-        elif any(p in cleaned_for_builtin for p in ["date"]): print("DEBUG: Matched built-in: date"); await self.tell_date(); command_handled = True # DEBUG
-        elif "youtube" in cleaned_for_builtin: print("DEBUG: Matched built-in: youtube"); await self.open_website("https://www.youtube.com", "YouTube"); command_handled = True # DEBUG
-        elif "google" in cleaned_for_builtin: print("DEBUG: Matched built-in: google"); await self.open_website("https://www.google.com", "Google"); command_handled = True # DEBUG
-        elif l_raw_query.startswith(("open website", "shiva open website")): # Check raw query prefix for this specific one
-             print("DEBUG: Matched built-in prefix: open website"); url_part = re.sub(r'^(shiva\s)?open\s+(website|site)\s*', '', raw_query, flags=re.IGNORECASE).strip() # DEBUG
-             if url_part and '.' in url_part and ' ' not in url_part: await self.open_website(url_part, url_part)
-             else: await self.speak("Which website?")
-             command_handled = True # Set handled=True whether it opened or asked "which"
-        elif any(p in cleaned_for_builtin for p in ["music", "song"]): print("DEBUG: Matched built-in: music"); await self.play_music(); command_handled = True # DEBUG
-        elif any(p in cleaned_for_builtin for p in ["video"]): print("DEBUG: Matched built-in: video"); await self.open_video_file(raw_query); command_handled = True # DEBUG
-        elif "pdf" in cleaned_for_builtin: print("DEBUG: Matched built-in: pdf"); await self.open_pdf_file(raw_query); command_handled = True # DEBUG
-        elif any(p in cleaned_for_builtin for p in ["word document", "word doc", "word file"]): print("DEBUG: Matched built-in: word"); await self.open_word_document(raw_query); command_handled = True # DEBUG
-        elif "notepad" in cleaned_for_builtin: print("DEBUG: Matched built-in: notepad"); await self.open_application("notepad"); command_handled = True # DEBUG
-        elif "calculator" in cleaned_for_builtin: print("DEBUG: Matched built-in: calculator"); await self.open_application("calculator"); command_handled = True # DEBUG
-        elif "paint" in cleaned_for_builtin: print("DEBUG: Matched built-in: paint"); await self.open_application("paint"); command_handled = True # DEBUG
-        elif "command prompt" in cleaned_for_builtin: print("DEBUG: Matched built-in: cmd"); await self.open_application("command prompt"); command_handled = True # DEBUG
-        elif "wikipedia" in cleaned_for_builtin:
-            print("DEBUG: Matched built-in: wikipedia"); search_term = cleaned_for_builtin.replace("wikipedia", "").strip(); await self.search_wikipedia(search_term); command_handled = True # DEBUG
-        elif "weather" in cleaned_for_builtin: # Uses AI internally
-            print("DEBUG: Matched built-in: weather"); city = "your location"; match = re.search(r'weather in\s+(.+)', raw_query, re.IGNORECASE); # DEBUG
-            if match: city = match.group(1).strip()
-            weather_query = f"Briefly, what is the current weather in {city}?"; print("DEBUG: AI Query for weather...") # DEBUG
-            info = await self.ask_google_ai(weather_query); await self.speak(info); command_handled = True
-        elif any(p in cleaned_for_builtin for p in ["fun fact", "fact"]): # Uses AI internally
-             print("DEBUG: Matched built-in: fact"); print("DEBUG: AI Query for fact...") # DEBUG
-             fact = await self.ask_google_ai("Tell me an interesting short fun fact."); await self.speak(fact); command_handled = True
-        elif "timer" in cleaned_for_builtin: print("DEBUG: Matched built-in: timer"); await self.set_timer(raw_query); command_handled = True # DEBUG
-        elif "send email" in cleaned_for_builtin: print("DEBUG: Matched built-in: email"); await self.speak("Sorry, I cannot send emails."); command_handled = True # DEBUG
-        elif any(p in cleaned_for_builtin for p in ["hold on", "wait", "pause"]):
-             print("DEBUG: Matched built-in: pause"); await self.speak("Pausing for 30 seconds."); await asyncio.sleep(30); await self.speak("Listening again."); command_handled = True # DEBUG
-
-        # --- 3. IMPLICIT AI Fallback (if no built-in command was handled) ---
-        if not command_handled:
-            print("DEBUG: No built-in match found. Attempting AI fallback.") # DEBUG
-            # Check if AI is available before calling
-            if self.genai_model:
-                # Use the raw query for the AI, as cleaning might remove context
-                ai_question = raw_query
-                print(f"DEBUG: Sending to AI (Fallback): '{ai_question}'") # DEBUG
-                # Optional: Add a brief lead-in phrase
-                # await self.speak("Let me check that...")
-                answer = await self.ask_google_ai(ai_question)
-                await self.speak(answer)
-            else:
-                # AI is not available (config or model load failed)
-                print("DEBUG: AI fallback attempted, but AI model not loaded.") # DEBUG
-                await self.speak("Sorry, I didn't understand that command, and my AI helper is unavailable.")
-            # Fallback case is always considered "handled" now, even if AI is unavailable
-            command_handled = True
-
-        # --- Redundant Fallback - Can be removed if above handled=True is set ---
-        # if not command_handled: # This should ideally not be reached anymore
-        #    print(f"DEBUG: Command fell through all checks: '{raw_query}'") # DEBUG
-        #    await self.speak("Sorry, I couldn't process that command.")
-
+            # --- 3. IMPLICIT AI Fallback (no built-in matched) ---
+            METRICS.inc("commands_total", intent="ai_fallback")
+            with METRICS.span("handler_seconds", intent="ai_fallback"):
+                if await self._ensure_ai_model():
+                    log.debug("No built-in match; sending to AI: %r", raw_query) # Raw query: cleaning might remove context
+                    await self.speak_ai_answer(raw_query, conversation=True, speculation=speculation)
+                else:
+                    log.debug("AI fallback attempted, but AI model not loaded.")
+                    await self.speak("Sorry, I didn't understand that command, and my AI helper is unavailable.")
+        finally:
+            if speculation: self._discard_speculation("not used", speculation) # No-op once adopted
 
     async def greet(self): # Neutral greeting
         hour=datetime.datetime.now().hour; greet="Good morning!" if 0<=hour<12 else "Good afternoon!" if 12<=hour<18 else "Good evening!"
         await self.speak(f"{greet} This is Shiva. How may I assist?")
 
+# --- Built-in intent registry (order == priority; exit first) ---
+BUILTIN_INTENTS = [
+    Intent("exit", ["stop listening", "stop now", "exit", "quit", "shutdown", "goodbye", "bye", "stop shiva"], Shiva._intent_exit),
+    Intent("timer", ["timer", "timers", "remind me", "reminder", "reminders"], lambda s, q: s.timer_command(q)), # Before "interrupt" so "cancel the timer" is a timer command
+    Intent("interrupt", ["stop", "cancel", "never mind", "nevermind", "be quiet", "shut up"], Shiva._intent_interrupt, prefix=True),
+    Intent("how are you", ["how are you"], lambda s, q: s.speak("I am operational!")),
+    Intent("your name", ["your name"], lambda s, q: s.speak(f"My name is {s.name}.")),
+    Intent("creator", ["who created you", "developer"], lambda s, q: s.speak("I was developed by Shyam Yadav.")),
+    Intent("time", ["time"], lambda s, q: s.tell_time()),
+    Intent("date", ["date"], lambda s, q: s.tell_date()),
+    Intent("youtube", ["youtube"], lambda s, q: s.open_website("https://www.youtube.com", "YouTube")),
+    Intent("google", ["google"], lambda s, q: s.open_website("https://www.google.com", "Google")),
+    Intent("open website", ["open website", "open site"], Shiva._intent_open_website, prefix=True),
+    Intent("music", ["music", "song", "songs"], lambda s, q: s.play_music(q)),
+    Intent("video", ["video", "videos"], lambda s, q: s.open_video_file(q)),
+    Intent("pdf", ["pdf", "pdfs"], lambda s, q: s.open_pdf_file(q)),
+    Intent("word", ["word document", "word documents", "word doc", "word docs", "word file", "word files"], lambda s, q: s.open_word_document(q)),
+    Intent("play", ["play"], lambda s, q: s.play_media(q), prefix=True),
+    Intent("notepad", ["notepad"], lambda s, q: s.open_application("notepad")),
+    Intent("calculator", ["calculator"], lambda s, q: s.open_application("calculator")),
+    Intent("paint", ["paint"], lambda s, q: s.open_application("paint")),
+    Intent("cmd", ["command prompt"], lambda s, q: s.open_application("command prompt")),
+    Intent("wikipedia", ["wikipedia"], Shiva._intent_wikipedia),
+    Intent("weather", ["weather"], Shiva._intent_weather),
+    Intent("fact", ["fun fact", "fun facts", "fact", "facts"], Shiva._intent_fact),
+    Intent("email", ["send email"], lambda s, q: s.speak("Sorry, I cannot send emails.")),
+    Intent("pause", ["hold on", "wait", "pause"], Shiva._intent_pause),
+    Intent("new conversation", ["new conversation", "start over", "forget our conversation", "forget that"], Shiva._intent_new_conversation),
+]
+INTENT_ROUTER = IntentRouter(BUILTIN_INTENTS)
+
+# ===============================================
+# Command Pipeline: listen while processing (capture -> recognize -> dispatch)
+# ===============================================
+class StageStats:
+    """ Per-stage counters: items processed, queue depth (now / peak), queue wait and service time samples. """
+    def __init__(self, name, queue=None, keep=1000):
+        self.name = name; self.queue = queue; self.processed = 0; self.max_depth = 0
+        self.waits = deque(maxlen=keep); self.service = deque(maxlen=keep)
+    def enqueued(self):
+        if self.queue is not None: self.max_depth = max(self.max_depth, self.queue.qsize())
+    def record(self, wait, service): self.processed += 1; self.waits.append(wait); self.service.append(service)
+    def snapshot(self):
+        return {"processed": self.processed, "depth": self.queue.qsize() if self.queue is not None else 0, "max_depth": self.max_depth,
+                "wait_p50_ms": percentile(self.waits, 50) * 1000, "wait_p95_ms": percentile(self.waits, 95) * 1000,
+                "service_p50_ms": percentile(self.service, 50) * 1000, "service_p95_ms": percentile(self.service, 95) * 1000}
+
+class StopEvent(threading.Event):
+    """ A threading.Event that coroutines can also await (wait_async) without polling: set() from any thread wakes
+        them through their loop's call_soon_threadsafe. """
+    def __init__(self): super().__init__(); self._waiters = []; self._waiters_lock = threading.Lock()
+    def set(self):
+        super().set()
+        with self._waiters_lock: waiters, self._waiters = self._waiters, []
+        for loop, fut in waiters:
+            try: loop.call_soon_threadsafe(lambda f=fut: f.done() or f.set_result(None))
+            except RuntimeError: pass # That loop is already closed
+    async def wait_async(self):
+        if self.is_set(): return
+        waiter = (asyncio.get_running_loop(), asyncio.get_running_loop().create_future())
+        with self._waiters_lock: self._waiters.append(waiter)
+        try:
+            if not self.is_set(): await waiter[1] # Re-checked after registering, so a set() in between is not missed
+        finally:
+            with self._waiters_lock:
+                if waiter in self._waiters: self._waiters.remove(waiter)
+
+class ScriptedInput:
+    """ Headless command source for the pipeline: a list of transcripts, or (delay_seconds, transcript) pairs,
+        emitted as if recognized; the pipeline finishes once the script is exhausted and in-flight work is done. """
+    def __init__(self, commands, interval=0.0):
+        self._items = deque((c if isinstance(c, tuple) else (interval, c)) for c in commands)
+    async def next(self):
+        if not self._items: return None
+        delay, text = self._items.popleft()
+        if delay: await asyncio.sleep(delay)
+        return text
+
+class CommandPipeline:
+    """ Long-lived asyncio pipeline replacing the serial listen -> process loop:
+          capture    -> audio_q   (front-end segments, legacy listen() text, or ScriptedInput text)
+          recognize  -> command_q (speech-to-text)
+          dispatch   -> handler tasks (built-in intent or AI fallback), cancellable
+        Capture keeps running while handlers wait on Gemini/Wikipedia/sleep, so "stop" is heard mid-answer.
+        A new command supersedes in-flight work and speech (supersede=False lets them overlap, e.g. for batch replay);
+        "stop"/"cancel" cancels it outright.
+        Runs until stop_event is set or the input is exhausted (a StopEvent is awaited; a plain threading.Event is polled);
+        stats() reports per-stage depth and latency.
+        on_command_done(query, outcome) is called as each command finishes: "done", "cancelled", "error" or "interrupt". """
+    def __init__(self, shiva, script=None, stop_event=None, audio_queue=2, command_queue=4, supersede=True, on_command_done=None):
+        self.shiva = shiva; self.script = script; self.stop_event = stop_event or StopEvent(); self.supersede = supersede; self.on_command_done = on_command_done
+        self.audio_q = asyncio.Queue(maxsize=audio_queue); self.command_q = asyncio.Queue(maxsize=command_queue)
+        self.capture_stats = StageStats("capture", self.audio_q); self.recognize_stats = StageStats("recognize", self.command_q); self.dispatch_stats = StageStats("dispatch")
+        self.inflight = set(); self.cancelled = 0; self.handled = []
+
+    async def _next_input(self):
+        """ Returns the next captured item (str or SpeechSegment), "none" for nothing heard, None when the input is exhausted. """
+        if self.script is not None: return await self.script.next()
+        frontend = self.shiva.audio_frontend
+        if frontend is None: return await self.shiva.take_command() # Legacy listen(): capture + recognition in one step
+        segment = await frontend.next_segment(timeout=0.5)
+        if segment is None: return None if frontend.finished.is_set() else "none"
+        return segment
+    async def _capture(self):
+        await self.shiva.wait_until_ready(mic=self.script is None)
+        if self.script is None and not STARTUP._reported: STARTUP.mark("first listen"); STARTUP.report()
+        try:
+            while not self.stop_event.is_set():
+                t0 = time.perf_counter(); item = await self._next_input()
+                if item is None: break
+                if item == "none": continue
+                await self.audio_q.put((item, time.perf_counter())); self.capture_stats.enqueued(); self.capture_stats.record(0.0, time.perf_counter() - t0)
+        except asyncio.CancelledError: raise
+        except Exception as e: print(f"Capture error: {e}")
+        await self.audio_q.put(None)
+    async def _recognize(self):
+        while True:
+            entry = await self.audio_q.get()
+            if entry is None: break
+            item, queued_at = entry; t0 = time.perf_counter()
+            query = item if isinstance(item, str) else await self.shiva.recognize_segment(item)
+            self.recognize_stats.record(t0 - queued_at, time.perf_counter() - t0)
+            if query and query != "none": await self.command_q.put((query, time.perf_counter())); self.recognize_stats.enqueued()
+        await self.command_q.put(None)
+    async def _dispatch(self):
+        while True:
+            entry = await self.command_q.get()
+            if entry is None: break
+            query, queued_at = entry; intent = INTENT_ROUTER.route(query)
+            if intent is not None and intent.name == "interrupt":
+                print(f"Interrupt: '{query}' ({len(self.inflight)} task(s) in flight)")
+                self.shiva.speech.barge_in(keep_priority=-1); self.cancel_inflight(); self.dispatch_stats.record(time.perf_counter() - queued_at, 0.0)
+                if self.on_command_done: self.on_command_done(query, "interrupt")
+                continue
+            if self.supersede: self.shiva.speech.barge_in(); self.cancel_inflight() # New command cuts off old chatter and work
+            task = asyncio.ensure_future(self.shiva.process_command(query)); task.started_at = time.perf_counter(); task.queued_at = queued_at; task.query = query
+            self.inflight.add(task); task.add_done_callback(self._handler_done); self.handled.append(query)
+        if self.inflight: await asyncio.gather(*self.inflight, return_exceptions=True)
+    def _handler_done(self, task):
+        self.inflight.discard(task); self.dispatch_stats.record(task.started_at - task.queued_at, time.perf_counter() - task.started_at)
+        outcome = "cancelled" if task.cancelled() else "error" if task.exception() is not None else "done"
+        if outcome == "error": print(f"Command handler error: {task.exception()}")
+        if self.on_command_done: self.on_command_done(task.query, outcome)
+    def cancel_inflight(self):
+        """ Cancels every running handler task (their speech is cut by the caller's barge-in). """
+        for task in list(self.inflight):
+            if not task.done(): task.cancel(); self.cancelled += 1
+    async def _watch_stop(self, stages):
+        if isinstance(self.stop_event, StopEvent): await self.stop_event.wait_async() # No wakeups until stopped (one watcher per server session)
+        else:
+            while not self.stop_event.is_set(): await asyncio.sleep(0.1)
+        for t in stages: t.cancel()
+        self.cancel_inflight()
+
+    async def run(self):
+        """ Runs the stages until stop_event is set or the input is exhausted and all handlers have finished. """
+        self.shiva.pipeline = self
+        self.shiva.timers.start() # Restored timers fire (and new ones are scheduled) on this loop
+        stages = [asyncio.ensure_future(c) for c in (self._capture(), self._recognize(), self._dispatch())]
+        watcher = asyncio.ensure_future(self._watch_stop(stages))
+        try: await asyncio.gather(*stages, return_exceptions=True)
+        finally:
+            watcher.cancel(); self.cancel_inflight()
+            if self.inflight: await asyncio.gather(*self.inflight, return_exceptions=True)
+            self.shiva.pipeline = None; self.shiva.timers.stop()
+        return self.stats()
+    def stats(self):
+        return {"capture": self.capture_stats.snapshot(), "recognize": self.recognize_stats.snapshot(), "dispatch": dict(self.dispatch_stats.snapshot(), inflight=len(self.inflight), cancelled=self.cancelled)}
+
+# ===============================================
+# Server Mode: many clients over WebSocket/HTTP sharing one warm STT model, AI client and cache
+# ===============================================
+def _ws_mask(data, mask):
+    n = len(data)
+    return (int.from_bytes(data, "big") ^ int.from_bytes((mask * (n // 4 + 1))[:n], "big")).to_bytes(n, "big") if n else data
+def _ws_frame(payload, opcode=0x1, mask=None):
+    """ One final WebSocket frame; clients must pass a 4-byte mask, servers send unmasked. """
+    n = len(payload); bit = 0x80 if mask else 0
+    head = struct.pack("!BB", 0x80 | opcode, bit | n) if n < 126 else struct.pack("!BBH", 0x80 | opcode, bit | 126, n) if n < 65536 else struct.pack("!BBQ", 0x80 | opcode, bit | 127, n)
+    return head + mask + _ws_mask(payload, mask) if mask else head + payload
+async def _ws_read_frame(reader, max_size):
+    """ (fin, opcode, payload) of the next WebSocket frame, unmasked. """
+    b1, b2 = await reader.readexactly(2); n = b2 & 0x7F
+    if n == 126: n = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif n == 127: n = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if n > max_size: raise ConnectionError("WebSocket frame too large")
+    mask = await reader.readexactly(4) if b2 & 0x80 else None; data = await reader.readexactly(n)
+    return bool(b1 & 0x80), b1 & 0x0F, _ws_mask(data, mask) if mask else data
+
+class RemoteSpeech:
+    """ SpeechWorker stand-in for a server session: each utterance becomes a {"type": "say"} message for the client
+        to speak (or show), and barge_in() sends {"type": "stop"} if anything was said since the last one. Playback
+        happens on the client, so utterances resolve as soon as they are sent. """
+    def __init__(self, send): self.send = send; self._seq = itertools.count(); self._said = False
+    def submit(self, text, priority=PRIORITY_NORMAL):
+        utt = Utterance(text, priority, next(self._seq))
+        if utt.segments: self.send({"type": "say", "text": text, "priority": priority}); self._said = True
+        utt._resolve(True); return utt
+    def cancel(self, utt): utt.cancelled = True; utt._resolve(False)
+    def barge_in(self, keep_priority=PRIORITY_URGENT):
+        if self._said: self.send({"type": "stop", "keep_priority": keep_priority}); self._said = False
+    def is_speaking(self): return False
+    def shutdown(self, timeout=None): pass
+
+class SessionShiva(Shiva):
+    """ The assistant for one server session. The server's STT backend, AI request manager (one rate-limit budget),
+        response cache and Wikipedia pool are shared; timers, conversation memory and the pipeline are its own (no
+        startup threads, futures or speech_recognition objects per session).
+        Speech goes to the client as messages and websites are sent to it to open; actions that would touch the
+        server's desktop (applications, local files and media) are declined. """
+    DESKTOP_ONLY = "Sorry, I can only do that in the desktop assistant."
+    def __init__(self, session, server):
+        self.session = session; self.server = server
+        super().__init__(genai_model=server.genai_model, calibrate_mic=False, cache=server.cache, stt=server.stt, media_index=False, timers=TimerScheduler(),
+                         ai_manager=server.ai, wiki=server.wiki, speech=RemoteSpeech(session.send), stop_event=session.stop_event)
+    background_startup = False # The server warmed the STT and loaded the AI model once; sessions start nothing of their own
+    async def speak(self, text, priority=PRIORITY_NORMAL, wait=True):
+        if not text: return True
+        log.debug("[%s] Shiva: %.100s", self.session.id, text)
+        utt = self.speech.submit(text, priority)
+        return True if wait else utt
+    async def recognize_segment(self, segment):
+        if not segment.denoised: # Whole-utterance NR off the event loop, so one session's audio does not stall the others
+            segment.audio = await asyncio.get_running_loop().run_in_executor(None, self._reduce_noise, segment.audio); segment.denoised = True
+        query = await super().recognize_segment(segment)
+        self.session.send({"type": "transcript", "text": "" if query == "none" else query})
+        if query == "none": self.session.send({"type": "done", "query": "", "outcome": "unrecognized"})
+        return query
+    async def open_website(self, url, name):
+        if not url.startswith("http"): url = "https://" + url
+        self.session.send({"type": "open_url", "url": url, "name": name}); await self.speak(f"Opening {name}")
+    async def play_music(self, raw_query="", music_dir=None): await self.speak(self.DESKTOP_ONLY)
+    async def play_media(self, raw_query): await self.speak(self.DESKTOP_ONLY)
+    async def open_application(self, app_alias): await self.speak(self.DESKTOP_ONLY)
+    async def find_and_open_file(self, file_type, extensions, default_path, raw_query, kind=None): await self.speak(self.DESKTOP_ONLY)
+
+class ServerSession:
+    """ One client of the server: a SessionShiva driven by its own CommandPipeline, which reads this object as its
+        script. Typed commands and 16-bit mono PCM go in (streamed PCM is cut into utterances by a per-session
+        VADSegmenter); replies come out of outbox as JSON-ready dicts: say, stop, transcript, open_url, done (one per
+        command, with its outcome) and bye. A client that stops reading loses its oldest messages. """
+    def __init__(self, server, id, sample_rate=16000, max_outbox=256):
+        self.server = server; self.id = id; self.sample_rate = sample_rate; self.last_active = time.monotonic(); self.commands = 0; self.task = None
+        self.stop_event = StopEvent(); self.outbox = asyncio.Queue(maxsize=max_outbox); self._inputs = asyncio.Queue(); self._exchange_lock = asyncio.Lock()
+        self.segmenter = None; self._pcm = bytearray(); self.shiva = SessionShiva(self, server)
+    def start(self): self.task = asyncio.ensure_future(self._run()); return self
+    async def _run(self):
+        try: await CommandPipeline(self.shiva, script=self, stop_event=self.stop_event, on_command_done=self._command_done).run()
+        except Exception as e: log.warning("Session %s pipeline error: %s", self.id, e)
+        finally: self.send({"type": "bye"}); self.server._session_ended(self)
+    def _command_done(self, query, outcome): self.commands += 1; self.send({"type": "done", "query": query, "outcome": outcome})
+    def send(self, message):
+        while True:
+            try: self.outbox.put_nowait(message); return
+            except asyncio.QueueFull: self.outbox.get_nowait(); METRICS.inc("server_messages_dropped_total")
+    async def next(self): return await self._inputs.get() # Pipeline script: a query, a SpeechSegment, or None once closed
+
+    def put_text(self, text):
+        """ Queues a typed command; returns it as the pipeline (and its "done" message) will see it. """
+        query = _WHITESPACE_RE.sub(" ", text).strip().lower(); self.last_active = time.monotonic()
+        if query: self._inputs.put_nowait(query)
+        return query
+    def put_segment(self, segment): self.last_active = time.monotonic(); self._inputs.put_nowait(segment)
+    def put_audio(self, pcm, flush=False):
+        """ Feeds streamed PCM through the session's VAD and queues each completed utterance for recognition;
+            flush=True ends one in progress (the client stopped streaming). Returns how many were queued. """
+        self.last_active = time.monotonic()
+        if self.segmenter is None: self.segmenter = VADSegmenter(self.sample_rate)
+        seg = self.segmenter; step = seg.frame_samples * 2; self._pcm += pcm; queued = 0
+        if flush: self._pcm += bytes((-len(self._pcm)) % step + step * seg.hangover_frames) # Trailing silence closes the utterance
+        for i in range(0, len(self._pcm) - step + 1, step):
+            segment = seg.push(bytes(self._pcm[i:i + step]))
+            if segment: self._inputs.put_nowait(segment); queued += 1
+        del self._pcm[:len(self._pcm) - len(self._pcm) % step]
+        return queued
+    async def exchange(self, text=None, segment=None, timeout=SERVER_REQUEST_TIMEOUT):
+        """ HTTP: submits one command (text or a SpeechSegment) and returns the messages up to its "done". """
+        async with self._exchange_lock:
+            expect = self.put_text(text) if text is not None else None
+            if segment is not None: self.put_segment(segment)
+            messages = []; loop = asyncio.get_running_loop(); deadline = loop.time() + timeout
+            while True:
+                try: message = await asyncio.wait_for(self.outbox.get(), deadline - loop.time())
+                except asyncio.TimeoutError: messages.append({"type": "timeout"}); return messages
+                messages.append(message)
+                if message["type"] == "transcript" and expect is None: expect = message["text"]
+                if message["type"] == "bye" or (message["type"] == "done" and message["query"] == expect): return messages
+    def drain(self):
+        messages = []
+        while not self.outbox.empty(): messages.append(self.outbox.get_nowait())
+        return messages
+    def close(self):
+        """ Ends the session: in-flight work is cancelled and its timers are dropped. """
+        self.stop_event.set(); self._inputs.put_nowait(None)
+
+class ShivaServer:
+    """ Serves many assistant sessions from one process on a small asyncio HTTP/1.1 + WebSocket server (stdlib only).
+        Shared by every session: the STT backend (warmed once), the Gemini model and AIRequestManager (one RPM/TPM
+        budget), the response cache, the Wikipedia connection pool and INTENT_ROUTER. Per session (SessionShiva):
+        timers, conversation memory and the command pipeline.
+          GET    /v1/ws?rate=16000          WebSocket. In: text frames {"type": "text", "text": ...}, {"type": "end_audio"},
+                                            {"type": "bye"}; binary frames of 16-bit mono PCM. Out: JSON text frames.
+          POST   /v1/sessions               -> {"id": ...}
+          POST   /v1/sessions/<id>/text     {"text": ...} -> {"messages": [...]} up to the command's "done"
+          POST   /v1/sessions/<id>/audio    one utterance as a WAV body -> {"messages": [...]}
+          GET    /v1/sessions/<id>/events   messages queued since the last request (e.g. timer alerts)
+          DELETE /v1/sessions/<id>
+          GET    /v1/health, /metrics
+        At most max_sessions are open (503 beyond); sessions idle for idle_timeout seconds with no pending timer are closed. """
+    WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    MAX_BODY = 16 * 1024 * 1024
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, stt=None, genai_model=None, cache=None, ai_manager=None, wiki=None,
+                 max_sessions=SERVER_MAX_SESSIONS, idle_timeout=SERVER_SESSION_IDLE_SECONDS):
+        self.host = host; self.port = port; self.max_sessions = max_sessions; self.idle_timeout = idle_timeout
+        self.stt = stt or make_default_stt(); self.genai_model = genai_model; self.cache = cache if cache is not None else make_default_cache()
+        self.ai = ai_manager or AIRequestManager(lambda: self.genai_model); self.wiki = wiki or WikipediaClient()
+        self.sessions = {}; self._server = None; self._reaper = None
+        self.stats = {"sessions_opened": 0, "sessions_closed": 0, "websockets": 0, "requests": 0}
+
+    def _warm_up(self):
+        try: self.stt.warm_up()
+        except Exception as e: print(f"STT warm-up error ({self.stt.name}): {e}")
+        if ENABLE_NOISE_REDUCTION:
+            try: nr.reduce_noise # Import now rather than on the first uploaded utterance
+            except ImportError as e: print(f"NR libs missing: {e}")
+        if self.genai_model is None and configure_google_ai():
+            try: self.genai_model = genai.GenerativeModel(GENERATIVE_MODEL_NAME); print(f"Successfully loaded Google AI Model: '{GENERATIVE_MODEL_NAME}'.")
+            except Exception as e: print(f"\n!!! ERROR loading AI Model '{GENERATIVE_MODEL_NAME}': {e} !!!\n")
+    async def start(self):
+        """ Warms the shared STT model and loads the AI model (once), then starts listening; returns self. """
+        with STARTUP.phase("server warm-up"): await asyncio.get_running_loop().run_in_executor(None, self._warm_up)
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]; self._reaper = asyncio.ensure_future(self._reap_idle())
+        print(f"Shiva server on http://{self.host}:{self.port} (WebSocket /v1/ws): STT {self.stt.name}, AI {'ready' if self.genai_model else 'unavailable'}, up to {self.max_sessions} sessions.")
+        return self
+    async def serve_forever(self):
+        await self.start()
+        try: await self._server.serve_forever()
+        finally: await self.close()
+    async def close(self):
+        if self._reaper: self._reaper.cancel()
+        if self._server: self._server.close()
+        sessions = list(self.sessions.values())
+        for session in sessions: session.close()
+        if sessions: await asyncio.gather(*(s.task for s in sessions), return_exceptions=True)
+        self.wiki.pool.close_idle()
+
+    def open_session(self, sample_rate=16000):
+        """ Starts a new session (None when max_sessions are open). """
+        if len(self.sessions) >= self.max_sessions: METRICS.inc("server_sessions_total", event="rejected"); return None
+        session = ServerSession(self, os.urandom(8).hex(), sample_rate).start(); self.sessions[session.id] = session
+        self.stats["sessions_opened"] += 1; METRICS.inc("server_sessions_total", event="opened"); return session
+    def _session_ended(self, session):
+        if self.sessions.pop(session.id, None) is not None: self.stats["sessions_closed"] += 1; METRICS.inc("server_sessions_total", event="closed")
+    async def _reap_idle(self):
+        while True:
+            await asyncio.sleep(min(30.0, self.idle_timeout / 4)); cutoff = time.monotonic() - self.idle_timeout
+            for session in [s for s in self.sessions.values() if s.last_active < cutoff and not s.shiva.timers.pending()]:
+                log.info("Closing idle session %s.", session.id); session.close()
+    def health(self):
+        return {"sessions": len(self.sessions), "max_sessions": self.max_sessions, "cpu_seconds": time.process_time(), "stt": self.stt.name,
+                "ai": self.genai_model is not None, "ai_requests": self.ai.stats, "cache": self.cache.stats(), **self.stats}
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line.strip(): return None
+        method, target, _ = line.decode("latin-1").split(" ", 2); headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""): break
+            name, _, value = line.decode("latin-1").partition(":"); headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > self.MAX_BODY: raise ConnectionError("request body too large")
+        u = urllib.parse.urlsplit(target)
+        return method.upper(), u.path, dict(urllib.parse.parse_qsl(u.query)), headers, await reader.readexactly(length) if length else b""
+    @staticmethod
+    def _respond(writer, status, payload, keep_alive=True):
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode(); ctype = "text/plain; version=0.0.4" if isinstance(payload, str) else "application/json"
+        reason = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}.get(status, "")
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body)
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None: break
+                method, path, params, headers, body = request; self.stats["requests"] += 1
+                if headers.get("upgrade", "").lower() == "websocket": await self._websocket(reader, writer, path, params, headers); break
+                with METRICS.span("server_request_seconds"):
+                    try: status, payload = await self._route(method, path, body)
+                    except (ValueError, AttributeError) as e: status, payload = 400, {"error": str(e)} # Malformed JSON / WAV
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self._respond(writer, status, payload, keep_alive); await writer.drain()
+                if not keep_alive: break
+        except (ConnectionError, asyncio.IncompleteReadError): pass
+        except Exception as e: log.warning("Server connection error: %s", e)
+        finally: writer.close()
+    async def _route(self, method, path, body):
+        parts = [p for p in path.split("/") if p]
+        if parts == ["metrics"]: return 200, METRICS.prometheus_text()
+        if parts == ["v1", "health"]: return 200, self.health()
+        if parts == ["v1", "sessions"]:
+            if method != "POST": return 405, {"error": "use POST to open a session"}
+            session = self.open_session()
+            return (201, {"id": session.id}) if session else (503, {"error": "too many sessions"})
+        if len(parts) in (3, 4) and parts[:2] == ["v1", "sessions"]:
+            session = self.sessions.get(parts[2]); action = parts[3] if len(parts) == 4 else None
+            if session is None: return 404, {"error": "no such session"}
+            if action is None and method == "DELETE": session.close(); return 200, {"id": session.id, "closed": True}
+            if action == "text" and method == "POST":
+                text = json.loads(body or b"{}").get("text") or ""
+                if not text.strip(): return 400, {"error": "empty text"}
+                return 200, {"messages": await session.exchange(text=text)}
+            if action == "audio" and method == "POST": return 200, {"messages": await session.exchange(segment=self._wav_segment(body, session.sample_rate))}
+            if action == "events" and method == "GET": session.last_active = time.monotonic(); return 200, {"messages": session.drain()}
+        return 404, {"error": "not found"}
+    @staticmethod
+    def _wav_segment(body, sample_rate):
+        """ An uploaded WAV (one utterance) as a SpeechSegment; it skips the VAD. """
+        try: samples = _read_wav_mono16(io.BytesIO(body), sample_rate)
+        except (wave.Error, EOFError) as e: raise ValueError(f"not a WAV file: {e}")
+        seconds = len(samples) / sample_rate
+        return SpeechSegment(sr.AudioData(samples.tobytes(), sample_rate, 2), 0.0, seconds, seconds, time.perf_counter())
+
+    async def _websocket(self, reader, writer, path, params, headers):
+        key = headers.get("sec-websocket-key")
+        if path.rstrip("/") != "/v1/ws" or not key: self._respond(writer, 404 if key else 400, {"error": "WebSocket endpoint is /v1/ws"}, keep_alive=False); return
+        session = self.open_session(int(params.get("rate", 16000)))
+        if session is None: self._respond(writer, 503, {"error": "too many sessions"}, keep_alive=False); return
+        accept = base64.b64encode(hashlib.sha1((key + self.WS_GUID).encode()).digest()).decode()
+        writer.write(f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {accept}\r\n\r\n".encode())
+        session.send({"type": "session", "id": session.id}); self.stats["websockets"] += 1
+        async def pump():
+            while True:
+                message = await session.outbox.get(); writer.write(_ws_frame(json.dumps(message).encode()))
+                if message["type"] == "bye": writer.write(_ws_frame(struct.pack("!H", 1000), 0x8)); await writer.drain(); return
+                await writer.drain()
+        pumper = asyncio.ensure_future(pump()); kind, chunks = None, []
+        try:
+            while True:
+                fin, opcode, data = await _ws_read_frame(reader, self.MAX_BODY)
+                if opcode == 0x8: break
+                if opcode == 0x9: writer.write(_ws_frame(data, 0xA)); continue
+                if opcode == 0xA: continue
+                if opcode: kind, chunks = opcode, [data]
+                else: chunks.append(data) # Continuation
+                if not fin: continue
+                if kind == 0x2: session.put_audio(b"".join(chunks)); continue
+                try: self._ws_command(session, json.loads(b"".join(chunks)))
+                except (ValueError, AttributeError): session.send({"type": "error", "error": "expected a JSON object"})
+        except (ConnectionError, asyncio.IncompleteReadError): pass
+        finally:
+            session.close()
+            if not pumper.done(): pumper.cancel()
+    @staticmethod
+    def _ws_command(session, message):
+        kind = message.get("type")
+        if kind == "text": session.put_text(str(message.get("text") or ""))
+        elif kind == "end_audio": session.put_audio(b"", flush=True)
+        elif kind == "bye": session.close()
+        else: session.send({"type": "error", "error": f"unknown message type {kind!r}"})
+
+# ===============================================
+# UI Component: GIF frame pipeline (darken + resize once, cache on disk)
+# ===============================================
+class GIFFramePipeline:
+    """ Prepares a GIF for full-screen display without Tk: each frame is darkened by the overlay in one vectorized
+        NumPy pass, resized once, and written to an on-disk .npy cache keyed by GIF hash, target size and alpha.
+        Frames are then read lazily from a memory-mapped file. If the rendition would not fit memory_cap_mb it keeps
+        every 2nd frame, then shrinks the resolution (down to min_scale); ring_capacity tells the UI how many decoded
+        frames it may hold. Per-frame GIF durations are kept (default_delay_ms when a frame has none). """
+    MIN_FRAME_MS = 20
+    def __init__(self, gif_path, size, overlay_alpha=128, cache_dir=GIF_CACHE_DIR, memory_cap_mb=GIF_FRAME_MEMORY_CAP_MB, default_delay_ms=100, min_scale=0.5):
+        self.gif_path = gif_path; self.target_size = tuple(size); self.overlay_alpha = overlay_alpha; self.cache_dir = cache_dir
+        self.memory_cap_bytes = int(memory_cap_mb * 1024 * 1024); self.default_delay_ms = default_delay_ms; self.min_scale = min_scale
+        self.size = self.target_size; self.step = 1; self.frame_count = 0; self.ring_capacity = 2
+        self.durations = []; self.ready = 0; self.done = False; self.failed = False; self.cache_hit = False
+        self._frames = None; self._lock = threading.Lock()
+
+    def plan(self, n_frames):
+        """ Returns (width, height, step) for n_frames so every kept frame fits the memory cap, if possible. """
+        w, h = self.target_size; cap = self.memory_cap_bytes; frame_bytes = lambda w, h: w * h * 4 # Tk photos are ~4 bytes/pixel
+        if n_frames * frame_bytes(w, h) <= cap: return w, h, 1
+        step = 2 if n_frames > 2 else 1; kept = -(-n_frames // step)
+        if kept * frame_bytes(w, h) <= cap: return w, h, step
+        scale = max(self.min_scale, (cap / (kept * frame_bytes(w, h))) ** 0.5)
+        return max(1, int(w * scale)), max(1, int(h * scale)), step
+
+    def cache_paths(self):
+        with open(self.gif_path, "rb") as f: digest = hashlib.sha1(f.read()).hexdigest()[:16]
+        w, h = self.size; base = os.path.join(self.cache_dir, f"{digest}_{w}x{h}_a{self.overlay_alpha}_s{self.step}")
+        return base + ".npy", base + ".json"
+
+    def prepare(self):
+        """ Fills the cache (or opens an existing one). Safe to run on a background thread; ready counts usable frames. """
+        try:
+            with STARTUP.phase("gif frames"):
+                gif = Image.open(self.gif_path); n_frames = getattr(gif, "n_frames", 1)
+                w, h, self.step = self.plan(n_frames); self.size = (w, h); kept = -(-n_frames // self.step)
+                self.ring_capacity = max(2, min(kept, self.memory_cap_bytes // (w * h * 4)))
+                if (w, h) != self.target_size or self.step > 1: print(f"GIF rendition reduced for memory cap: {w}x{h}, every {self.step} frame(s).")
+                npy_path, meta_path = self.cache_paths()
+                if os.path.exists(npy_path) and os.path.exists(meta_path):
+                    with open(meta_path) as f: self.durations = json.load(f)["durations"]
+                    with self._lock: self._frames = np.load(npy_path, mmap_mode="r")
+                    self.frame_count = self.ready = len(self._frames); self.cache_hit = True; print(f"GIF frames from cache: {npy_path}")
+                    return
+                os.makedirs(self.cache_dir, exist_ok=True); tmp_path = npy_path + ".tmp"
+                out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(kept, h, w, 3))
+                with self._lock: self._frames = out
+                self.frame_count = kept; scale = (255 - self.overlay_alpha) / (255.0 * 255.0); k = 0
+                for i, frame in enumerate(ImageSequence.Iterator(gif)):
+                    duration = max(self.MIN_FRAME_MS, int(frame.info.get("duration") or self.default_delay_ms))
+                    if i % self.step: self.durations[-1] += duration; continue # Dropped frame: extend the previous one
+                    rgba = np.asarray(frame.convert("RGBA"), dtype=np.float32)
+                    # Same result as alpha-compositing a black overlay and showing it over the black label
+                    dark = (rgba[..., :3] * (rgba[..., 3:] * scale) + 0.5).astype(np.uint8)
+                    out[k] = np.asarray(Image.fromarray(dark, "RGB").resize((w, h), Image.Resampling.LANCZOS))
+                    self.durations.append(duration); k += 1; self.ready = k
+                out.flush()
+                with self._lock: # Close the memmap before renaming (required on Windows), then reopen read-only
+                    self._frames = None; del out; os.replace(tmp_path, npy_path); self._frames = np.load(npy_path, mmap_mode="r")
+                with open(meta_path, "w") as f: json.dump({"durations": self.durations, "source": self.gif_path}, f)
+                print(f"GIF processing complete: {k} frames cached at {self.size[0]}x{self.size[1]}.")
+        except Exception as e:
+            print(f"ERR processing GIF: {e}")
+            import traceback
+            traceback.print_exc()
+            self.failed = True
+        finally: self.done = True
+
+    def frame(self, idx):
+        """ RGB uint8 array of prepared frame idx (read from the memory map on demand). """
+        with self._lock: return np.array(self._frames[idx])
+    def duration(self, idx): return self.durations[idx] if idx < len(self.durations) else self.default_delay_ms
+
 # ===============================================
 # UI Component: Animated GIF Background Label (FIXED ANIMATION LOGIC)
 # ===============================================
 class AnimatedGIFLabel(tk.Label):
-    """ A Tkinter Label that displays an animated GIF with overlay. """
+    """ A Tkinter Label that displays an animated GIF with overlay.
+        Frames come from a GIFFramePipeline prepared on a background thread, so the window appears immediately;
+        at most pipeline.ring_capacity PhotoImages are held (a ring buffer), and each frame uses its own GIF duration.
+        delay is only the fallback for frames without a duration. """
     def __init__(self, master, gif_path, delay=100, overlay_alpha=128, **kwargs):
         super().__init__(master, **kwargs)
         self.gif_path = gif_path
         self.delay = delay
         self.overlay_alpha = overlay_alpha
-        self.frames = []
+        self.frames = OrderedDict() # Ring buffer: frame index -> PhotoImage, oldest first
+        self.pipeline = None
         self.idx = 0
         self._job = None # Stores the job ID from root.after
+        self._poll_job = None # after() job that waits for the first prepared frame
         self._is_running = False # Flag to control animation loop
+        self.config(bg="black")
         print(f"Loading GIF: {self.gif_path}")
-        self.load_gif() # Load frames during initialization
-
-        if self.frames:
-            print(f"GIF loaded: {len(self.frames)} frames.")
-            # Configure the label with the first frame
-            self.config(image=self.frames[self.idx], bg="black")
-            # Start the animation loop
-            self.start_animation()
-        else:
-            # Handle GIF loading failure
-            print("Failed GIF load.")
-            err_text = f"Error loading GIF:\n{os.path.basename(self.gif_path)}\nCheck path/file."
-            self.config(text=err_text, fg="red", bg="black", font=("Arial", 16), wraplength=master.winfo_screenwidth()-100)
+        self.load_gif() # Starts background frame preparation
+
+    def _show_load_error(self):
+        print("Failed GIF load.")
+        err_text = f"Error loading GIF:\n{os.path.basename(self.gif_path)}\nCheck path/file."
+        self.config(text=err_text, fg="red", bg="black", font=("Arial", 16), wraplength=self.master.winfo_screenwidth()-100)
 
     def load_gif(self):
-        """ Loads and processes GIF frames. """
+        """ Starts the frame pipeline on a background thread; _poll_frames starts the animation once a frame is ready. """
         if not os.path.exists(self.gif_path):
             print(f"ERR: GIF file not found: {self.gif_path}")
-            self.frames = []
+            self._show_load_error()
             return
+        self.master.update_idletasks() # Ensure window size is available
+        # Get target size (usually fullscreen) -- Tk calls must stay on this thread
+        screen_w, screen_h = self.master.winfo_width(), self.master.winfo_height()
+        if screen_w < 100 or screen_h < 100 : # Fallback if window not ready
+            screen_w, screen_h = self.master.winfo_screenwidth(), self.master.winfo_screenheight()
+        print(f"Target size for GIF frames: {screen_w}x{screen_h}")
+        self.pipeline = GIFFramePipeline(self.gif_path, (screen_w, screen_h), self.overlay_alpha, default_delay_ms=self.delay)
+        threading.Thread(target=self.pipeline.prepare, name="shiva-gif", daemon=True).start()
+        self._poll_job = self.after(15, self._poll_frames)
+
+    def _poll_frames(self):
+        """ Tk thread: waits for the first prepared frame, then starts the animation (or shows the load error). """
+        self._poll_job = None
         try:
-            # Open the GIF
-            self.gif = Image.open(self.gif_path)
-            self.frames = []
-            self.master.update_idletasks() # Ensure window size is available
-            # Get target size (usually fullscreen)
-            screen_w, screen_h = self.master.winfo_width(), self.master.winfo_height()
-            if screen_w < 100 or screen_h < 100 : # Fallback if window not ready
-                screen_w, screen_h = self.master.winfo_screenwidth(), self.master.winfo_screenheight()
-            print(f"Target size for GIF frames: {screen_w}x{screen_h}")
-
-            # Iterate through frames, apply overlay, resize, and store as PhotoImage
-            for i, frame in enumerate(ImageSequence.Iterator(self.gif)):
-                frame = frame.convert("RGBA") # Ensure RGBA for transparency handling
-                overlay = Image.new("RGBA", frame.size, (0, 0, 0, self.overlay_alpha)) # Create overlay
-                blended = Image.alpha_composite(frame, overlay) # Blend frame and overlay
-                resized = blended.resize((screen_w, screen_h), Image.Resampling.LANCZOS) # Resize
-                self.frames.append(ImageTk.PhotoImage(resized)) # Convert to Tkinter format
-
-            self._original_gif_img = self.gif # Keep reference to original PIL image
-            print(f"GIF processing complete: {len(self.frames)} frames.")
-        except Exception as e:
-            print(f"ERR processing GIF: {e}")
-            import traceback
-            traceback.print_exc()
-            self.frames = [] # Reset frames list on error
+            if self.pipeline.failed: self._show_load_error(); return
+            if self.pipeline.ready:
+                self.idx = 0; self.config(image=self._photo(0), bg="black"); self.start_animation(); STARTUP.mark("gif first frame"); return
+            self._poll_job = self.after(15, self._poll_frames)
+        except tk.TclError: pass # Widget destroyed while loading
+
+    def _photo(self, idx):
+        """ PhotoImage for frame idx from the ring buffer, decoding it from the pipeline (and evicting the oldest) if needed. """
+        photo = self.frames.get(idx)
+        if photo is None:
+            photo = ImageTk.PhotoImage(Image.fromarray(self.pipeline.frame(idx), "RGB")) # Convert to Tkinter format
+            self.frames[idx] = photo
+            while len(self.frames) > self.pipeline.ring_capacity: self.frames.popitem(last=False)
+        return photo
 
     # --- CORRECTED animate METHOD ---
     def animate(self):
         """ Cycles through GIF frames. This is the core animation loop step. """
         # Check if we should continue animating
-        if not self._is_running or not self.frames or not self.winfo_exists():
+        if not self._is_running or not self.pipeline or not self.pipeline.ready or not self.winfo_exists():
              # If stopped, no frames, or widget destroyed, stop the process.
              self._is_running = False
              if self._job:
@@ -388,16 +2788,15 @@ class AnimatedGIFLabel(tk.Label):
                  self._job = None
              return
 
-        # Move to the next frame index
-        self.idx = (self.idx + 1) % len(self.frames)
-
         try:
-            # Update the label's image to the next frame
-            self.config(image=self.frames[self.idx])
+            # Update the label's image to the current frame, then move on (frames still being prepared are skipped)
+            self.config(image=self._photo(self.idx))
+            delay = self.pipeline.duration(self.idx)
+            self.idx = (self.idx + 1) % self.pipeline.ready
 
-            # Schedule the *next* call to this animate method after the delay
+            # Schedule the *next* call to this animate method after this frame's own duration
             # This creates the loop.
-            self._job = self.after(self.delay, self.animate)
+            self._job = self.after(delay, self.animate)
 
         except tk.TclError:
              # This often happens if the window is closed while animation is pending
@@ -412,7 +2811,7 @@ class AnimatedGIFLabel(tk.Label):
 
     def start_animation(self):
         """ Starts the animation loop if frames are loaded and it's not already running. """
-        if self.frames and not self._is_running:
+        if self.pipeline and self.pipeline.ready and not self._is_running:
             print("Starting GIF animation loop...")
             self._is_running = True
             # Cancel any potentially lingering job before starting fresh
@@ -436,36 +2835,35 @@ class AnimatedGIFLabel(tk.Label):
         """ Cleans up resources when the widget is destroyed. """
         print("Destroying AnimatedGIFLabel...")
         self.stop_animation() # Ensure animation is stopped
-        self.frames = [] # Release image data references
+        if self._poll_job: self.after_cancel(self._poll_job); self._poll_job = None
+        self.frames.clear() # Release image data references
         self.config(image='') # Clear current image from label
-        self._original_gif_img = None # Release PIL image reference
+        self.pipeline = None # Release the memory-mapped frames
         super().destroy() # Call parent destroy method
 
 
 # ===============================================
 # Background Voice Loop & UI Start/Management (Syntax Fixed)
 # ===============================================
-stop_voice_loop = threading.Event(); root_window_ref = None
+stop_voice_loop = StopEvent(); root_window_ref = None
 def voice_loop(shiva_instance):
     """ The main loop for listening and processing commands in a background thread. """
     global root_window_ref; print("Starting voice loop thread..."); loop = asyncio.new_event_loop(); asyncio.set_event_loop(loop)
-    while not stop_voice_loop.is_set():
-        try:
-            if not root_window_ref or not root_window_ref.winfo_exists():
-                if not stop_voice_loop.is_set(): print("Root window closed. Exiting voice loop."); break
-        except Exception as win_check_e:
-            if not stop_voice_loop.is_set(): print(f"Win check error: {win_check_e}. Exiting loop."); break
-        try:
-            command = loop.run_until_complete(shiva_instance.take_command())
-            if stop_voice_loop.is_set(): break
-            if command and command != "none": loop.run_until_complete(shiva_instance.process_command(command));
-            time.sleep(0.1)
-        except RuntimeError as e:
-             if "cannot schedule" in str(e) or "closed" in str(e):
-                 if not stop_voice_loop.is_set(): print("Asyncio loop shutdown. Exiting voice loop."); break
-             else: print(f"RuntimeError in voice loop: {e}"); time.sleep(1)
-        except Exception as e: print(f"Unexpected Error in voice loop: {e}"); import traceback; traceback.print_exc(); time.sleep(2)
-    print("Voice loop thread finished.");
+    try: loop.run_until_complete(shiva_instance.wait_until_ready(mic=True)); loop.run_until_complete(shiva_instance.greet()) # Greet once the mic and STT model are ready, before the first listen
+    except Exception as e: print(f"Greeting error: {e}")
+    try:
+        stats = loop.run_until_complete(CommandPipeline(shiva_instance, stop_event=stop_voice_loop).run()) # Listens while commands are processed
+        print(f"Pipeline stats: {stats}")
+    except RuntimeError as e:
+        if "cannot schedule" in str(e) or "closed" in str(e): print("Asyncio loop shutdown. Exiting voice loop.")
+        else: print(f"RuntimeError in voice loop: {e}")
+    except Exception as e: print(f"Unexpected Error in voice loop: {e}"); import traceback; traceback.print_exc()
+    print("Voice loop thread finished."); shiva_instance.speech.shutdown()
+    if shiva_instance.audio_frontend: shiva_instance.audio_frontend.stop()
+    print(f"Response cache: {shiva_instance.cache.stats()}")
+    if METRICS_JSONL_PATH:
+        try: METRICS.write_jsonl(METRICS_JSONL_PATH) # Final snapshot
+        except OSError as e: log.warning("Metrics JSONL write failed: %s", e)
     try: # Corrected loop closing block
         if not loop.is_closed():
              loop.close(); print("Voice thread asyncio loop closed.")
@@ -487,7 +2885,7 @@ def start_ui(shiva):
     def exit_fullscreen(event=None): print("Exiting fullscreen."); root.attributes('-fullscreen', False)
     root.bind('<Escape>', exit_fullscreen); bg_label = AnimatedGIFLabel(root, gif_path=DEFAULT_GIF_PATH, delay=90, overlay_alpha=GIF_OVERLAY_ALPHA); bg_label.place(x=0, y=0, relwidth=1, relheight=1); bg_label.lower();
     print("Starting voice loop thread..."); voice_thread = threading.Thread(target=voice_loop, args=(shiva,), daemon=True); voice_thread.start(); root.protocol("WM_DELETE_WINDOW", on_close);
-    print("Starting Tkinter mainloop...");
+    STARTUP.mark("ui ready"); print("Starting Tkinter mainloop...");
     try: root.mainloop()
     except KeyboardInterrupt: print("\nCtrl+C in mainloop."); on_close()
     finally: # Corrected finally block indentation
@@ -499,18 +2897,28 @@ def start_ui(shiva):
 # ===============================================
 # Main Execution Block (Unchanged)
 # ===============================================
-async def run_app(): shiva = Shiva(); await shiva.greet(); start_ui(shiva)
+async def run_app():
+    if METRICS_JSONL_PATH or METRICS_HTTP_PORT: METRICS.start_export(METRICS_JSONL_PATH, METRICS_HTTP_PORT)
+    shiva = Shiva(); start_ui(shiva) # Greeting + first listen happen on the voice thread once the mic is calibrated
+async def run_server(host=SERVER_HOST, port=SERVER_PORT):
+    """ python shiv.py --server: no window or microphone; clients connect over WebSocket/HTTP (see ShivaServer). """
+    if METRICS_JSONL_PATH or METRICS_HTTP_PORT: METRICS.start_export(METRICS_JSONL_PATH, METRICS_HTTP_PORT)
+    await ShivaServer(host, port).serve_forever()
 if __name__ == "__main__":
     print("\n========================================"); print("   Shiva Voice Assistant - Starting Up  "); print("========================================")
     if os.name == 'nt': asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    import argparse
+    parser = argparse.ArgumentParser(description="Shiva Voice Assistant")
+    parser.add_argument("--server", action="store_true", help="serve many clients over WebSocket/HTTP instead of the local mic and window")
+    parser.add_argument("--host", default=SERVER_HOST); parser.add_argument("--port", type=int, default=SERVER_PORT)
+    cli = parser.parse_args()
     # --- Pre-run Checks / Info ---
-    # Check status based on hardcoded key config
-    if not google_ai_configured: print("\n*** NOTICE: Google AI SDK config failed (check hardcoded API Key/Permissions). AI commands likely fail. ***\n")
-    elif not ai_model_loaded: print("\n*** NOTICE: Google AI Model loading failed (check model name/key permissions). AI commands may fail. ***\n")
-    else: print("\n*** Google AI appears configured and ready. It will answer unrecognized commands. ***\n") # Updated message
-    if not os.path.exists(DEFAULT_GIF_PATH): print(f"\n*** WARNING: GIF not found: {DEFAULT_GIF_PATH} ***\n*** Background animation will fail. ***\n")
+    # Check status based on the .env key (SDK configuration and model load now run in the background at startup)
+    if not GOOGLE_API_KEY: print("\n*** NOTICE: No valid GOOGLE_API_KEY (check .env). AI commands will fail. ***\n")
+    else: print("\n*** Google AI key found. The model loads in the background and will answer unrecognized commands. ***\n")
+    if not cli.server and not os.path.exists(DEFAULT_GIF_PATH): print(f"\n*** WARNING: GIF not found: {DEFAULT_GIF_PATH} ***\n*** Background animation will fail. ***\n")
     # --- Run ---
-    try: asyncio.run(run_app())
+    try: asyncio.run(run_server(cli.host, cli.port) if cli.server else run_app())
     except KeyboardInterrupt: print("\nCtrl+C detected. Exiting.")
     except Exception as e: print(f"\n--- FATAL ERROR ---"); print(f"Error: {e}"); import traceback; print("\n--- Traceback ---"); traceback.print_exc(); print("-----------------\n"); os._exit(1)
     finally: print("========================================"); print("   Shiva Voice Assistant - Shut Down    "); print("========================================")
@@ -0,0 +1,1233 @@
+# =============================================================================
+# Shiva Voice Assistant - Benchmarks
+#
+# Description: Offline micro-benchmarks for Shiva's hot paths. Each benchmark
+#              is a sub-command:  python shiva_bench.py <benchmark> [options]
+#              "replay" drives the whole assistant headlessly (transcripts or WAVs,
+#              stub TTS/Gemini/Wikipedia) and reports per-stage latency.
+# =============================================================================
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import glob
+import io
+import itertools
+import json
+import os
+import random
+import re
+import statistics
+import tempfile
+import threading
+import time
+import urllib.parse
+import tracemalloc
+import wave
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+
+import shiv
+
+# =====================================
+# Shared helpers
+# =====================================
+percentile = shiv.percentile
+
+@contextlib.contextmanager
+def patched(obj, **attrs):
+    """ Temporarily sets attributes on a module, class or instance; restores them (or removes ones it added) on exit. """
+    saved = {name: vars(obj)[name] for name in attrs if name in vars(obj)}
+    for name, value in attrs.items(): setattr(obj, name, value)
+    try: yield obj
+    finally:
+        for name in attrs:
+            if name in saved: setattr(obj, name, saved[name])
+            else: delattr(obj, name)
+
+def collect_wavs(args_paths):
+    """ Expands WAV files and folders (non-recursive) into a sorted list of WAV paths. """
+    paths = []
+    for p in args_paths: paths.extend(sorted(glob.glob(os.path.join(p, "*.wav"))) if os.path.isdir(p) else [p])
+    return paths
+
+def print_latency_row(label, samples_s):
+    """ Prints mean/p50/p95/p99 in microseconds for a list of latencies in seconds. """
+    us = [x * 1e6 for x in samples_s]
+    print(f"  {label:<14} mean={statistics.fmean(us):8.2f}us  p50={percentile(us, 50):8.2f}us  p95={percentile(us, 95):8.2f}us  p99={percentile(us, 99):8.2f}us")
+
+# =====================================
+# Local stand-ins for external services
+# =====================================
+class StubTTSEngine:
+    """ pyttsx3-compatible engine that sleeps in place of audio output (seconds_per_char of "speech").
+        Fires 'started-word' callbacks per word and honours stop() between words, like pyttsx3. """
+    def __init__(self, seconds_per_char=0.004):
+        self.seconds_per_char = seconds_per_char; self.spoken = []; self.said = []; self.say_times = []; self._pending = []; self._callbacks = []; self._stopped = False
+    def connect(self, topic, cb):
+        if topic == 'started-word': self._callbacks.append(cb)
+    def say(self, text): self._pending.append(text); self.said.append(text); self.say_times.append(time.perf_counter())
+    def stop(self): self._stopped = True
+    def runAndWait(self):
+        pending, self._pending = self._pending, []; self._stopped = False
+        for text in pending:
+            for word in text.split():
+                for cb in self._callbacks: cb(None, 0, len(word))
+                if self._stopped: return
+                time.sleep((len(word) + 1) * self.seconds_per_char)
+            self.spoken.append(text)
+
+class _FakeResponse:
+    """ Mimics google.generativeai's GenerateContentResponse: .parts / .candidates, async-iterable when streamed. """
+    def __init__(self, chunks, chunk_delay=0.0):
+        self._chunks = chunks; self._chunk_delay = chunk_delay; self.prompt_feedback = None
+        parts = [SimpleNamespace(text="".join(chunks))]
+        self.parts = parts; self.candidates = [SimpleNamespace(content=SimpleNamespace(parts=parts), finish_reason="STOP")]
+    async def __aiter__(self):
+        for i, text in enumerate(self._chunks):
+            if i: await asyncio.sleep(self._chunk_delay)
+            yield SimpleNamespace(parts=[SimpleNamespace(text=text)], text=text, prompt_feedback=None)
+
+class FakeGenerativeModel:
+    """ Local stand-in for genai.GenerativeModel: answers after first_token_delay, then one chunk of chunk_chars
+        characters every chunk_delay seconds. Non-streamed calls return only after the whole answer is "generated". """
+    DEFAULT_ANSWER = ("The monsoon reaches Kerala in early June. It then advances north over the following weeks. "
+                      "Most of India receives the bulk of its annual rainfall during these months. "
+                      "Farmers time their sowing around its arrival, so forecasts are watched closely.")
+    def __init__(self, answer=None, first_token_delay=0.4, chunk_delay=0.08, chunk_chars=24):
+        self.answer = answer or self.DEFAULT_ANSWER; self.first_token_delay = first_token_delay; self.chunk_delay = chunk_delay; self.chunk_chars = chunk_chars; self.calls = 0
+    def _chunks(self): return [self.answer[i:i + self.chunk_chars] for i in range(0, len(self.answer), self.chunk_chars)]
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        self.calls += 1; chunks = self._chunks(); await asyncio.sleep(self.first_token_delay)
+        usage = SimpleNamespace(prompt_token_count=shiv.estimate_tokens(shiv.AIRequestManager.prompt_text(prompt)), candidates_token_count=shiv.estimate_tokens(self.answer))
+        if stream: response = _FakeResponse(chunks, self.chunk_delay)
+        else: await asyncio.sleep(self.chunk_delay * (len(chunks) - 1)); response = _FakeResponse(chunks)
+        response.usage_metadata = usage; return response
+
+WIKI_PAGES = {
+    "Mahatma Gandhi": "Mohandas Karamchand Gandhi was an Indian lawyer and political ethicist. He employed nonviolent resistance to lead the campaign for India's independence from British rule. He inspired movements for civil rights and freedom across the world. The honorific Mahatma was first applied to him in South Africa in 1914.",
+    "Taj Mahal": "The Taj Mahal is an ivory-white marble mausoleum on the right bank of the river Yamuna in Agra. It was commissioned in 1631 by the Mughal emperor Shah Jahan to house the tomb of his wife Mumtaz Mahal. The tomb is the centrepiece of a 17-hectare complex. It is regarded as the finest example of Mughal architecture.",
+    "Monsoon": "A monsoon is a seasonal change in the direction of the prevailing winds of a region. Monsoons cause wet and dry seasons throughout much of the tropics. The South Asian monsoon brings most of India's annual rainfall. Its onset over Kerala usually comes in early June.",
+    "Python (programming language)": "Python is a high-level, general-purpose programming language. Its design philosophy emphasizes code readability with the use of significant indentation. Python is dynamically typed and garbage-collected. It was conceived in the late 1980s by Guido van Rossum.",
+    "Albert Einstein": "Albert Einstein was a German-born theoretical physicist. He is best known for developing the theory of relativity. He received the 1921 Nobel Prize in Physics for his services to theoretical physics. His mass-energy equivalence formula has been called the world's most famous equation.",
+    "Black hole": "A black hole is a region of spacetime where gravity is so strong that nothing, not even light, can escape it. Black holes form when massive stars collapse at the end of their life cycle. Their boundary is called the event horizon. Supermassive black holes lie at the centre of most galaxies.",
+    "Mercury": None, # Disambiguation page
+    "Mercury (planet)": "Mercury is the first planet from the Sun and the smallest in the Solar System. It is a rocky planet with a trace atmosphere. Its orbit around the Sun takes 87.97 Earth days. It has no natural satellites.",
+    "Mercury (element)": "Mercury is a chemical element with the symbol Hg and atomic number 80. It is the only metallic element that is liquid at standard temperature and pressure. It is used in thermometers, barometers and fluorescent lamps. Mercury is toxic to humans.",
+    "Freddie Mercury": "Freddie Mercury was a British singer and songwriter who achieved global fame as the lead vocalist of the rock band Queen. He was known for his flamboyant stage persona and four-octave vocal range. He was born in Zanzibar in 1946. He died in 1991.",
+}
+WIKI_REDIRECTS = {"Gandhi": "Mahatma Gandhi", "Einstein": "Albert Einstein", "Python programming": "Python (programming language)"}
+
+class FakeWikipediaServer:
+    """ Local HTTP/1.1 stand-in for the MediaWiki api.php subset used by WikipediaClient (generator=search with
+        extracts, formatversion 2) and by the wikipedia package (list=search, prop=info|pageprops, prop=extracts,
+        formatversion 1), over WIKI_PAGES with redirects and a disambiguation page. Keep-alive is supported; each
+        request waits latency seconds and each new connection handshake_latency (TLS setup on the real site). """
+    def __init__(self, latency=0.15, handshake_latency=0.1, pages=None):
+        import http.server
+        self.latency = latency; self.handshake_latency = handshake_latency; self.pages = pages or WIKI_PAGES
+        self.requests = 0; self.connections = 0; self.lock = threading.Lock(); server = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def setup(self):
+                super().setup(); time.sleep(server.handshake_latency)
+                with server.lock: server.connections += 1
+            def do_GET(self):
+                with server.lock: server.requests += 1
+                time.sleep(server.latency)
+                params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query, keep_blank_values=True))
+                payload = json.dumps(server.answer(params)).encode()
+                self.send_response(200); self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(payload))); self.end_headers(); self.wfile.write(payload)
+            def log_message(self, *args): pass
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler); self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/w/api.php"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    def close(self): self.httpd.shutdown(); self.httpd.server_close()
+    def search(self, text):
+        words = re.findall(r"\w+", text.lower()); exact = {t.lower(): t for t in list(self.pages) + list(WIKI_REDIRECTS)}
+        first = WIKI_REDIRECTS.get(exact.get(text.lower()), exact.get(text.lower()))
+        scored = sorted(((sum(w in (t + " " + (p or "")).lower() for w in words), t) for t, p in self.pages.items()), key=lambda x: -x[0])
+        return ([first] if first else []) + [t for s, t in scored if s == len(words) and t != first]
+    def _extract(self, title, sentences):
+        text = self.pages[title] or ""; parts = re.split(r"(?<=\.)\s+", text)
+        return " ".join(parts[:int(sentences)]) if sentences else text
+    def _page(self, title, pageid):
+        page = {"pageid": pageid, "ns": 0, "title": title, "fullurl": f"https://en.wikipedia.org/wiki/{title.replace(' ', '_')}"}
+        if self.pages[title] is None: page["pageprops"] = {"disambiguation": ""}
+        return page
+    def answer(self, q):
+        ids = {t: i + 1 for i, t in enumerate(self.pages)}
+        if q.get("generator") == "search":
+            titles = self.search(q.get("gsrsearch", ""))[:int(q.get("gsrlimit", 10))]
+            pages = [dict(self._page(t, ids[t]), index=i + 1, extract=self._extract(t, q.get("exsentences"))) for i, t in enumerate(titles)]
+            return {"batchcomplete": True, "query": {"pages": pages}} if pages else {"batchcomplete": True}
+        if q.get("list") == "search":
+            return {"query": {"searchinfo": {}, "search": [{"ns": 0, "title": t} for t in self.search(q.get("srsearch", ""))[:int(q.get("srlimit", 10))]]}}
+        title = q.get("titles", ""); query = {}
+        if title in WIKI_REDIRECTS and "redirects" in q: query["redirects"] = [{"from": title, "to": WIKI_REDIRECTS[title]}]; title = WIKI_REDIRECTS[title]
+        if title not in self.pages: query["pages"] = {"-1": {"ns": 0, "title": title, "missing": ""}}; return {"query": query}
+        page = self._page(title, ids[title])
+        if "extracts" in q.get("prop", ""): page["extract"] = self._extract(title, q.get("exsentences"))
+        if "revisions" in q.get("prop", ""): page["revisions"] = [{"*": "<ul>" + "".join(f'<li><a href="#">{t}</a></li>' for t in self.pages if t.startswith(title + " (") or t.endswith(" " + title)) + "</ul>"}]
+        query["pages"] = {str(ids[title]): page}; return {"query": query}
+
+class TranscriptSTT(shiv.STTBackend):
+    """ Replays known transcripts (in order) after latency seconds, in place of a real recognizer. """
+    name = "replay"
+    def __init__(self, transcripts, latency=0.3): self.transcripts = list(transcripts); self.latency = latency
+    def recognize(self, audio_data):
+        time.sleep(self.latency)
+        return shiv.RecognitionResult(self.transcripts.pop(0), 1.0, self.name, self.latency) if self.transcripts else None
+
+# =====================================
+# Benchmark: intent router (old elif chain vs compiled IntentRouter)
+# =====================================
+_LEGACY_CHAIN = [ # (intent name, substrings) in the original elif order; checked against the cleaned query
+    ("how are you", ["how are you"]), ("your name", ["your name"]), ("creator", ["who created you", "developer"]),
+    ("time", ["time"]), ("date", ["date"]), ("youtube", ["youtube"]), ("google", ["google"]), ("open website", None),
+    ("music", ["music", "song"]), ("video", ["video"]), ("pdf", ["pdf"]), ("word", ["word document", "word doc", "word file"]),
+    ("notepad", ["notepad"]), ("calculator", ["calculator"]), ("paint", ["paint"]), ("cmd", ["command prompt"]),
+    ("wikipedia", ["wikipedia"]), ("weather", ["weather"]), ("fact", ["fun fact", "fact"]), ("timer", ["timer"]),
+    ("email", ["send email"]), ("pause", ["hold on", "wait", "pause"]),
+]
+_LEGACY_EXIT = ["stop listening", "stop now", "exit", "quit", "shutdown", "goodbye", "bye", "stop shiva"]
+
+def legacy_route(raw_query):
+    """ Re-implementation of the pre-router Shiva.process_command matching, for comparison. """
+    l_raw_query = raw_query.lower()
+    if any(p in l_raw_query for p in _LEGACY_EXIT): return "exit"
+    cleaned = re.sub(r'^\s*shiva\b', '', raw_query, flags=re.IGNORECASE).strip()
+    cleaned = re.sub(r'\b(please|can you|could you|tell me|what is|who is|open|play|start|show|display|search|set|get me|find)\b', '', cleaned, flags=re.IGNORECASE).strip()
+    cleaned = re.sub(r'\s+', ' ', cleaned).strip()
+    for name, phrases in _LEGACY_CHAIN:
+        if phrases is None:
+            if l_raw_query.startswith(("open website", "shiva open website")): return name
+        elif any(p in cleaned for p in phrases): return name
+    return None
+
+_CORPUS_TEMPLATES = [ # (expected intent, transcript); None means "should reach the AI fallback"
+    ("exit", "shiva stop listening"), ("exit", "goodbye shiva"), ("exit", "quit"),
+    ("how are you", "shiva how are you today"), ("your name", "what is your name"), ("creator", "who created you"),
+    ("time", "what time is it"), ("time", "shiva tell me the time"), ("date", "what is the date today"),
+    ("youtube", "open youtube"), ("google", "open google please"), ("open website", "open website example.com"),
+    ("music", "play some music"), ("music", "play a song"), ("video", "play the video"), ("pdf", "open my pdf"),
+    ("word", "open the word document"), ("notepad", "open notepad"), ("calculator", "start the calculator"),
+    ("paint", "open paint"), ("cmd", "open command prompt"), ("wikipedia", "search wikipedia for alan turing"),
+    ("weather", "what is the weather in delhi"), ("fact", "tell me a fun fact"), ("fact", "give me a random fact"),
+    ("timer", "set a timer for 5 minutes"), ("timer", "shiva timer 30 seconds"), ("email", "send email to mom"),
+    ("pause", "hold on a second"), ("pause", "wait"),
+    (None, "sometimes i wonder why the sky is blue"), (None, "how do they manufacture glass"),
+    (None, "explain quantum entanglement simply"), (None, "what is the capital of france"),
+    (None, "write a haiku about the monsoon"), (None, "what is an update in software"),
+    (None, "is a tomato a fruit"), (None, "recommend a good book on history"),
+    (None, "how many times has india won the world cup"), (None, "important dates in history"), # Plurals of non-plural triggers
+    ("music", "play some songs"), ("timer", "list my timers"), ("fact", "tell me some fun facts"),
+]
+
+def build_router_corpus(size, seed=7):
+    """ Returns `size` (expected_intent, transcript) pairs sampled from the templates with light noise. """
+    rng = random.Random(seed); fillers = ["", "please ", "shiva ", "can you ", "hey "]
+    corpus = []
+    for label, text in (rng.choice(_CORPUS_TEMPLATES) for _ in range(size)):
+        lead = rng.choice(fillers[:1] if label == "open website" else fillers) # "open website" only counts as a prefix
+        corpus.append((label, lead + text))
+    return corpus
+
+def load_router_corpus(path):
+    """ Loads 'intent<TAB>transcript' lines; an empty or 'none' intent means AI fallback. """
+    corpus = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"): continue
+            label, _, text = line.rstrip("\n").partition("\t"); label = label.strip()
+            corpus.append((None if label.lower() in ("", "none") else label, text.strip().lower()))
+    return corpus
+
+def bench_router(args):
+    corpus = load_router_corpus(args.corpus) if args.corpus else build_router_corpus(args.size)
+    new_route = lambda q: (lambda i: i.name if i else None)(shiv.INTENT_ROUTER.route(q))
+    print(f"Router benchmark: {len(corpus)} transcripts, {args.repeat} repeat(s)")
+    for label, route in (("legacy elif", legacy_route), ("IntentRouter", new_route)):
+        latencies = []; correct = 0
+        for _ in range(args.repeat):
+            for expected, text in corpus:
+                t0 = time.perf_counter(); got = route(text); latencies.append(time.perf_counter() - t0)
+                correct += (got == expected)
+        print_latency_row(label, latencies)
+        print(f"  {'':<14} accuracy={100.0 * correct / (len(corpus) * args.repeat):6.2f}%")
+    if args.show_diffs:
+        for expected, text in sorted(set(corpus), key=lambda x: x[1]):
+            old, new = legacy_route(text), new_route(text)
+            if old != new: print(f"  diff: {text!r}: legacy={old} router={new} expected={expected}")
+
+# =====================================
+# Benchmark: streamed vs blocking AI answers (time-to-first-audio)
+# =====================================
+def bench_stream(args):
+    model = FakeGenerativeModel(first_token_delay=args.first_token_delay, chunk_delay=args.chunk_delay, chunk_chars=args.chunk_chars)
+    print(f"Stream benchmark: first token after {args.first_token_delay*1000:.0f}ms, {len(model._chunks())} chunks every {args.chunk_delay*1000:.0f}ms")
+    for label, stream in (("blocking", False), ("streaming", True)):
+        ttfa, total = [], []
+        for _ in range(args.repeat):
+            engine = StubTTSEngine(args.seconds_per_char); shiva = shiv.Shiva(engine=engine, genai_model=model, calibrate_mic=False, cache=shiv.ResponseCache(max_entries=0), media_index=shiv.MediaIndex(), timers=shiv.TimerScheduler())
+            t0 = time.perf_counter(); asyncio.run(shiva.speak_ai_answer("What about the monsoon?", stream=stream))
+            total.append(time.perf_counter() - t0); ttfa.append(engine.say_times[0] - t0); shiva.speech.shutdown()
+        print(f"  {label:<10} TTFA p50={percentile(ttfa, 50)*1000:7.1f}ms  done p50={percentile(total, 50)*1000:7.1f}ms")
+        if stream: print(f"  {'':<10} last run: {shiva.last_stream_stats}")
+
+# =====================================
+# Benchmark: speech worker (event-loop freedom, preemption, barge-in)
+# =====================================
+async def _loop_lag_probe(stop, interval=0.01):
+    """ Returns the worst extra delay seen by a ticker (every interval seconds) until stop is set: how long the event loop was blocked. """
+    worst = 0.0
+    while not stop.is_set():
+        t0 = time.perf_counter(); await asyncio.sleep(interval); worst = max(worst, time.perf_counter() - t0 - interval)
+    return worst
+
+async def _run_tts_scenario(shiva, engine, args):
+    long_text = " ".join(["Wikipedia says the monsoon is a seasonal change in the prevailing wind direction."] * args.sentences)
+    stop = asyncio.Event(); probe = asyncio.create_task(_loop_lag_probe(stop))
+    readout = await shiva.speak(long_text, wait=False); await asyncio.sleep(args.alert_after)
+    t_alert = time.perf_counter(); alert = await shiva.speak("Time's up! Your timer is done.", shiv.PRIORITY_URGENT, wait=False)
+    await asyncio.wrap_future(alert.future); alert_start = next(t for t, text in zip(engine.say_times, engine.said) if text.startswith("Time's up"))
+    await asyncio.sleep(args.alert_after); t_barge = time.perf_counter(); shiva.speech.barge_in()
+    readout_spoken = await asyncio.wrap_future(readout.future); t_quiet = time.perf_counter()
+    stop.set(); lag = await probe
+    print(f"  urgent alert started {1000*(alert_start - t_alert):7.1f}ms after submit (readout preempted, then resumed)")
+    print(f"  barge-in silenced the readout in {1000*(t_quiet - t_barge):7.1f}ms (readout fully spoken: {readout_spoken})")
+    print(f"  worst event-loop stall while speaking: {1000*lag:7.1f}ms")
+
+def bench_tts(args):
+    engine = StubTTSEngine(args.seconds_per_char); shiva = shiv.Shiva(engine=engine, calibrate_mic=False, cache=shiv.ResponseCache(max_entries=0), media_index=shiv.MediaIndex(), timers=shiv.TimerScheduler())
+    print(f"TTS worker benchmark: {args.sentences}-sentence readout, urgent alert after {args.alert_after*1000:.0f}ms")
+    asyncio.run(_run_tts_scenario(shiva, engine, args)); shiva.speech.shutdown()
+
+# =====================================
+# Benchmark: streaming VAD front-end over WAV files
+# =====================================
+def write_synthetic_speech_wav(path, rate=16000, bursts=((0.8, 1.2), (2.35, 0.8), (4.6, 1.6)), noise_rms=60.0, seed=3):
+    """ Writes a WAV of background noise with voiced "speech" bursts given as (start_s, duration_s). Returns the burst ends. """
+    rng = np.random.default_rng(seed); total = max(s + d for s, d in bursts) + 1.0; n = int(total * rate)
+    audio = rng.normal(0, noise_rms, n)
+    for start, dur in bursts:
+        t = np.arange(int(dur * rate)) / rate; env = np.minimum(1.0, np.minimum(t, dur - t) / 0.05) # 50ms fade in/out
+        voice = sum(np.sin(2 * np.pi * f * t) / k for k, f in enumerate((140, 280, 420, 900), 1)) * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+        i = int(start * rate); audio[i:i + len(t)] += 3000 * env * voice
+    with wave.open(path, "wb") as wf:
+        wf.setnchannels(1); wf.setsampwidth(2); wf.setframerate(rate); wf.writeframes(np.clip(audio, -32768, 32767).astype(np.int16).tobytes())
+    return [s + d for s, d in bursts]
+
+def _legacy_listen_end(path, pause_threshold=1.0):
+    """ Seconds of audio recognizer.listen() consumed before closing the first phrase (speech end + dead air). """
+    recognizer = shiv.sr.Recognizer(); recognizer.pause_threshold = pause_threshold
+    with shiv.sr.AudioFile(path) as source:
+        recognizer.adjust_for_ambient_noise(source, duration=0.5); recognizer.listen(source, timeout=7, phrase_time_limit=10)
+        return source.stream.audio_reader.tell() / source.SAMPLE_RATE if hasattr(source.stream, "audio_reader") else None
+
+def bench_vad(args):
+    paths = collect_wavs(args.wavs)
+    if not paths:
+        path = os.path.join(tempfile.gettempdir(), "shiva_vad_synthetic.wav"); ends = write_synthetic_speech_wav(path); paths = [path]
+        print(f"No WAVs given; synthetic clip {path} (speech ends at {', '.join(f'{e:.2f}s' for e in ends)})")
+    recognizer = shiv.sr.Recognizer() if args.recognize else None
+    print(f"VAD benchmark: hangover={args.hangover_ms}ms pre-roll={args.pre_roll_ms}ms, {len(paths)} file(s)")
+    eos_delays, stt_latencies = [], []
+    for path in paths:
+        source = shiv.WavFileSource(path, realtime=args.realtime); frontend = shiv.AudioFrontEnd(source, hangover_ms=args.hangover_ms, pre_roll_ms=args.pre_roll_ms).start()
+        print(f"  {os.path.basename(path)}")
+        while True:
+            segment = frontend._segments.get()
+            if segment is None: break
+            delay = segment.eos_s - segment.end_s; eos_delays.append(delay); line = f"    speech {segment.start_s:6.2f}s-{segment.end_s:6.2f}s  end-of-speech declared +{delay*1000:5.0f}ms"
+            if recognizer:
+                try: text = recognizer.recognize_google(segment.audio, language='en-in')
+                except Exception as e: text = f"<{type(e).__name__}>"
+                latency = time.perf_counter() - segment.eos_at; stt_latencies.append(latency); line += f"  EOS->text {latency*1000:6.0f}ms  {text!r}"
+            print(line)
+        frontend.stop()
+        legacy = _legacy_listen_end(path)
+        if legacy is not None: print(f"    legacy listen() closed its first phrase at {legacy:6.2f}s of audio (pause_threshold=1.0s)")
+    if eos_delays: print(f"  end-of-speech detection delay: p50={percentile(eos_delays, 50)*1000:.0f}ms p95={percentile(eos_delays, 95)*1000:.0f}ms over {len(eos_delays)} utterance(s)")
+    if stt_latencies: print(f"  end-of-speech -> recognition:  p50={percentile(stt_latencies, 50)*1000:.0f}ms p95={percentile(stt_latencies, 95)*1000:.0f}ms")
+
+# =====================================
+# Benchmark: streaming denoiser vs whole-utterance noisereduce
+# =====================================
+def _read_wav_int16(path):
+    source = shiv.WavFileSource(path, tail_silence_ms=0); source.open(); samples = source._samples; source.close()
+    return samples, source.sample_rate
+
+def _legacy_denoise(samples, rate):
+    """ The pre-streaming take_command path: whole buffer int16 -> float32 -> noisereduce -> int16. """
+    aud_fl = samples.astype(np.float32) / np.iinfo(np.int16).max
+    red_fl = shiv.nr.reduce_noise(y=aud_fl, sr=rate, stationary=True, prop_decrease=0.85)
+    return (red_fl * np.iinfo(np.int16).max).astype(np.int16)
+
+def _streaming_denoise(samples, rate, frame_ms=30):
+    denoiser = shiv.StreamingDenoiser(rate); vad = shiv.EnergyVAD(); step = int(rate * frame_ms / 1000); out = []
+    for i in range(0, len(samples) - step + 1, step):
+        frame = samples[i:i + step]; out.append(denoiser.process(frame.tobytes(), learn_noise=not vad.is_speech(frame)))
+    return np.frombuffer(b"".join(out), dtype=np.int16)
+
+def _measure(fn, *args):
+    tracemalloc.start(); t0 = time.perf_counter(); fn(*args); elapsed = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop(); return elapsed, peak
+
+def bench_denoise(args):
+    paths = collect_wavs(args.wavs)
+    if not paths:
+        path = os.path.join(tempfile.gettempdir(), "shiva_vad_synthetic.wav"); write_synthetic_speech_wav(path); paths = [path]
+        print(f"No WAVs given; using synthetic clip {path}")
+    shiv.nr.reduce_noise # Import noisereduce before timing
+    print(f"Denoise benchmark: {len(paths)} file(s); RTF = processing time / audio duration (lower is better)")
+    print(f"  {'file':<28} {'dur':>6}  {'legacy RTF':>10} {'peak MB':>8}  {'stream RTF':>10} {'peak MB':>8}")
+    for path in paths:
+        samples, rate = _read_wav_int16(path); duration = len(samples) / rate
+        legacy_t, legacy_peak = _measure(_legacy_denoise, samples, rate)
+        stream_t, stream_peak = _measure(_streaming_denoise, samples, rate)
+        print(f"  {os.path.basename(path)[:28]:<28} {duration:5.1f}s  {legacy_t/duration:10.4f} {legacy_peak/2**20:8.2f}  {stream_t/duration:10.4f} {stream_peak/2**20:8.2f}")
+    print("  (streaming work happens during capture, so its cost is off the end-of-speech -> text path; legacy runs after listening)")
+
+# =====================================
+# Benchmark: serial voice loop vs concurrent command pipeline (scripted input)
+# =====================================
+_PIPELINE_SCRIPT = [(0.0, "tell me about the monsoon"), (0.7, "stop"), (0.3, "pause"), (0.5, "cancel"), (0.2, "what is the date")]
+
+async def _run_serial(shiva, script):
+    """ The old voice_loop shape: the next command is only heard once the previous one has been processed. """
+    t0 = time.perf_counter(); spoken_at = 0.0; reactions = []
+    for delay, text in script:
+        spoken_at += delay; heard = max(time.perf_counter() - t0, spoken_at)
+        if heard == spoken_at: await asyncio.sleep(spoken_at - (time.perf_counter() - t0))
+        reactions.append((text, heard - spoken_at)); shiva.speech.barge_in(); await shiva.process_command(text)
+    return time.perf_counter() - t0, reactions
+
+def bench_pipeline(args):
+    print(f"Pipeline benchmark: scripted commands {[t for _, t in _PIPELINE_SCRIPT]}, fake AI first token {args.first_token_delay}s")
+    for mode in ("serial", "pipeline"):
+        engine = StubTTSEngine(args.seconds_per_char); model = FakeGenerativeModel(first_token_delay=args.first_token_delay, chunk_delay=args.chunk_delay)
+        shiva = shiv.Shiva(engine=engine, genai_model=model, calibrate_mic=False, cache=shiv.ResponseCache(max_entries=0), media_index=shiv.MediaIndex(), timers=shiv.TimerScheduler())
+        if mode == "serial":
+            if args.skip_serial: shiva.speech.shutdown(); continue
+            elapsed, reactions = asyncio.run(_run_serial(shiva, _PIPELINE_SCRIPT))
+            print(f"  serial   total {elapsed:6.2f}s  command heard after: " + ", ".join(f"{t!r} +{r*1000:.0f}ms" for t, r in reactions))
+        else:
+            pipeline = shiv.CommandPipeline(shiva, script=shiv.ScriptedInput(_PIPELINE_SCRIPT)); t0 = time.perf_counter()
+            stats = asyncio.run(pipeline.run()); elapsed = time.perf_counter() - t0
+            print(f"  pipeline total {elapsed:6.2f}s  handlers cancelled: {stats['dispatch']['cancelled']}  commands: {pipeline.handled}")
+            for stage, st in stats.items():
+                print(f"    {stage:<9} processed={st['processed']:<3} max_depth={st['max_depth']}  wait p50={st['wait_p50_ms']:.1f}ms p95={st['wait_p95_ms']:.1f}ms  service p50={st['service_p50_ms']:.0f}ms p95={st['service_p95_ms']:.0f}ms")
+        shiva.speech.shutdown()
+
+# =====================================
+# Benchmark: media index (incremental scan + fuzzy lookup) vs listing a folder
+# =====================================
+_MEDIA_WORDS = ("believer thunder radioactive demons monsoon river night city dream fire stone light shadow ocean summer winter road "
+                "heart star rain gold silver echo storm wild blue red paper sky home love lost found run").split()
+
+def build_media_tree(root, count, seed=11):
+    """ Writes count empty media files as <artist>/<album>/<title>.<ext>; returns the titles used. """
+    rng = random.Random(seed); exts = [("mp3", 6), ("mp4", 2), ("pdf", 1), ("docx", 1)]; titles = []
+    choices = [e for e, w in exts for _ in range(w)]
+    for i in range(count):
+        artist = f"artist {i % 500:03d}"; album = f"album {i % 37:02d}"; folder = os.path.join(root, artist, album)
+        title = " ".join(rng.sample(_MEDIA_WORDS, 2)) + f" {i}"; titles.append(title)
+        os.makedirs(folder, exist_ok=True); open(os.path.join(folder, f"{title.replace(' ', '_')}.{rng.choice(choices)}"), "w").close()
+    return titles
+
+def bench_media(args):
+    root = args.root or os.path.join(tempfile.gettempdir(), f"shiva_media_{args.files}")
+    if not os.path.isdir(root): print(f"Building {args.files} synthetic media files under {root} ..."); build_media_tree(root, args.files)
+    db = os.path.join(tempfile.gettempdir(), "shiva_media_bench.sqlite3")
+    if os.path.exists(db) and not args.keep_db: os.remove(db)
+    index = shiv.MediaIndex(db); print(f"Media benchmark: {root} (FTS5 trigram: {index.fts})")
+    print(f"  first scan       {index.scan([root])}"); print(f"  rescan unchanged {index.scan([root])}")
+    paths = [r[0] for r in index._db.execute("SELECT path FROM media ORDER BY id LIMIT 100")]
+    for p in paths: os.utime(p, None)
+    print(f"  rescan 100 touched {index.scan([root])}"); print(f"  indexed: {index.count()} files, music={index.count('music')}")
+    titles = [r[0] for r in index._db.execute("SELECT title FROM media WHERE kind = 'music' ORDER BY RANDOM() LIMIT 200")]
+    rng = random.Random(5); queries = []
+    for t in titles:
+        words = t.lower().split()[:2]; q = " ".join(words)
+        if rng.random() < 0.5: w = words[0]; i = rng.randrange(1, len(w) - 1); q = q.replace(w, w[:i] + w[i + 1:], 1) # Drop a letter (misrecognition)
+        queries.append(("play " + q, words))
+    latencies = []; correct = 0
+    for q, words in queries:
+        t0 = time.perf_counter(); hits = index.search(q.replace("play ", "", 1), kind="music", limit=1); latencies.append(time.perf_counter() - t0)
+        correct += bool(hits) and all(w in hits[0][2].lower() for w in words)
+    print_latency_row("index search", latencies); print(f"                 top hit contains the spoken words: {correct}/{len(queries)} (half the queries have a dropped letter)")
+    t0 = time.perf_counter(); n = sum(1 for _ in index._walk(root)); walk = time.perf_counter() - t0
+    print(f"  for comparison, one full directory walk (what a per-request listing of subfolders costs): {walk*1000:.0f}ms for {n} files")
+    index.close()
+
+# =====================================
+# Benchmark: timer scheduler (fake clock at scale, then real timers on one event loop)
+# =====================================
+class FakeClock:
+    def __init__(self, now=1_000_000.0): self.now = now
+    def __call__(self): return self.now
+
+async def _run_real_timers(count, spread):
+    fired = []; sched = shiv.TimerScheduler(lambda t, late: fired.append(late)); sched.start(); threads = threading.active_count()
+    for i in range(count): sched.add(0.05 + spread * i / count)
+    while len(fired) < count: await asyncio.sleep(0.05)
+    sched.stop(); return fired, threads
+
+def bench_timers(args):
+    print(f"Timer benchmark: {args.timers} timers"); failures = []
+    clock = FakeClock(); fired = []; sched = shiv.TimerScheduler(lambda t, late: fired.append(t.id), clock=clock); rng = random.Random(1)
+    t0 = time.perf_counter(); timers = [sched.add(rng.uniform(1, 86400)) for _ in range(args.timers)]; add_s = time.perf_counter() - t0
+    t0 = time.perf_counter(); victims = rng.sample(timers, args.timers // 10)
+    for t in victims: sched.cancel(t.id)
+    cancel_s = time.perf_counter() - t0
+    t0 = time.perf_counter(); listed = len(sched.pending()); list_s = time.perf_counter() - t0
+    t0 = time.perf_counter(); clock.now += 86401; sched.fire_due(); fire_s = time.perf_counter() - t0
+    cancelled = {t.id for t in victims}
+    print(f"  fake clock: add {add_s/args.timers*1e6:.1f}us/timer, cancel {cancel_s/len(victims)*1e6:.1f}us, list {listed} in {list_s*1000:.1f}ms, "
+          f"fire all {fire_s*1000:.0f}ms; fired={len(fired)} (expected {args.timers - len(victims)}), cancelled fired={len(cancelled & set(fired))}")
+    if len(fired) != args.timers - len(victims): failures.append(f"fake clock fired {len(fired)}, expected {args.timers - len(victims)}")
+    if cancelled & set(fired): failures.append(f"{len(cancelled & set(fired))} cancelled timers fired")
+    before = threading.active_count(); lates, threads = asyncio.run(_run_real_timers(args.real, args.spread))
+    print(f"  real loop: {len(lates)} timers over {args.spread}s, threads before={before} while running={threads}; "
+          f"lateness p50={percentile(lates, 50)*1000:.1f}ms p95={percentile(lates, 95)*1000:.1f}ms max={max(lates)*1000:.1f}ms")
+    if len(lates) != args.real: failures.append(f"real loop fired {len(lates)}, expected {args.real}")
+    if threads > before: failures.append(f"real loop ran {threads - before} extra thread(s)")
+    path = os.path.join(tempfile.gettempdir(), "shiva_timers_bench.sqlite3")
+    if os.path.exists(path): os.remove(path)
+    store = shiv.SQLiteTimerStore(path); persisted = shiv.TimerScheduler(store=store, clock=clock)
+    for i in range(100): persisted.add(60 * (i + 1), f"task {i}" if i % 2 else "")
+    store.close(); clock.now += 90; late = []
+    restored = shiv.TimerScheduler(lambda t, l: late.append(l), store=shiv.SQLiteTimerStore(path), clock=clock); restored.fire_due()
+    count = len(restored.pending()) + len(late)
+    print(f"  persistence: 100 saved, {count} restored, {len(late)} overdue fired on restart" + (f" (late by {late[0]:.0f}s)" if late else ""))
+    if count != 100: failures.append(f"restored {count} of 100 saved timers")
+    if len(late) != 1: failures.append(f"{len(late)} overdue timers fired on restart, expected 1")
+    print("  checks: " + ("; ".join(failures) if failures else "all passed"))
+    if failures: raise SystemExit(1)
+
+# =====================================
+# Replay harness: the whole command path, headless, against stub services
+# =====================================
+_REPLAY_SCRIPT = ["what time is it", "what is the date today", "search wikipedia for black holes", "what's the weather in delhi",
+                  "tell me a fun fact", "how does a rainbow form", "set a timer for 10 minutes", "what timers do i have",
+                  "cancel all timers", "what is your name", "who created you", "explain photosynthesis in simple words"]
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB (None where it cannot be read). """
+    try:
+        import resource; peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if os.uname().sysname == "Darwin" else peak / 1024
+    except (ImportError, AttributeError):
+        try: import psutil; return psutil.Process().memory_info().peak_wset / 2**20
+        except Exception: return None
+
+class ReplayInput:
+    """ ScriptedInput-compatible source of transcripts and/or WAV files (each WAV yields its front-end segments).
+        pace="serial" releases the next command only when the previous one has finished speaking. """
+    def __init__(self, items, pace, realtime=False, denoise=True):
+        self.items = deque(items); self.pace = pace; self.realtime = realtime; self.denoise = denoise; self.pipeline = None
+        self.segments = deque(); self.inputs = []; self.eos_delays = [] # Input timestamp per command; end-of-speech detection delays
+    async def _idle(self):
+        p = self.pipeline
+        while p.recognize_stats.processed < len(self.inputs) or p.inflight or p.command_q.qsize() or p.shiva.speech.is_speaking():
+            await asyncio.sleep(0.002)
+    async def next(self):
+        if self.pace == "serial": await self._idle()
+        while not self.segments:
+            if not self.items: return None
+            item = self.items.popleft()
+            if not item.lower().endswith(".wav"): self.inputs.append(time.perf_counter()); return item
+            frontend = shiv.AudioFrontEnd(shiv.WavFileSource(item, realtime=self.realtime), denoise=self.denoise).start()
+            while True:
+                segment = await frontend.next_segment()
+                if segment is None: break
+                self.segments.append(segment)
+            frontend.stop()
+        segment = self.segments.popleft(); self.inputs.append(segment.eos_at); self.eos_delays.append(segment.eos_s - segment.end_s); return segment
+
+class StageTimer:
+    """ Wraps callables so each call's duration lands in samples[stage]. """
+    def __init__(self): self.samples = {}
+    def add(self, stage, seconds): self.samples.setdefault(stage, []).append(seconds)
+    def wrap(self, stage, fn):
+        def timed(*a, **kw):
+            t0 = time.perf_counter()
+            try: return fn(*a, **kw)
+            finally: self.add(stage, time.perf_counter() - t0)
+        return timed
+    def wrap_async(self, stage, fn):
+        async def timed(*a, **kw):
+            t0 = time.perf_counter()
+            try: return await fn(*a, **kw)
+            finally: self.add(stage, time.perf_counter() - t0)
+        return timed
+
+def _replay_items(args):
+    items = []
+    for p in args.inputs:
+        if os.path.isdir(p) or p.lower().endswith(".wav"): items.extend(collect_wavs([p]))
+        else:
+            with open(p, encoding="utf-8") as f: items.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    return (items or list(_REPLAY_SCRIPT)) * args.repeat
+
+def bench_replay(args):
+    timer = StageTimer()
+    with patched(os, startfile=lambda *a, **k: None), patched(shiv.webbrowser, open=lambda *a, **k: True), \
+         patched(shiv.StreamingDenoiser, process=timer.wrap("nr (per frame)", shiv.StreamingDenoiser.process)), \
+         patched(shiv.INTENT_ROUTER, route=timer.wrap("routing", shiv.INTENT_ROUTER.route)): # Never launch apps/media while replaying; time NR and routing
+        return _replay(args, timer)
+
+def _replay(args, timer):
+    items = _replay_items(args); wavs = [i for i in items if i.lower().endswith(".wav")]
+    wiki_server = FakeWikipediaServer(args.wiki_latency, handshake_latency=0.0)
+    if args.stt == "replay":
+        refs = load_transcripts(wavs) if wavs else {}
+        missing = [w for w in wavs if os.path.abspath(w) not in refs]
+        if missing: raise SystemExit(f"{len(missing)} WAV(s) lack transcripts (transcripts.tsv or .txt); use --stt google/vosk/hybrid instead")
+        stt = TranscriptSTT([refs[os.path.abspath(w)] for w in wavs], args.stt_latency)
+    else: stt = {"google": shiv.GoogleSTT, "vosk": shiv.VoskSTT}.get(args.stt, lambda: shiv.HybridSTT(shiv.VoskSTT(), shiv.GoogleSTT()))()
+    engine = StubTTSEngine(args.seconds_per_char)
+    model = FakeGenerativeModel(first_token_delay=args.ai_first_token, chunk_delay=args.ai_chunk_delay)
+    shiva = shiv.Shiva(engine=engine, genai_model=model, calibrate_mic=False, cache=shiv.ResponseCache(max_entries=0 if args.no_cache else 512),
+                       stt=stt, media_index=shiv.MediaIndex(), timers=shiv.TimerScheduler(), wiki=shiv.WikipediaClient(wiki_server.url))
+    stt.recognize_async = timer.wrap_async("stt", stt.recognize_async)
+    shiva.process_command = timer.wrap_async("handler", shiva.process_command)
+    submit = shiva.speech.submit
+    def timed_submit(text, priority=shiv.PRIORITY_NORMAL):
+        utt = submit(text, priority); t0 = time.perf_counter(); utt.future.add_done_callback(lambda f: timer.add("tts", time.perf_counter() - t0)); return utt
+    shiva.speech.submit = timed_submit
+    replay = ReplayInput(items, args.pace, realtime=args.realtime, denoise=args.denoise)
+    pipeline = shiv.CommandPipeline(shiva, script=replay, supersede=args.pace == "serial"); replay.pipeline = pipeline
+    print(f"Replay: {len(items)} input(s) ({len(wavs)} WAV), pace={args.pace}, stt={args.stt}, AI first token {args.ai_first_token}s, Wikipedia {args.wiki_latency}s")
+    t0 = time.perf_counter(); stats = asyncio.run(pipeline.run())
+    while shiva.speech.is_speaking(): time.sleep(0.01)
+    wall = time.perf_counter() - t0; shiva.speech.shutdown(); wiki_server.close()
+    firsts = []
+    for i, t_in in enumerate(replay.inputs):
+        t_next = replay.inputs[i + 1] if i + 1 < len(replay.inputs) else float("inf"); first = next((t for t in engine.say_times if t_in <= t < t_next), None)
+        if first is not None: firsts.append(first - t_in)
+    if replay.eos_delays: timer.samples["capture (eos detect)"] = replay.eos_delays # In audio time
+    report = {"inputs": len(items), "commands": len(pipeline.handled), "wall_s": round(wall, 3), "throughput_cmd_s": round(len(pipeline.handled) / wall, 2) if wall else 0.0,
+              "peak_rss_mb": round(peak_rss_mb() or 0.0, 1), "stages": {}}
+    timer.samples["e2e (input -> first audio)"] = firsts; timer.samples["recognize stage wait"] = list(pipeline.recognize_stats.waits)
+    print(f"  {'stage':<28} {'n':>5} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage, samples in timer.samples.items():
+        if not samples: continue
+        row = {f"p{p}": round(percentile(samples, p) * 1000, 3) for p in (50, 95, 99)}; report["stages"][stage] = dict(row, n=len(samples))
+        print(f"  {stage:<28} {len(samples):5d} {row['p50']:7.2f}ms {row['p95']:7.2f}ms {row['p99']:7.2f}ms")
+    print(f"  throughput: {report['throughput_cmd_s']} commands/s ({report['commands']} in {wall:.2f}s)   peak RSS: {report['peak_rss_mb']} MB")
+    report["counters"] = shiv.METRICS.snapshot()["counters"]
+    if args.verbose: print(f"  pipeline: {stats}"); print(f"  counters: {report['counters']}")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+        print(f"  report saved to {args.save}")
+    if args.compare: return _compare_reports(args.compare, report, args.tolerance)
+
+def _compare_reports(baseline_path, report, tolerance):
+    """ Flags stages whose p95 grew more than tolerance (fraction) over the baseline; exits non-zero on regressions. """
+    with open(baseline_path, encoding="utf-8") as f: base = json.load(f)
+    regressions = []
+    for stage, row in report["stages"].items():
+        before, after = base.get("stages", {}).get(stage, {}).get("p95"), row["p95"]
+        if before and after > before * (1 + tolerance) and after - before > 1.0: regressions.append(f"{stage}: p95 {before:.1f}ms -> {after:.1f}ms")
+    print("  compared with baseline: " + ("; ".join(regressions) if regressions else f"no p95 regression beyond {tolerance:.0%}"))
+    if regressions: raise SystemExit(1)
+
+# =====================================
+# Benchmark: AI request manager against a local fake Gemini server (429s + latency)
+# =====================================
+class FakeGeminiServer:
+    """ Local HTTP stand-in for the Gemini endpoint: POST {"prompt": ...} -> {"text": ...} after latency seconds.
+        Returns 429 for a random error_rate of calls and whenever more than rpm calls arrive within a 60 s window. """
+    def __init__(self, latency=0.3, error_rate=0.1, rpm=240, seed=3):
+        import http.server
+        self.latency = latency; self.error_rate = error_rate; self.rpm = rpm; self.rng = random.Random(seed); self.lock = threading.Lock()
+        self.calls = 0; self.rejected = 0; self.window = deque(); server = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}"); now = time.monotonic()
+                with server.lock:
+                    server.calls += 1
+                    while server.window and now - server.window[0] > 60: server.window.popleft()
+                    limited = len(server.window) >= server.rpm or server.rng.random() < server.error_rate
+                    if limited: server.rejected += 1
+                    else: server.window.append(now)
+                time.sleep(server.latency * (0.2 if limited else 1.0))
+                payload = json.dumps({"error": "Resource has been exhausted (e.g. check quota)."} if limited else {"text": f"Answer to: {body.get('prompt', '')}. It is short."}).encode()
+                self.send_response(429 if limited else 200); self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(payload))); self.end_headers(); self.wfile.write(payload)
+            def log_message(self, *args): pass
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler); self.url = f"http://127.0.0.1:{self.httpd.server_port}/generate"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    def close(self): self.httpd.shutdown()
+
+class HTTPGenerativeModel:
+    """ genai.GenerativeModel look-alike that calls FakeGeminiServer; a 429 raises with the SDK's quota wording. """
+    def __init__(self, url): self.url = url
+    def _post(self, prompt):
+        import urllib.request, urllib.error
+        req = urllib.request.Request(self.url, data=json.dumps({"prompt": prompt}).encode(), headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp: return json.loads(resp.read())["text"]
+        except urllib.error.HTTPError as e:
+            if e.code == 429: raise RuntimeError("429 Resource has been exhausted (e.g. check quota).") from None
+            raise
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        text = await asyncio.get_running_loop().run_in_executor(None, self._post, prompt)
+        return _FakeResponse([text[i:i + 24] for i in range(0, len(text), 24)])
+
+async def _ai_load(call, questions, arrivals):
+    t0 = time.perf_counter(); results = []
+    async def one(q, at):
+        await asyncio.sleep(max(0.0, t0 + at - time.perf_counter())); start = time.perf_counter()
+        try: await call(q); outcome = "ok"
+        except shiv.AIDeadlineExceeded: outcome = "deadline"
+        except Exception: outcome = "error"
+        results.append((outcome, time.perf_counter() - start))
+    await asyncio.gather(*(one(q, at) for q, at in zip(questions, arrivals)))
+    return results, time.perf_counter() - t0
+
+def bench_ai(args):
+    rng = random.Random(9); topics = [f"question number {i}" for i in range(args.requests)]
+    questions = [rng.choice(topics[:max(1, len(topics) // 4)]) if rng.random() < args.duplicates else topics[i] for i in range(args.requests)]
+    arrivals = sorted(rng.uniform(0, args.spread) for _ in questions)
+    print(f"AI manager benchmark: {args.requests} requests over {args.spread}s ({args.duplicates:.0%} repeats), fake server latency {args.latency}s, "
+          f"random 429s {args.error_rate:.0%}, server limit {args.server_rpm} RPM")
+    for mode in ("direct", "managed"):
+        server = FakeGeminiServer(args.latency, args.error_rate, args.server_rpm); model = HTTPGenerativeModel(server.url)
+        if mode == "direct": call = model.generate_content_async; manager = None
+        else: manager = shiv.AIRequestManager(lambda: model, max_concurrency=args.concurrency, rpm=args.rpm, deadline=args.deadline); call = manager.generate
+        results, wall = asyncio.run(_ai_load(call, questions, arrivals)); server.close()
+        ok = [t for o, t in results if o == "ok"]; counts = {o: sum(1 for r in results if r[0] == o) for o in ("ok", "error", "deadline")}
+        print(f"  {mode:<8} ok={counts['ok']:<3} errors={counts['error']:<3} deadline fallbacks={counts['deadline']:<3} server calls={server.calls:<3} 429s={server.rejected:<3} "
+              f"latency p50={percentile(ok, 50)*1000:.0f}ms p95={percentile(ok, 95)*1000:.0f}ms  wall={wall:.1f}s")
+        if manager: print(f"           manager stats: {manager.stats}")
+
+# =====================================
+# Benchmark: Wikipedia lookups (blocking wikipedia package vs async pooled client with prefetch)
+# =====================================
+def bench_wiki(args):
+    import warnings, wikipedia as wikipedia_pkg
+    warnings.filterwarnings("ignore", module="wikipedia") # BeautifulSoup parser warning on disambiguation pages
+    server = FakeWikipediaServer(args.latency, args.handshake)
+    if args.serve:
+        print(f"Fake Wikipedia API at {server.url}\n  run Shiva with SHIVA_WIKIPEDIA_URL={server.url} (Ctrl+C to stop); pages: {', '.join(WIKI_PAGES)}")
+        try:
+            while True: time.sleep(1)
+        except KeyboardInterrupt: server.close(); return
+    terms = args.terms or ["gandhi", "taj mahal", "monsoon", "python programming", "einstein", "black holes", "mercury", "atlantis"]
+    print(f"Wikipedia benchmark: {len(terms)} lookups x {args.repeat}, fake API latency {args.latency*1000:.0f}ms + {args.handshake*1000:.0f}ms per new connection, "
+          f"speech {args.seconds_per_char}s/char")
+    print(f"  {'mode':<20} {'lookup p50':>10} {'first audio p50':>15} {'p95':>7} {'gap after announce':>18} {'loop stall max':>14} {'requests':>8} {'connections':>11}")
+    for mode in ("blocking package", "async client"):
+        engine = StubTTSEngine(args.seconds_per_char)
+        with contextlib.redirect_stdout(io.StringIO()):
+            shiva = shiv.Shiva(engine=engine, genai_model=FakeGenerativeModel(), calibrate_mic=False, cache=shiv.ResponseCache(max_entries=0), media_index=shiv.MediaIndex(), timers=shiv.TimerScheduler(),
+                               wiki=shiv.WikipediaClient(server.url))
+        requests0, connections0 = server.requests, server.connections; lookups = []; firsts = []; gaps = []; stalls = []
+        async def old_search(term):
+            """ The previous search_wikipedia: set_lang (which also clears the package's caches) and a blocking summary() on the loop. """
+            await shiva.speak(f"Searching Wikipedia for {term}...")
+            try:
+                wikipedia_pkg.set_lang("en"); wikipedia_pkg.wikipedia.API_URL = server.url; t0 = time.perf_counter()
+                results = wikipedia_pkg.summary(term, sentences=3, auto_suggest=True, redirect=True); lookups.append(time.perf_counter() - t0)
+                await shiva.speak(f"Wikipedia says: {results}")
+            except wikipedia_pkg.exceptions.DisambiguationError as e: await shiva.speak(f"'{term}' could mean: {', '.join(e.options[:3])}. Be specific?")
+            except wikipedia_pkg.exceptions.WikipediaException: await shiva.speak(f"No Wikipedia page for '{term}'.")
+        async def run():
+            for _ in range(args.repeat):
+                for term in terms:
+                    stop = asyncio.Event(); ticker = asyncio.ensure_future(_loop_lag_probe(stop, interval=0.005)); said0 = len(engine.said); t0 = time.perf_counter()
+                    if mode == "async client":
+                        lookup = shiva.wiki.summary; shiva.wiki.summary = lambda *a, **k: _timed_lookup(lookup, lookups, *a, **k)
+                        await shiva.search_wikipedia(term); shiva.wiki.summary = lookup
+                    else: await old_search(term)
+                    while shiva.speech.is_speaking(): await asyncio.sleep(0.005)
+                    stop.set(); stalls.append(await ticker)
+                    said = engine.said[said0:]; times = engine.say_times[said0:]
+                    if len(said) > 1: firsts.append(times[1] - t0); gaps.append(times[1] - times[0] - len(said[0]) * args.seconds_per_char)
+        with contextlib.redirect_stdout(io.StringIO()): asyncio.run(run())
+        shiva.speech.shutdown()
+        print(f"  {mode:<20} {percentile(lookups, 50)*1000:8.0f}ms {percentile(firsts, 50)*1000:13.0f}ms {percentile(firsts, 95)*1000:5.0f}ms "
+              f"{max(0.0, percentile(gaps, 50))*1000:16.0f}ms {max(stalls)*1000:12.0f}ms {server.requests - requests0:8d} {server.connections - connections0:11d}")
+    server.close()
+
+async def _timed_lookup(lookup, samples, *args, **kwargs):
+    t0 = time.perf_counter()
+    try: return await lookup(*args, **kwargs)
+    finally: samples.append(time.perf_counter() - t0)
+
+# =====================================
+# Benchmark: conversation memory (prompt tokens per turn, full history vs bounded window)
+# =====================================
+def bench_conversation(args):
+    model = FakeGenerativeModel(first_token_delay=args.latency, chunk_delay=0.0); engine = StubTTSEngine(0.0)
+    shiva = shiv.Shiva(engine=engine, genai_model=model, calibrate_mic=False, cache=shiv.ResponseCache(max_entries=0), media_index=shiv.MediaIndex(), timers=shiv.TimerScheduler(),
+                       ai_manager=shiv.AIRequestManager(lambda: model, rpm=100000), memory=shiv.ConversationMemory(token_budget=args.budget))
+    shiva.memory.summarizer = None if args.no_summary else shiva._summarize
+    questions = [f"follow-up question number {i} about the monsoon and the crops planted in region {i % 7}" for i in range(args.turns)]
+    naive = []; history = []; latencies = []
+    async def run():
+        for q in questions:
+            naive.append(shiv.estimate_tokens(q) + sum(shiv.estimate_tokens(a) + shiv.estimate_tokens(b) for a, b in history))
+            t0 = time.perf_counter(); answer = await shiva.ask_google_ai(q, conversation=True); latencies.append(time.perf_counter() - t0)
+            history.append((q, answer)); await asyncio.sleep(0)
+        if shiva.memory._compaction: await shiva.memory._compaction
+    with contextlib.redirect_stdout(io.StringIO()): asyncio.run(run())
+    stats = shiva.memory.turn_stats; bounded = [s["prompt_tokens"] or s["prompt_tokens_est"] for s in stats]
+    print(f"Conversation benchmark: {args.turns} turns, budget {args.budget} tokens, summarizer {'off' if args.no_summary else 'on'}")
+    print(f"  {'turn':>4}  {'full history':>12}  {'bounded':>8}  {'window':>6}  {'summary':>7}")
+    for s in stats:
+        if s["turn"] == 1 or s["turn"] % args.every == 0 or s["turn"] == len(stats):
+            print(f"  {s['turn']:>4}  {naive[s['turn'] - 1]:>12}  {bounded[s['turn'] - 1]:>8}  {s['window_turns']:>6}  {s['summary_tokens']:>7}")
+    print(f"  total prompt tokens: full history {sum(naive)}, bounded {sum(bounded)} ({1 - sum(bounded) / max(sum(naive), 1):.0%} fewer); "
+          f"max per turn {max(naive)} vs {max(bounded)}")
+    print(f"  model calls {model.calls} (answers {args.turns}, summaries {shiva.memory.compactions}); answer latency p50={percentile(latencies, 50)*1000:.0f}ms p95={percentile(latencies, 95)*1000:.0f}ms")
+
+# =====================================
+# Benchmark: wake-word gating (CPU per audio second, false accepts on background audio, misses on wake-word clips)
+# =====================================
+SYNTH_RATE = 16000
+VOWELS = {"i": (300, 2300), "e": (500, 1900), "a": (750, 1200), "o": (500, 900), "u": (320, 800), "ae": (650, 1700), "er": (500, 1400)}
+FRICATIVES = {"sh": (2500, 6000, 0.5), "s": (4000, 7500, 0.4), "f": (1000, 6000, 0.15), "v": (100, 1200, 0.2), "h": (500, 4000, 0.1)}
+WAKE_PHONES = [("sh", 0.11), ("i", 0.14), ("v", 0.05), ("a", 0.18)]
+
+def synth_phones(phones, rng, f0=None, stretch=0.15, shift=0.08):
+    """ Crude formant synthesis: vowels are harmonic series shaped by two resonances, fricatives band-limited noise.
+        Durations, pitch and formants are jittered per call, so every rendition differs like separate takes. """
+    f0 = f0 or rng.uniform(100, 220); out = []
+    for name, dur in phones:
+        n = int(SYNTH_RATE * dur * rng.uniform(1 - stretch, 1 + stretch)); t = np.arange(n) / SYNTH_RATE
+        if name in VOWELS:
+            f1, f2 = (f * rng.uniform(1 - shift, 1 + shift) for f in VOWELS[name]); k = np.arange(1, int(4000 / f0) + 1); freqs = k * f0
+            amps = 1 / (1 + ((freqs - f1) / 80) ** 2) + 0.6 / (1 + ((freqs - f2) / 120) ** 2) + 0.02
+            x = (amps[:, None] * np.sin(2 * np.pi * freqs[:, None] * t[None, :] + rng_normal(rng, len(k))[:, None])).sum(axis=0)
+        else:
+            lo, hi, gain = FRICATIVES[name]; spec = np.fft.rfft(rng_normal(rng, n)); f = np.fft.rfftfreq(n, 1 / SYNTH_RATE)
+            spec[(f < lo) | (f > hi)] = 0; x = np.fft.irfft(spec, n) * gain * 8
+        ramp = min(n // 2, int(0.01 * SYNTH_RATE)); env = np.ones(n)
+        if ramp: env[:ramp] = np.linspace(0, 1, ramp); env[-ramp:] = np.linspace(1, 0, ramp)
+        out.append(x * env)
+    x = np.concatenate(out); return x / (np.abs(x).max() + 1e-9)
+
+def rng_normal(rng, n): return np.random.default_rng(rng.randrange(1 << 30)).standard_normal(n)
+
+def synth_babble_word(rng):
+    phones = []
+    for _ in range(rng.randint(1, 3)):
+        if rng.random() < 0.7: phones.append((rng.choice(list(FRICATIVES)), rng.uniform(0.04, 0.12)))
+        phones.append((rng.choice(list(VOWELS)), rng.uniform(0.08, 0.2)))
+    return synth_phones(phones, rng)
+
+def synth_stream(rng, seconds, keyword_every=None):
+    """ Background "office": words from several talkers with pauses over a noise floor. With keyword_every, a wake-word
+        rendition (followed by a short command) every keyword_every seconds; returns int16 samples and keyword spans. """
+    total = int(seconds * SYNTH_RATE); x = rng_normal(rng, total) * 0.003 + 0.002 * np.sin(2 * np.pi * 50 * np.arange(total) / SYNTH_RATE); spans = []
+    pos = 0; next_kw = keyword_every * SYNTH_RATE * 0.5 if keyword_every else None
+    while pos < total:
+        if next_kw is not None and pos >= next_kw:
+            word = synth_phones(WAKE_PHONES, rng) * rng.uniform(0.3, 0.6); spans.append((pos / SYNTH_RATE, (pos + len(word)) / SYNTH_RATE)); next_kw += keyword_every * SYNTH_RATE
+        else: word = synth_babble_word(rng) * rng.uniform(0.05, 0.5)
+        end = min(total, pos + len(word)); x[pos:end] += word[:end - pos]; pos = end + int(SYNTH_RATE * rng.choice([rng.uniform(0.05, 0.3), rng.uniform(0.5, 3.0)]))
+    return (np.clip(x, -1, 1) * 32767).astype(np.int16), spans
+
+def _write_wav(path, samples, rate=SYNTH_RATE):
+    with wave.open(path, "wb") as wf: wf.setnchannels(1); wf.setsampwidth(2); wf.setframerate(rate); wf.writeframes(samples.tobytes())
+
+def _run_frontend(samples, rate, wake=None, denoise=True):
+    """ Feeds samples through an AudioFrontEnd frame by frame (no thread); returns (segments, cpu seconds, wake-gate detection times). """
+    fe = shiv.AudioFrontEnd(None, denoise=denoise, wake=wake); segments = []; hits = []
+    with contextlib.redirect_stdout(io.StringIO()): seg = fe.setup(rate)
+    n = seg.frame_samples; pcm = samples.tobytes()
+    if wake is not None:
+        feed = wake.feed; wake.feed = lambda frame: (feed(frame) and hits.append(wake._t)) or False
+    cpu0 = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(0, len(samples) - n + 1, n):
+            segment = fe.process_frame(pcm[2 * i:2 * (i + n)])
+            if segment: segments.append(segment)
+    return segments, time.process_time() - cpu0, hits
+
+def bench_wake(args):
+    rng = random.Random(17); tmp = tempfile.mkdtemp(prefix="shiva_wake_")
+    if args.templates: templates = sorted(glob.glob(os.path.join(args.templates, "*.wav")))
+    else:
+        templates = []
+        for i in range(args.enroll):
+            path = os.path.join(tmp, f"template_{i}.wav"); _write_wav(path, (synth_phones(WAKE_PHONES, rng) * 0.5 * 32767).astype(np.int16)); templates.append(path)
+    if args.background: background = [(p, shiv._read_wav_mono16(p, SYNTH_RATE)) for p in collect_wavs(args.background)]
+    else: background = [("synthetic office babble", synth_stream(rng, args.minutes * 60)[0])]
+    if args.positives: positives = [(p, shiv._read_wav_mono16(p, SYNTH_RATE), None) for p in collect_wavs(args.positives)]
+    else: samples, spans = synth_stream(rng, args.keywords * 6.0, keyword_every=6.0); positives = [("synthetic wake words", samples, spans)]
+    bg_seconds = sum(len(x) for _, x in background) / SYNTH_RATE
+    print(f"Wake-word benchmark: {len(templates)} template(s), {bg_seconds/60:.1f} min of background ({', '.join(n for n, _ in background)}), sensitivities {args.sensitivity}")
+    speech_s = lambda segs: sum(len(s.audio.frame_data) / 2 / SYNTH_RATE for s in segs)
+    ungated_cpu = 0.0; ungated = []
+    for _, x in background: segs, cpu, _ = _run_frontend(x, SYNTH_RATE); ungated_cpu += cpu; ungated += segs
+    print("  front-end CPU is VAD + streaming NR (+ spotter); every STT call also costs a cloud round-trip or local decoding of its audio")
+    print(f"  {'config':<22} {'CPU/audio s':>11} {'core %':>7} {'false accepts/h':>15} {'STT calls/h':>11} {'STT audio/h':>11} {'wake hits':>9} {'missed':>7}")
+    print(f"  {'ungated':<22} {ungated_cpu/bg_seconds*1000:9.1f}ms {ungated_cpu/bg_seconds*100:6.1f}% {'-':>15} {len(ungated)/bg_seconds*3600:11.0f} "
+          f"{speech_s(ungated)/bg_seconds*60:9.1f}min {'-':>9} {'-':>7}")
+    for sensitivity in args.sensitivity:
+        cpu = 0.0; detections = 0; admitted = []
+        for _, x in background:
+            gate = shiv.WakeWordGate(shiv.TemplateKeywordSpotter(templates), sensitivity=sensitivity)
+            segs, c, hits = _run_frontend(x, SYNTH_RATE, wake=gate); cpu += c; detections += len(hits); admitted += segs
+        found = expected = 0
+        for _, x, spans in positives:
+            gate = shiv.WakeWordGate(shiv.TemplateKeywordSpotter(templates), sensitivity=sensitivity); _, _, hits = _run_frontend(x, SYNTH_RATE, wake=gate)
+            if spans is None: expected += 1; found += bool(hits)
+            else: expected += len(spans); found += sum(any(a <= h <= b + 0.5 for h in hits) for a, b in spans)
+        print(f"  {f'gated, sensitivity {sensitivity:g}':<22} {cpu/bg_seconds*1000:9.1f}ms {cpu/bg_seconds*100:6.1f}% {detections/bg_seconds*3600:15.1f} {len(admitted)/bg_seconds*3600:11.0f} "
+              f"{speech_s(admitted)/bg_seconds*60:9.1f}min "
+              f"{found:>4}/{expected:<4} {1 - found/max(expected, 1):6.0%}")
+
+# =====================================
+# Benchmark: speech recognition backends (latency + WER on labeled WAVs)
+# =====================================
+def load_transcripts(paths):
+    """ Reference text per WAV: a sibling transcripts.tsv ('file.wav<TAB>text') or a file.txt next to file.wav. """
+    refs = {}
+    for folder in {os.path.dirname(os.path.abspath(p)) for p in paths}:
+        tsv = os.path.join(folder, "transcripts.tsv")
+        if os.path.exists(tsv):
+            with open(tsv, encoding="utf-8") as f:
+                for line in f:
+                    if "\t" in line: name, text = line.rstrip("\n").split("\t", 1); refs[os.path.join(folder, name)] = text
+    for p in paths:
+        txt = os.path.splitext(p)[0] + ".txt"
+        if os.path.abspath(p) not in refs and os.path.exists(txt):
+            with open(txt, encoding="utf-8") as f: refs[os.path.abspath(p)] = f.read().strip()
+    return {os.path.abspath(k): v for k, v in refs.items()}
+
+def _words(text): return re.findall(r"[a-z0-9']+", (text or "").lower())
+
+def word_errors(reference, hypothesis):
+    """ Word-level Levenshtein distance (substitutions + deletions + insertions) and the reference length. """
+    ref, hyp = _words(reference), _words(hypothesis); prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i]
+        for j, h in enumerate(hyp, 1): cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h)))
+        prev = cur
+    return prev[-1], len(ref)
+
+def _make_backend(name, args):
+    if name == "google": return shiv.GoogleSTT()
+    if name == "vosk": return shiv.VoskSTT(args.vosk_model)
+    if name == "hybrid": return shiv.HybridSTT(shiv.VoskSTT(args.vosk_model), shiv.GoogleSTT(), min_confidence=args.min_confidence, deadline=args.deadline)
+    raise SystemExit(f"unknown backend {name!r}")
+
+def bench_stt(args):
+    paths = collect_wavs(args.wavs); refs = load_transcripts(paths)
+    labeled = [p for p in paths if os.path.abspath(p) in refs]
+    if not labeled: raise SystemExit("No labeled WAVs: give folders with transcripts.tsv or file.txt next to each file.wav")
+    clips = []
+    for path in labeled:
+        with shiv.sr.AudioFile(path) as source: clips.append((path, shiv.sr.Recognizer().record(source)))
+    print(f"STT benchmark: {len(clips)} labeled clip(s), backends: {', '.join(args.backend)}")
+    print(f"  {'backend':<8} {'warm-up':>8}  {'WER':>6}  {'p50':>7} {'p95':>7}  {'failed':>6}")
+    for name in args.backend:
+        backend = _make_backend(name, args); t0 = time.perf_counter()
+        try: backend.warm_up()
+        except Exception as e: print(f"  {name:<8} unavailable: {e}"); continue
+        warm = time.perf_counter() - t0; errors = words = failed = 0; latencies = []
+        for path, audio in clips:
+            t0 = time.perf_counter()
+            try: result = asyncio.run(backend.recognize_async(audio))
+            except Exception as e:
+                result = None
+                if args.verbose: print(f"    {os.path.basename(path)}: {type(e).__name__}: {e}")
+            latencies.append(time.perf_counter() - t0); failed += result is None
+            e, n = word_errors(refs[os.path.abspath(path)], result.text if result else ""); errors += e; words += n
+            if args.verbose: print(f"    {os.path.basename(path)}: {result!r}")
+        print(f"  {name:<8} {warm*1000:6.0f}ms  {errors/max(words,1)*100:5.1f}%  {percentile(latencies, 50)*1000:5.0f}ms {percentile(latencies, 95)*1000:5.0f}ms  {failed:6d}")
+        if isinstance(backend, shiv.HybridSTT): print(f"           hybrid: {backend.stats}")
+
+# =====================================
+# Benchmark: speculative AI fallback (AI started on the hybrid STT's local transcript while the cloud confirms it)
+# =====================================
+SPECULATION_CASES = [ # (local partial, final transcript)
+    ("why do cats purr", "why do cats purr"), ("explain how vaccines work", "explain how vaccines work"),
+    ("what is the speed of light", "what is the speed of light"), ("how do airplanes stay in the air", "how do airplanes stay in the air"),
+    ("what causes the northern lights", "what causes the northern lights"), ("what is meant by entropy", "what is meant by entropy"),
+    ("how far is the moon", "how far is the moon from earth"), # Partial was cut short: speculation discarded, AI asked again
+    ("who made you", "who created you"), # Speculated, then a built-in wins
+    ("what time is it", "what time is it"), ("what's the wether like", "what's the weather like"), ("how are you", "how are you"), # Router sure enough: no speculation
+]
+
+class ScriptedSTT(shiv.STTBackend):
+    """ Returns .current (set per command) after latency seconds with a fixed confidence. """
+    def __init__(self, name, latency, confidence): self.name = name; self.latency = latency; self.confidence = confidence; self.current = None
+    def recognize(self, audio_data): time.sleep(self.latency); return shiv.RecognitionResult(self.current, self.confidence, self.name, self.latency)
+
+def bench_speculate(args):
+    audio = shiv.sr.AudioData(b"\0" * 3200, 16000, 2); rows = {}
+    print(f"Speculative AI benchmark: {len(SPECULATION_CASES)} commands x {args.repeat}; hybrid STT local {args.local_latency*1000:.0f}ms (unsure) + cloud {args.cloud_latency*1000:.0f}ms, "
+          f"fake Gemini first token {args.ai_latency*1000:.0f}ms; speculate below built-in confidence {shiv.SPECULATIVE_AI_MAX_CONFIDENCE}")
+    for enabled in (False, True):
+        local = ScriptedSTT("local", args.local_latency, 0.5); cloud = ScriptedSTT("cloud", args.cloud_latency, 0.9)
+        model = FakeGenerativeModel(first_token_delay=args.ai_latency, chunk_delay=0.05); engine = StubTTSEngine(0.0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            shiva = shiv.Shiva(engine=engine, genai_model=model, calibrate_mic=False, cache=shiv.ResponseCache(max_entries=0), media_index=shiv.MediaIndex(),
+                               stt=shiv.HybridSTT(local, cloud, local_deadline=1.0, deadline=3.0), timers=shiv.TimerScheduler(), ai_manager=shiv.AIRequestManager(lambda: model, rpm=100000))
+        firsts = {}
+        async def run():
+            for _ in range(args.repeat):
+                for partial, final in SPECULATION_CASES:
+                    local.current = partial; cloud.current = final; said0 = len(engine.said); t0 = time.perf_counter()
+                    query = await shiva._recognize(audio); await shiva.process_command(query)
+                    while shiva.speech.is_speaking(): await asyncio.sleep(0.005)
+                    if len(engine.said) > said0: firsts.setdefault((partial, final), []).append(engine.say_times[said0] - t0)
+        with contextlib.redirect_stdout(io.StringIO()), patched(shiv, ENABLE_SPECULATIVE_AI=enabled): asyncio.run(run())
+        shiva.speech.shutdown(); rows[enabled] = (firsts, dict(shiva.speculation_stats), model.calls, shiva.ai.stats["requests"])
+    (off, _, calls_off, _), (on, stats, calls_on, _) = rows[False], rows[True]
+    print(f"  {'final transcript':<34} {'built-in conf':>13} {'first audio off':>15} {'on':>7} {'saved':>7}")
+    for partial, final in SPECULATION_CASES:
+        a = percentile(off[(partial, final)], 50); b = percentile(on[(partial, final)], 50)
+        print(f"  {final:<34} {shiv.INTENT_ROUTER.builtin_confidence(partial):13.2f} {a*1000:13.0f}ms {b*1000:5.0f}ms {(a - b)*1000:5.0f}ms")
+    ai_cases = [c for c in SPECULATION_CASES if shiv.INTENT_ROUTER.route(c[1]) is None]
+    ai_off = [x for c in ai_cases for x in off[c]]; ai_on = [x for c in ai_cases for x in on[c]]
+    print(f"  AI answers, end-of-speech -> first audio: p50 {percentile(ai_off, 50)*1000:.0f} -> {percentile(ai_on, 50)*1000:.0f}ms, p95 {percentile(ai_off, 95)*1000:.0f} -> {percentile(ai_on, 95)*1000:.0f}ms")
+    print(f"  speculation: {stats['started']} started, {stats['adopted']} adopted, {stats['discarded']} discarded; latency saved {stats['latency_saved_s']:.2f}s total "
+          f"({stats['latency_saved_s'] / max(stats['adopted'], 1) * 1000:.0f}ms per adopted answer); ~{stats['tokens_wasted']} tokens wasted "
+          f"({stats['tokens_wasted'] / max(stats['discarded'], 1):.0f} per discard); model calls {calls_off} -> {calls_on}")
+
+# =====================================
+# Benchmark: server mode load test (concurrent WebSocket sessions per core)
+# =====================================
+SERVER_MIX = [("what time is it", 3), ("what is the date today", 1), ("how are you", 1), ("set a timer for 5 seconds", 1), ("wikipedia black hole", 2), (None, 4)] # None: a fresh AI question
+
+class CycleSTT(shiv.STTBackend):
+    """ Returns the next of a fixed set of transcripts after latency seconds (server load test). """
+    name = "cycle"
+    def __init__(self, transcripts, latency=0.05): self.transcripts = itertools.cycle(transcripts); self.latency = latency
+    def recognize(self, audio_data): time.sleep(self.latency); return shiv.RecognitionResult(next(self.transcripts), 1.0, self.name, self.latency)
+
+def _serve_child(args):
+    """ The server process of the load test: ShivaServer with fake Gemini / STT and the parent's fake Wikipedia. """
+    model = FakeGenerativeModel(first_token_delay=args.ai_latency, chunk_delay=0.05)
+    server = shiv.ShivaServer("127.0.0.1", 0, stt=CycleSTT(["what time is it", "how are you"], args.stt_latency), genai_model=model, cache=shiv.ResponseCache(),
+                              ai_manager=shiv.AIRequestManager(lambda: model, max_concurrency=512, rpm=10**6, tpm=10**9), wiki=shiv.WikipediaClient(args.wiki_url),
+                              max_sessions=args.max_sessions)
+    async def run():
+        await server.start()
+        with open(args.port_file + ".tmp", "w") as f: f.write(str(server.port))
+        os.replace(args.port_file + ".tmp", args.port_file); await server._server.serve_forever()
+    asyncio.run(run())
+
+class WSClient:
+    """ Minimal asyncio WebSocket client (masked frames, shiv's framing helpers) for the load test. """
+    def __init__(self, reader, writer): self.reader = reader; self.writer = writer
+    @classmethod
+    async def connect(cls, port, path="/v1/ws"):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port); key = base64.b64encode(os.urandom(16)).decode()
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode())
+        status = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b""): pass
+        if b" 101 " not in status: writer.close(); raise ConnectionError(status.decode().strip())
+        return cls(reader, writer)
+    def send(self, payload, opcode=0x1): self.writer.write(shiv._ws_frame(payload, opcode, os.urandom(4)))
+    async def send_json(self, message): self.send(json.dumps(message).encode()); await self.writer.drain()
+    async def recv(self):
+        """ Next JSON message, or None once the server closes. """
+        while True:
+            _, opcode, data = await shiv._ws_read_frame(self.reader, 1 << 24)
+            if opcode == 0x8: return None
+            if opcode == 0x1: return json.loads(data)
+    def close(self): self.writer.close()
+
+def _utterance_pcm(rng, rate=SYNTH_RATE):
+    """ 0.6 s room noise, ~1 s of synthetic speech, 0.1 s noise: what an audio client streams for one command. """
+    noise = lambda s: rng_normal(rng, int(s * rate)) * 0.002
+    speech = np.concatenate([synth_babble_word(rng) * 0.4 for _ in range(3)])
+    return (np.clip(np.concatenate([noise(0.6), speech + noise(len(speech) / rate), noise(0.1)]), -1, 1) * 32767).astype(np.int16).tobytes()
+
+async def _load_user(port, rng, stop_at, think, clips, results):
+    """ One client: a command every ~think seconds (typed, or streamed PCM in real time if clips), timing each reply. """
+    try: client = await WSClient.connect(port)
+    except (OSError, ConnectionError): results["errors"] += 1; return
+    try:
+        if (await client.recv() or {}).get("type") != "session": results["errors"] += 1; return
+        await asyncio.sleep(rng.uniform(0, think))
+        while time.perf_counter() < stop_at:
+            expect = None
+            if clips:
+                pcm = rng.choice(clips); step = int(SYNTH_RATE * 0.03) * 2
+                for i in range(0, len(pcm), step): client.send(pcm[i:i + step], 0x2); await asyncio.sleep(0.03)
+                await client.send_json({"type": "end_audio"})
+            else:
+                expect = next(text for text, w in rng.choices(SERVER_MIX, weights=[w for _, w in SERVER_MIX])) or None
+                expect = expect or f"why do monsoon winds change direction over region {rng.randrange(10**6)}"
+                await client.send_json({"type": "text", "text": expect})
+            t0 = time.perf_counter(); first = None
+            while True:
+                message = await asyncio.wait_for(client.recv(), 30)
+                if message is None: results["errors"] += 1; return
+                kind = message["type"]
+                if kind == "transcript" and expect is None: expect = message["text"]
+                if kind == "say" and first is None and message["priority"] != shiv.PRIORITY_URGENT: first = time.perf_counter() - t0 # Not a timer alert
+                if kind == "done" and message["query"] == expect: break
+            if time.perf_counter() <= stop_at:
+                results["reply"].append(first if first is not None else time.perf_counter() - t0); results["done"].append(time.perf_counter() - t0); results["commands"] += 1
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * think)
+    except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError): results["errors"] += 1
+    finally: client.close()
+
+def _http_json(port, method, path, body=None, ctype="application/json"):
+    import urllib.request
+    data = body if isinstance(body, bytes) or body is None else json.dumps(body).encode()
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data, method=method, headers={"Content-Type": ctype})
+    with urllib.request.urlopen(request, timeout=30) as r: return json.loads(r.read())
+
+def bench_server(args):
+    if args.child: return _serve_child(args)
+    import subprocess, sys
+    wiki = FakeWikipediaServer(latency=args.wiki_latency, handshake_latency=0.0); port_file = os.path.join(tempfile.mkdtemp(prefix="shiva_server_"), "port")
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "server", "--child", "--port-file", port_file, "--wiki-url", wiki.url, "--ai-latency", str(args.ai_latency),
+                              "--stt-latency", str(args.stt_latency), "--max-sessions", str(max(args.sessions) + 10)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(600):
+            if os.path.exists(port_file) or child.poll() is not None: break
+            time.sleep(0.05)
+        if not os.path.exists(port_file): print("Server child failed to start."); return
+        with open(port_file) as f: port = int(f.read())
+        rng = random.Random(5); clips = [_utterance_pcm(rng) for _ in range(4)]
+        sid = _http_json(port, "POST", "/v1/sessions")["id"]; t0 = time.perf_counter(); text = _http_json(port, "POST", f"/v1/sessions/{sid}/text", {"text": "what time is it"})["messages"]
+        http_text = time.perf_counter() - t0; buf = io.BytesIO(); _write_wav(buf, np.frombuffer(clips[0], np.int16)); t0 = time.perf_counter()
+        audio = _http_json(port, "POST", f"/v1/sessions/{sid}/audio", buf.getvalue(), "audio/wav")["messages"]; http_audio = time.perf_counter() - t0; _http_json(port, "DELETE", f"/v1/sessions/{sid}")
+        print(f"Server load test: python shiv.py --server equivalent with fake Gemini (first token {args.ai_latency*1000:.0f}ms), STT ({args.stt_latency*1000:.0f}ms) and Wikipedia "
+              f"({args.wiki_latency*1000:.0f}ms); {os.cpu_count()} CPU(s), load generator on the same machine")
+        print(f"  HTTP check: text -> {[m['type'] for m in text]} in {http_text*1000:.0f}ms; WAV -> {[m['type'] for m in audio]} in {http_audio*1000:.0f}ms")
+        print(f"  each session: one command per ~{args.think:g}s ({args.audio:.0%} streaming PCM in real time, the rest typed: time, date, timers, Wikipedia, AI questions); "
+              f"SLO p95 first reply <= {args.slo_ms:.0f}ms")
+        print(f"  {'sessions':>8} {'commands/s':>10} {'reply p50':>9} {'p95':>7} {'done p95':>8} {'server CPU':>10} {'CPU/command':>11} {'load gen CPU':>12} {'errors':>6}")
+        best = None
+        for n in args.sessions:
+            results = {"reply": [], "done": [], "commands": 0, "errors": 0}
+            async def level():
+                stop_at = time.perf_counter() + args.ramp + args.seconds; users = []
+                for i in range(n):
+                    user_rng = random.Random(i * 7919 + n)
+                    users.append(asyncio.ensure_future(_load_user(port, user_rng, stop_at, args.think, clips if user_rng.random() < args.audio else None, results)))
+                await asyncio.sleep(args.ramp); results.update(reply=[], done=[], commands=0)
+                health0 = await asyncio.get_running_loop().run_in_executor(None, _http_json, port, "GET", "/v1/health"); t0 = time.perf_counter(); cpu0 = time.process_time()
+                await asyncio.sleep(args.seconds)
+                health1 = await asyncio.get_running_loop().run_in_executor(None, _http_json, port, "GET", "/v1/health")
+                results["cpu"] = (health1["cpu_seconds"] - health0["cpu_seconds"]) / (time.perf_counter() - t0); results["window"] = time.perf_counter() - t0
+                results["client_cpu"] = (time.process_time() - cpu0) / results["window"]
+                await asyncio.gather(*users, return_exceptions=True)
+            asyncio.run(level())
+            p95 = percentile(results["reply"], 95) if results["reply"] else float("inf"); rate = results["commands"] / results["window"]
+            print(f"  {n:>8} {rate:10.1f} {percentile(results['reply'], 50)*1000 if results['reply'] else 0:7.0f}ms {p95*1000:5.0f}ms {percentile(results['done'], 95)*1000 if results['done'] else 0:6.0f}ms "
+                  f"{results['cpu']:9.0%} {results['cpu'] / max(rate, 1e-9) * 1000:9.1f}ms {results['client_cpu']:12.0%} {results['errors']:6d}")
+            if p95 * 1000 <= args.slo_ms and not results["errors"]: best = (n, results["cpu"])
+            else: break
+        health = _http_json(port, "GET", "/v1/health")
+        print(f"  shared across sessions: STT backend {health['stt']} (warmed once), AI calls {health['ai_requests']['calls']} ({health['ai_requests']['coalesced']} coalesced), "
+              f"cache {health['cache']}, sessions opened {health['sessions_opened']}")
+        if best:
+            n, cpu = best
+            print(f"  sustained {n} concurrent sessions within the SLO using {cpu:.0%} of a core -> ~{n / max(cpu, 1e-9):.0f} sessions per core at this command rate "
+                  f"(one event loop: add processes behind a load balancer to use more cores)")
+        else: print("  no level met the SLO")
+    finally:
+        child.terminate(); child.wait(5); wiki.close()
+
+# =====================================
+# Entry point
+# =====================================
+def main():
+    parser = argparse.ArgumentParser(description="Shiva offline benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    p = sub.add_parser("router", help="old elif chain vs compiled IntentRouter: latency and routing accuracy")
+    p.add_argument("--corpus", help="TSV file of 'intent<TAB>transcript' lines (default: synthetic corpus)")
+    p.add_argument("--size", type=int, default=5000, help="synthetic corpus size"); p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--show-diffs", action="store_true", help="list transcripts the two routers disagree on")
+    p.set_defaults(func=bench_router)
+    p = sub.add_parser("stream", help="blocking vs streamed AI answer against a fake model: time-to-first-audio")
+    p.add_argument("--first-token-delay", type=float, default=0.4); p.add_argument("--chunk-delay", type=float, default=0.08)
+    p.add_argument("--chunk-chars", type=int, default=24); p.add_argument("--seconds-per-char", type=float, default=0.004)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_stream)
+    p = sub.add_parser("tts", help="speech worker against a stub engine: preemption, barge-in and event-loop stalls")
+    p.add_argument("--sentences", type=int, default=8); p.add_argument("--alert-after", type=float, default=0.3)
+    p.add_argument("--seconds-per-char", type=float, default=0.004)
+    p.set_defaults(func=bench_tts)
+    p = sub.add_parser("vad", help="streaming VAD front-end over WAV files: segmentation and end-of-speech latency")
+    p.add_argument("wavs", nargs="*", help="WAV files or folders (default: a synthetic clip)")
+    p.add_argument("--hangover-ms", type=int, default=shiv.VAD_HANGOVER_MS); p.add_argument("--pre-roll-ms", type=int, default=shiv.VAD_PRE_ROLL_MS)
+    p.add_argument("--realtime", action="store_true", help="pace the WAV at real-time speed")
+    p.add_argument("--recognize", action="store_true", help="also run Google recognition (network) and report EOS->text latency")
+    p.set_defaults(func=bench_vad)
+    p = sub.add_parser("denoise", help="streaming denoiser vs whole-utterance noisereduce: real-time factor and peak memory")
+    p.add_argument("wavs", nargs="*", help="WAV files or folders (default: a synthetic clip)")
+    p.set_defaults(func=bench_denoise)
+    p = sub.add_parser("stt", help="speech recognition backends over labeled WAVs: latency and word error rate")
+    p.add_argument("wavs", nargs="+", help="WAV files or folders with transcripts.tsv or .txt references")
+    p.add_argument("--backend", nargs="+", default=["google", "vosk", "hybrid"], choices=["google", "vosk", "hybrid"])
+    p.add_argument("--vosk-model", default=shiv.VOSK_MODEL_PATH); p.add_argument("--min-confidence", type=float, default=shiv.STT_MIN_CONFIDENCE)
+    p.add_argument("--deadline", type=float, default=shiv.STT_DEADLINE_SECONDS); p.add_argument("--verbose", action="store_true")
+    p.set_defaults(func=bench_stt)
+    p = sub.add_parser("pipeline", help="serial voice loop vs concurrent pipeline on a scripted session: interrupt reaction and stage stats")
+    p.add_argument("--first-token-delay", type=float, default=1.5); p.add_argument("--chunk-delay", type=float, default=0.08)
+    p.add_argument("--seconds-per-char", type=float, default=0.004); p.add_argument("--skip-serial", action="store_true", help="the serial run waits out the 30s pause")
+    p.set_defaults(func=bench_pipeline)
+    p = sub.add_parser("media", help="media index over a (synthetic) library: scan/rescan time and fuzzy lookup latency")
+    p.add_argument("--files", type=int, default=100000); p.add_argument("--root", help="existing library folder instead of a synthetic tree")
+    p.add_argument("--keep-db", action="store_true", help="reuse the previous index (measures a warm incremental scan)")
+    p.set_defaults(func=bench_media)
+    p = sub.add_parser("timers", help="timer scheduler: add/cancel/fire cost at scale, lateness and thread count on a real loop, persistence")
+    p.add_argument("--timers", type=int, default=100000); p.add_argument("--real", type=int, default=5000); p.add_argument("--spread", type=float, default=2.0)
+    p.set_defaults(func=bench_timers)
+    p = sub.add_parser("replay", help="headless replay of transcripts/WAVs through the full pipeline with stub services: per-stage p50/p95/p99")
+    p.add_argument("inputs", nargs="*", help="transcript files (one command per line), WAV files or folders (default: built-in script)")
+    p.add_argument("--pace", choices=["serial", "batch"], default="serial", help="serial: one command at a time (latency); batch: as fast as possible (throughput)")
+    p.add_argument("--repeat", type=int, default=1); p.add_argument("--stt", choices=["replay", "google", "vosk", "hybrid"], default="replay")
+    p.add_argument("--stt-latency", type=float, default=0.3); p.add_argument("--ai-first-token", type=float, default=0.6)
+    p.add_argument("--ai-chunk-delay", type=float, default=0.05); p.add_argument("--wiki-latency", type=float, default=0.4)
+    p.add_argument("--seconds-per-char", type=float, default=0.002); p.add_argument("--realtime", action="store_true", help="pace WAVs at real-time speed")
+    p.add_argument("--no-denoise", dest="denoise", action="store_false"); p.add_argument("--no-cache", action="store_true")
+    p.add_argument("--save", help="write the report as JSON"); p.add_argument("--compare", help="baseline JSON report; exit 1 on p95 regressions")
+    p.add_argument("--tolerance", type=float, default=0.2); p.add_argument("--verbose", action="store_true")
+    p.set_defaults(func=bench_replay)
+    p = sub.add_parser("ai", help="AI request manager vs direct calls against a local fake server injecting 429s and latency")
+    p.add_argument("--requests", type=int, default=60); p.add_argument("--spread", type=float, default=5.0, help="arrival window, seconds")
+    p.add_argument("--duplicates", type=float, default=0.3); p.add_argument("--latency", type=float, default=0.3); p.add_argument("--error-rate", type=float, default=0.1)
+    p.add_argument("--server-rpm", type=int, default=40); p.add_argument("--rpm", type=int, default=36); p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--deadline", type=float, default=10.0)
+    p.set_defaults(func=bench_ai)
+    p = sub.add_parser("wiki", help="Wikipedia lookups against a local fake API: blocking wikipedia package vs async pooled client with prefetch")
+    p.add_argument("terms", nargs="*"); p.add_argument("--repeat", type=int, default=2); p.add_argument("--latency", type=float, default=0.15)
+    p.add_argument("--handshake", type=float, default=0.1, help="extra seconds per new connection (TCP + TLS on the real site)")
+    p.add_argument("--seconds-per-char", type=float, default=0.01); p.add_argument("--serve", action="store_true", help="only run the fake API (for SHIVA_WIKIPEDIA_URL)")
+    p.set_defaults(func=bench_wiki)
+    p = sub.add_parser("conversation", help="conversation memory: prompt tokens per turn, full history vs token-budgeted window with summaries")
+    p.add_argument("--turns", type=int, default=50); p.add_argument("--budget", type=int, default=shiv.CONVERSATION_TOKEN_BUDGET)
+    p.add_argument("--latency", type=float, default=0.01); p.add_argument("--every", type=int, default=5); p.add_argument("--no-summary", action="store_true")
+    p.set_defaults(func=bench_conversation)
+    p = sub.add_parser("wake", help="wake-word gating: CPU per audio second and false accepts on background audio vs ungated NR+STT, misses on wake-word clips")
+    p.add_argument("--background", nargs="*", help="WAVs/folders of recorded background audio without the wake word (default: synthetic babble)")
+    p.add_argument("--positives", nargs="*", help="WAVs/folders each containing the wake word once (default: synthetic)")
+    p.add_argument("--templates", help="folder of enrolled wake-word WAVs (default: synthetic takes)"); p.add_argument("--enroll", type=int, default=3)
+    p.add_argument("--minutes", type=float, default=10.0); p.add_argument("--keywords", type=int, default=40)
+    p.add_argument("--sensitivity", type=float, nargs="+", default=[0.3, 0.4, 0.5, 0.6, 0.7])
+    p.set_defaults(func=bench_wake)
+    p = sub.add_parser("speculate", help="speculative AI fallback on the hybrid STT's local transcript: first-audio latency saved and tokens wasted")
+    p.add_argument("--repeat", type=int, default=3); p.add_argument("--local-latency", type=float, default=0.15); p.add_argument("--cloud-latency", type=float, default=0.9)
+    p.add_argument("--ai-latency", type=float, default=0.6)
+    p.set_defaults(func=bench_speculate)
+    p = sub.add_parser("server", help="server mode load test: concurrent WebSocket sessions (typed + streamed audio) vs reply latency and server CPU -> sessions per core")
+    p.add_argument("--sessions", type=int, nargs="+", default=[25, 50, 100, 200, 400, 800]); p.add_argument("--think", type=float, default=10.0, help="mean seconds between a session's commands")
+    p.add_argument("--audio", type=float, default=0.2, help="fraction of sessions streaming PCM"); p.add_argument("--seconds", type=float, default=20.0); p.add_argument("--ramp", type=float, default=5.0)
+    p.add_argument("--slo-ms", type=float, default=1000.0); p.add_argument("--ai-latency", type=float, default=0.4); p.add_argument("--stt-latency", type=float, default=0.05)
+    p.add_argument("--wiki-latency", type=float, default=0.1)
+    p.add_argument("--child", action="store_true", help=argparse.SUPPRESS); p.add_argument("--port-file", help=argparse.SUPPRESS); p.add_argument("--wiki-url", help=argparse.SUPPRESS)
+    p.add_argument("--max-sessions", type=int, default=shiv.SERVER_MAX_SESSIONS, help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_server)
+    args = parser.parse_args(); args.func(args)
+
+if __name__ == "__main__":
+    main()